@@ -41,8 +41,10 @@ setup(
     'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
   ],
   packages=['rmview', 'rmview.screenstream'],
+  # the VNC servers installed on the tablet, read only when installing them
+  package_data={'rmview': ['bin/*-vnc-server-standalone']},
   install_requires=['pyqt5', 'paramiko', 'twisted[tls]', 'pyjwt'],
-  extras_require = { 'tunnel': ['sshtunnel'] },
+  extras_require = { 'tunnel': ['sshtunnel'], 'qtreactor': ['qt5reactor'] },
   entry_points={
     'console_scripts':['rmview = rmview.rmview:rmViewMain']
   },
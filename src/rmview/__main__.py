@@ -1,6 +1,6 @@
 from rmview.rmview import *
-from twisted.python import log
 
 if __name__ == '__main__':
+  from twisted.python import log
   log.startLogging(sys.stdout)
   rmViewMain()
\ No newline at end of file
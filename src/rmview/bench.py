@@ -0,0 +1,793 @@
+"""
+Micro-benchmarks for the streaming pipeline.
+
+They run without a tablet, on synthetic data shaped like the updates
+sent by the reMarkable, e.g.:
+
+    python -m rmview.bench receive --chunk 1448
+
+Streams recorded from a tablet with the `capture_file` setting can be
+replayed with `python -m rmview.bench replay --file stream.rfbcap`, or
+served by a fake tablet to a streamer with `python -m rmview.bench e2e`.
+`python -m rmview.bench startup` measures how long rmview takes to show
+its window and, connected to a fake tablet, the first frame.
+"""
+import argparse
+import random
+import time
+import zlib
+from struct import pack
+
+from .rmparams import WIDTH, HEIGHT
+from .rfb import RFBClient, RAW_ENCODING, HEXTILE_ENCODING, RRE_ENCODING, ZRLE_ENCODING
+from . import rfb
+
+BYTES_PER_PIXEL = 2
+
+
+class NullTransport():
+
+  def write(self, data):
+    pass
+
+  def loseConnection(self):
+    pass
+
+
+def skipHandshake(client, bypp=BYTES_PER_PIXEL):
+  """Put client in the state following the RFB handshake."""
+  client.transport = NullTransport()
+  client.width, client.height = WIDTH, HEIGHT
+  client.bpp = client.depth = 8 * bypp
+  client.bypp, client.bigendian = bypp, 0
+  if bypp == 1:
+    client.redmax, client.greenmax, client.bluemax = 255, 0, 0
+    client.redshift = client.greenshift = client.blueshift = 0
+  else:
+    client.redmax, client.greenmax, client.bluemax = 31, 63, 31
+    client.redshift, client.greenshift, client.blueshift = 11, 5, 0
+  client.updates = 0
+  client._handler = client._handleExpected
+  client.expect(client._handleConnection, 1)
+  return client
+
+
+class NullClient(RFBClient):
+  """An RFBClient discarding all decoded pixels."""
+
+  def commitUpdate(self, rectangles=None):
+    self.updates += 1
+
+  def fillRectangle(self, x, y, width, height, color):
+    pass
+
+  def fillRectangles(self, fills):
+    pass
+
+
+def rawUpdate():
+  header = pack("!BxH", 0, 1) + pack("!HHHHi", 0, 0, WIDTH, HEIGHT, RAW_ENCODING)
+  return header + bytes(WIDTH * HEIGHT * BYTES_PER_PIXEL)
+
+
+def hextileUpdate():
+  # a full page of tiles with background, foreground and a few subrects,
+  # i.e. lots of small messages as when strokes are being drawn
+  tile = pack("!B", 2 | 4 | 8) + b'\xff\xff' + b'\x00\x00' + pack("!B", 4)
+  tile += b''.join(pack("!BB", (i * 4) << 4 | i * 4, 0x11) for i in range(4))
+  tiles = ((WIDTH + 15) // 16) * ((HEIGHT + 15) // 16)
+  header = pack("!BxH", 0, 1) + pack("!HHHHi", 0, 0, WIDTH, HEIGHT, HEXTILE_ENCODING)
+  return header + tile * tiles
+
+
+def rreUpdate():
+  # a white page with a few thousand short black lines
+  rng = random.Random(0)
+  subrects = b''.join(b'\x00\x00' + pack("!HHHH", rng.randrange(WIDTH - 16), rng.randrange(HEIGHT - 4), 16, 3)
+                      for _ in range(5000))
+  header = pack("!BxH", 0, 1) + pack("!HHHHi", 0, 0, WIDTH, HEIGHT, RRE_ENCODING)
+  return header + pack("!I", 5000) + b'\xff\xff' + subrects
+
+
+def zrleUpdates(count):
+  # pages of palette RLE tiles, sharing a zlib stream as on a real connection
+  z = zlib.compressobj()
+  run = b'\x80' + b'\x24' + b'\x81' + b'\x02'  # 37 white, 3 black pixels
+  updates = []
+  for _ in range(count):
+    tiles = []
+    for y in range(0, HEIGHT, 64):
+      for x in range(0, WIDTH, 64):
+        pixels = min(64, WIDTH - x) * min(64, HEIGHT - y)
+        runs = run * (pixels // 40)
+        if pixels % 40:
+          runs += b'\x80' + bytes([pixels % 40 - 1])
+        tiles.append(b'\x82\xff\xff\x00\x00' + runs)
+    data = z.compress(b''.join(tiles)) + z.flush(zlib.Z_SYNC_FLUSH)
+    header = pack("!BxH", 0, 1) + pack("!HHHHi", 0, 0, WIDTH, HEIGHT, ZRLE_ENCODING)
+    updates.append(header + pack("!I", len(data)) + data)
+  return b''.join(updates)
+
+
+def serverHandshake():
+  """Server side of a RFB 3.8 handshake without authentication."""
+  pixformat = pack("!BBBBHHHBBBxxx", 16, 16, 0, 1, 31, 63, 31, 11, 5, 0)
+  name = b'rmview bench'
+  return (b'RFB 003.008\n' + pack("!BB", 1, rfb.NO_AUTH) + pack("!I", 0)
+          + pack("!HH", WIDTH, HEIGHT) + pixformat + pack("!I", len(name)) + name)
+
+
+def syntheticCapture(updates, chunk):
+  data = serverHandshake() + (rawUpdate() + hextileUpdate() + rreUpdate()) * updates + zrleUpdates(updates)
+  return [(0, data[i:i + chunk]) for i in range(0, len(data), chunk)]
+
+
+def pageContent(rng, bypp, strokes=40):
+  """A white page with antialiased pen strokes, as a NumPy array of pixels."""
+  import numpy as np
+
+  core = np.zeros((HEIGHT, WIDTH), bool)
+  for _ in range(strokes):
+    x, y = rng.randrange(WIDTH), rng.randrange(HEIGHT)
+    dx, dy = rng.choice((-3, 3)), rng.randrange(-2, 3)
+    for _ in range(rng.randrange(50, 300)):
+      dx = min(max(dx + rng.randrange(-1, 2), -4), 4)
+      dy = min(max(dy + rng.randrange(-1, 2), -4), 4)
+      x, y = min(max(x + dx, 1), WIDTH - 3), min(max(y + dy, 1), HEIGHT - 3)
+      core[y:y+2, x:x+2] = True
+  def grow(mask):
+    grown = mask.copy()
+    grown[1:] |= mask[:-1]; grown[:-1] |= mask[1:]
+    grown[:, 1:] |= mask[:, :-1]; grown[:, :-1] |= mask[:, 1:]
+    return grown
+  inner = grow(core)
+  outer = grow(inner)
+  gray = np.full((HEIGHT, WIDTH), 255, np.uint16)
+  gray[outer] = 0xd0
+  gray[inner] = 0x80
+  gray[core] = 0
+  if bypp == 1:
+    return gray.astype(np.uint8)
+  return (gray >> 3 << 11) | (gray >> 2 << 5) | (gray >> 3)
+
+
+def feed(client, data, chunk):
+  view = memoryview(data)
+  for i in range(0, len(data), chunk):
+    client.dataReceived(bytes(view[i:i + chunk]))
+
+
+def benchReceive(args):
+  for name, update in (("raw", rawUpdate()), ("hextile", hextileUpdate())):
+    data = update * args.updates
+    client = skipHandshake(NullClient())
+    start = time.perf_counter()
+    feed(client, data, args.chunk)
+    elapsed = time.perf_counter() - start
+    assert client.updates == args.updates
+    print("%-8s %8.1f MB/s  %6.1f updates/s  (%d bytes in %d byte chunks)" % (
+      name, len(data) / elapsed / 1e6, client.updates / elapsed, len(data), args.chunk))
+
+
+def benchPaint(args):
+  from .screenstream.common import VncClient, ScreenStreamSignals
+
+  class PaintClient(VncClient):
+
+    def commitUpdate(self, rectangles=None):
+      self.updates += 1
+
+  client = skipHandshake(PaintClient(ScreenStreamSignals()))
+  client.useNumpy = not args.no_numpy
+  data = hextileUpdate() * args.updates
+  start = time.perf_counter()
+  feed(client, data, args.chunk)
+  elapsed = time.perf_counter() - start
+  print("hextile  %8.1f ms/update" % (1000 * elapsed / client.updates))
+
+
+def strokeDamage(rng, pos):
+  """Damage of a pen stroke continuing from pos: a few 16x16 tiles."""
+  x, y = pos
+  rects = []
+  for _ in range(4):
+    x = min(max(x + rng.randrange(-16, 17), 0), WIDTH - 16)
+    y = min(max(y + rng.randrange(-16, 17), 0), HEIGHT - 16)
+    rects.append((x, y, 16, 16))
+  return rects, (x, y)
+
+
+def benchViewer(args):
+  from PyQt5.QtCore import Qt
+  from PyQt5.QtGui import QImage, QPainter
+  from PyQt5.QtWidgets import QApplication
+  from .viewer import QtImageViewer, FrameItem, TiledFrameItem, GLFrameItem
+
+  app = QApplication.instance() or QApplication([])
+  img = QImage(WIDTH, HEIGHT, QImage.Format_RGB16)
+  img.fill(Qt.white)
+  painter = QPainter(img)
+  for item in (FrameItem, TiledFrameItem) + ((GLFrameItem,) if args.opengl else ()):
+    viewer = QtImageViewer()
+    viewer.frameItemClass = item
+    if item is GLFrameItem and not viewer.useOpenGL():
+      print("%-15s skipped, OpenGL is not available" % item.__name__)
+      continue
+    viewer.resize(WIDTH // 2, HEIGHT // 2)
+    viewer.show()
+    viewer.setImage(img)
+    for zoom, mode in (('fit', 'full'), ('fit', 'damage'), ('400%', 'damage')):
+      if zoom == 'fit':
+        viewer.setFit(True)
+      else:
+        viewer.setFit(False)
+        viewer.resetTransform()
+        viewer.scale(4, 4)
+        viewer.centerOn(WIDTH // 2, HEIGHT // 2)
+      app.processEvents()
+      rng = random.Random(0)
+      pos = (WIDTH // 2, HEIGHT // 2)
+      wall, cpu = time.perf_counter(), time.process_time()
+      for i in range(args.frames):
+        rects, pos = strokeDamage(rng, pos)
+        for r in rects:
+          painter.fillRect(*r, Qt.black if i % 2 else Qt.gray)
+        viewer.setImage(img, rects if mode == 'damage' else None)
+        # the scene, then the view, queue their updates
+        app.processEvents()
+        app.processEvents()
+      wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+      print("%-15s %-5s %-7s %8.1f fps  %6.2f ms CPU/frame" % (
+        item.__name__, zoom, mode, args.frames / wall, 1000 * cpu / args.frames))
+    viewer.close()
+  painter.end()
+
+
+def benchEncodings(args):
+  from PyQt5.QtGui import QImage
+  from .fakeserver import Encoder
+  from .screenstream.common import VncClient, ScreenStreamSignals, FrameBuffer, PIXEL_FORMATS, framebufferArray
+
+  bypp = 1 if args.pixel_format == 'gray8' else 2
+  rng = random.Random(0)
+  pages = [pageContent(rng, bypp) for _ in range(args.updates)]
+  print("%-8s %10s %12s %12s %18s" % ("", "KB/update", "decode ms", "decode MB/s", "ms at %g Mbit/s" % args.bandwidth))
+  for name, encoding in (("raw", RAW_ENCODING), ("rre", RRE_ENCODING), ("hextile", HEXTILE_ENCODING),
+                         ("zlibhex", rfb.ZLIBHEX_ENCODING), ("zrle", ZRLE_ENCODING), ("tight", rfb.TIGHT_ENCODING)):
+    encoder = Encoder(encoding, bypp)
+    updates = [encoder.update(page) for page in pages]
+    client = skipHandshake(VncClient(ScreenStreamSignals(), FrameBuffer(fmt=PIXEL_FORMATS[args.pixel_format])), bypp)
+    client.useNumpy = not args.no_numpy
+    client.requestUpdate = lambda delay=0: None
+    elapsed = 0
+    for update in updates:
+      start = time.perf_counter()
+      client.dataReceived(update)
+      elapsed += time.perf_counter() - start
+    shown = framebufferArray(client.framebuffer.front())[:, :WIDTH]
+    assert (shown == pages[-1]).all(), "%s: decoded frame differs" % name
+    size = sum(map(len, updates)) / len(updates)
+    decode = elapsed / len(updates)
+    print("%-8s %10.1f %12.1f %12.1f %18.1f" % (
+      name, size / 1e3, 1000 * decode, size / decode / 1e6, 1000 * (decode + size * 8 / args.bandwidth / 1e6)))
+
+
+def benchDecode(args):
+  from .fakeserver import Encoder
+  from .screenstream.common import VncClient, ScreenStreamSignals, FrameBuffer, PIXEL_FORMATS, framebufferArray
+
+  bypp = 1 if args.pixel_format == 'gray8' else 2
+  rng = random.Random(0)
+  pages = [pageContent(rng, bypp) for _ in range(args.updates)]
+  encoder = Encoder(ZRLE_ENCODING, bypp, band=args.band)
+  updates = [encoder.update(page) for page in pages]
+  print("ZRLE, %d rects/update" % -(-HEIGHT // args.band))
+  print("%-8s %12s %12s" % ("threads", "reactor ms", "total ms"))
+  for threads in (0, 1, 2, 4):
+    client = skipHandshake(VncClient(ScreenStreamSignals(), FrameBuffer(fmt=PIXEL_FORMATS[args.pixel_format])), bypp)
+    client.requestUpdate = lambda delay=0: None
+    if threads:
+      client._decodePool = rfb.DecodePool(client, threads)
+    busy = total = 0
+    for update in updates:
+      start = time.perf_counter()
+      client.dataReceived(update)
+      busy += time.perf_counter() - start
+      if threads:
+        # as the server waits for the request sent on commit
+        client._decodePool.flush()
+      total += time.perf_counter() - start
+    shown = framebufferArray(client.framebuffer.front())[:, :WIDTH]
+    assert (shown == pages[-1]).all(), "%d threads: decoded frame differs" % threads
+    client.connectionLost(None)
+    print("%-8d %12.1f %12.1f" % (threads, 1000 * busy / len(updates), 1000 * total / len(updates)))
+
+
+def benchReplay(args):
+  from twisted.internet import reactor
+  from .capture import readCapture, ReplayTransport
+  from .screenstream.common import VncFactory, VncClient, ScreenStreamSignals
+  from .stats import Stats
+
+  class ReplayClient(VncClient):
+
+    def connectionLost(self, reason):
+      super(ReplayClient, self).connectionLost(reason)
+      if args.realtime:
+        reactor.stop()
+
+  class ReplayFactory(VncFactory):
+    protocol = ReplayClient
+
+  if args.file:
+    records = list(readCapture(args.file))
+  else:
+    records = syntheticCapture(args.updates, args.chunk)
+  stats = Stats(enabled=True)
+  client = ReplayFactory(ScreenStreamSignals(), stats=stats).buildProtocol(None)
+  client.useNumpy = not args.no_numpy
+  transport = ReplayTransport(records, realtime=args.realtime)
+  start = time.perf_counter()
+  if args.realtime:
+    reactor.callWhenRunning(transport.play, client)
+    reactor.run()
+  else:
+    transport.play(client)
+  elapsed = time.perf_counter() - start
+  size, updates = stats.counters['bytes_in'], stats.counters['updates']
+  print("replay   %8.1f MB/s  %6.1f updates/s  (%d bytes, %d updates)" % (
+    size / elapsed / 1e6, updates / elapsed, size, updates))
+  decoders = [(name[len('decode_'):], total) for name, (total, _) in stats.timers.items() if name.startswith('decode_')]
+  for name, total in sorted(decoders, key=lambda d: -d[1]):
+    print("  %-12s %8.1f ms" % (name, total / 1e6))
+
+
+class FakeSSH():
+  """Just enough of a paramiko client for the streamers to use a fake server."""
+
+  hostname = '127.0.0.1'
+  deviceVersion = 2
+  # old enough for ScreenShare not to wait for the authentication broadcasts
+  softwareVersion = (2, 9, 1, 0)
+
+  class Output():
+
+    def __init__(self, data=b''):
+      self.data = data
+
+    def read(self):
+      return self.data
+
+  def exec_command(self, cmd):
+    # pretend the VNC server is already running
+    return None, self.Output(b'rM-vnc-server-standalone -listen localhost'), self.Output()
+
+
+def penEvents(reports):
+  """A stylus drawing at 500Hz: position and pressure, then SYN_REPORT."""
+  from .pentracker import EVENT
+  from .rmparams import e_type_abs, e_type_sync, e_code_stylus_xpos, e_code_stylus_ypos, e_code_stylus_pressure
+  data = bytearray()
+  for i in range(reports):
+    t = i * 2000
+    for e_type, e_code, value in ((e_type_abs, e_code_stylus_xpos, 5000 + i % 3000),
+                                  (e_type_abs, e_code_stylus_ypos, 8000 + i % 2000),
+                                  (e_type_abs, e_code_stylus_pressure, 0 if i % 1000 < 100 else 2000),
+                                  (e_type_sync, 0, 0)):
+      data += EVENT.pack(t // 1000000, t % 1000000, e_type, e_code, value)
+  return bytes(data)
+
+
+class PenSSH():
+  """Serves recorded pen events to a PenTracker, in chunks as they arrive from the network."""
+
+  class Channel():
+
+    def __init__(self, data, chunk):
+      self.data = memoryview(data)
+      self.chunk = chunk
+
+    def recv(self, n):
+      r, self.data = self.data[:min(n, self.chunk)], self.data[min(n, self.chunk):]
+      return bytes(r)
+
+  class Stream():
+
+    def __init__(self, channel):
+      self.channel = channel
+
+    def read(self, n):
+      return self.channel.recv(n)
+
+  class Kill():
+
+    def write(self, data):
+      pass
+
+  def __init__(self, data, chunk):
+    self.data = data
+    self.chunk = chunk
+
+  def exec_command(self, cmd):
+    return self.Kill(), self.Stream(self.Channel(self.data, self.chunk)), None
+
+
+def benchPen(args):
+  import struct
+  from .pentracker import PenTracker
+
+  reports = 500 * 60
+  data = penEvents(reports)
+  events = len(data) // 16
+  print("%d events in %d reports, %d byte chunks" % (events, reports, args.chunk))
+  print("%-10s %12s %12s" % ("", "us/event", "moves"))
+
+  # as PenTracker used to do, one read per event and a move for every x and y
+  stream = PenSSH(data, args.chunk).exec_command('')[1]
+  moves = 0
+  new_x = new_y = False
+  start = time.perf_counter()
+  while True:
+    try:
+      _, _, e_type, e_code, e_value = struct.unpack('2IHHi', stream.read(16))
+    except struct.error:
+      break
+    if e_type == 3:
+      if e_code == 1:
+        new_x = True
+      if e_code == 0:
+        new_y = True
+      if new_x and new_y:
+        moves += 1
+        new_x = new_y = False
+  print("%-10s %12.2f %12d" % ("per event", 1e6 * (time.perf_counter() - start) / events, moves))
+
+  tracker = PenTracker(PenSSH(data, args.chunk))
+  moves = []
+  tracker.signals.onPenMove.connect(lambda x, y: moves.append((x, y)))
+  start = time.perf_counter()
+  tracker._track()
+  print("%-10s %12.2f %12d" % ("batched", 1e6 * (time.perf_counter() - start) / events, len(moves)))
+
+
+def benchE2E(args):
+  from PyQt5.QtCore import QCoreApplication, QThreadPool, QTimer
+  from . import fakeserver
+  from .screenstream.common import FrameGovernor
+  from .screenstream.vnc import VncStreamer
+  from .screenstream.screenshare import ScreenShareStream
+
+  app = QCoreApplication.instance() or QCoreApplication([])
+  if args.file:
+    content = fakeserver.RecordedContent(args.file)
+  else:
+    content = fakeserver.ScriptedContent(rfb.HEXTILE_ENCODING if args.encoding == 'hextile' else ZRLE_ENCODING)
+  server = fakeserver.FakeServerFactory(content, count=args.frames, period=args.period)
+  screenshare = args.backend == 'screenshare'
+  port = fakeserver.listen(server, tls=screenshare)
+  options = dict(governor=FrameGovernor(max_fps=args.max_fps), pixel_format=args.pixel_format,
+                 decode_threads=args.decode_threads)
+  if screenshare:
+    streamer = ScreenShareStream(FakeSSH(), **options)
+  else:
+    streamer = VncStreamer(FakeSSH(), {}, **options)
+  streamer.port = port.getHost().port
+
+  frames = []
+  def onNewFrame(image, rects):
+    with streamer.framebuffer.reading():
+      frames.append(time.perf_counter())
+  streamer.signals.onNewFrame.connect(onNewFrame)
+  streamer.signals.onFatalError.connect(lambda e: (print("error:", e), app.quit()))
+
+  pool = QThreadPool.globalInstance()
+  start = time.perf_counter()
+  pool.start(streamer)
+  poll = QTimer(interval=50)
+  poll.timeout.connect(lambda: pool.activeThreadCount() or app.quit())
+  poll.start()
+  app.exec_()
+
+  events = server.events
+  if not frames or 'handshake' not in events:
+    print("no frame received")
+    return
+  print("%-12s connect %6.1f ms  first frame %6.1f ms" % (
+    args.backend, 1000 * (events['handshake'] - start), 1000 * (frames[0] - start)))
+  latencies = sorted(f - s for f, s in zip(frames[1:], server.sent[1:]))
+  if latencies and len(frames) == len(server.sent):
+    print("%d updates   median %6.2f ms  p95 %6.2f ms  max %6.2f ms" % (
+      len(latencies), 1000 * latencies[len(latencies) // 2],
+      1000 * latencies[int(len(latencies) * .95)], 1000 * latencies[-1]))
+  else:
+    print("%d updates sent, %d frames received" % (len(server.sent), len(frames)))
+
+
+class SocketServer():
+  """
+  Serves a fake server protocol to one client on a plain socket, from a
+  thread of its own, so that it shares neither the reactor nor the event
+  loop being measured. It is also the transport of the protocol.
+  """
+
+  def __init__(self, factory):
+    import socket
+    import threading
+    self.factory = factory
+    self.closed = False
+    self.listener = socket.socket()
+    self.listener.bind(('127.0.0.1', 0))
+    self.listener.listen(1)
+    self.port = self.listener.getsockname()[1]
+    self.thread = threading.Thread(target=self._serve, daemon=True)
+    self.thread.start()
+
+  def write(self, data):
+    self.conn.sendall(data)
+
+  def loseConnection(self):
+    self.closed = True
+
+  def _serve(self):
+    import socket
+    self.conn, _ = self.listener.accept()
+    self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    protocol = self.factory.buildProtocol(None)
+    protocol.makeConnection(self)
+    while not self.closed:
+      data = self.conn.recv(65536)
+      if not data:
+        break
+      protocol.dataReceived(data)
+    self.conn.close()
+    self.listener.close()
+
+
+def percentiles(latencies):
+  latencies = sorted(latencies)
+  if not latencies:
+    return "no samples"
+  return "median %6.2f ms  p95 %6.2f ms  max %6.2f ms  (%d)" % (
+    1000 * latencies[len(latencies) // 2], 1000 * latencies[int(len(latencies) * .95)],
+    1000 * latencies[-1], len(latencies))
+
+
+def benchLatency(args):
+  if args.reactor is None:
+    # a reactor can only be installed and run once per process
+    import subprocess
+    import sys
+    for mode in ('thread', 'qt'):
+      subprocess.run([sys.executable, '-m', 'rmview.bench'] + sys.argv[1:] + ['--reactor', mode], check=True)
+    return
+
+  from PyQt5.QtCore import QThreadPool, QTimer
+  from PyQt5.QtWidgets import QApplication
+  from .screenstream import qtreactor
+
+  app = QApplication.instance() or QApplication([])
+  if args.reactor == 'qt':
+    qtreactor.install()
+  from . import fakeserver
+  from .screenstream.common import FrameGovernor
+  from .screenstream.vnc import VncStreamer
+  from .viewer import QtImageViewer, FrameItem
+
+  content = fakeserver.ScriptedContent(rfb.HEXTILE_ENCODING if args.encoding == 'hextile' else ZRLE_ENCODING)
+  server = SocketServer(fakeserver.FakeServerFactory(content, count=args.frames, keepalive=0))
+  # updates are requested period seconds apart, so that they do not queue up
+  period = args.period or 0.02
+  streamer = VncStreamer(FakeSSH(), {}, governor=FrameGovernor(max_fps=0, delay=period),
+                         pixel_format=args.pixel_format, decode_threads=args.decode_threads)
+  streamer.port = server.port
+
+  # frames shown, and (time, frames shown) at each paint
+  shown = []
+  painted = []
+  class TimedFrameItem(FrameItem):
+    def paint(self, painter, option, widget=None):
+      super(TimedFrameItem, self).paint(painter, option, widget)
+      painted.append((time.perf_counter(), len(shown)))
+
+  viewer = QtImageViewer()
+  viewer.frameItemClass = TimedFrameItem
+  viewer.resize(WIDTH // 2, HEIGHT // 2)
+  viewer.show()
+
+  inputs = []
+  def sendPointer():
+    inputs.append(time.perf_counter())
+    streamer.pointerEvent(len(inputs) % WIDTH, HEIGHT // 2, 1)
+  pointer = QTimer(interval=int(1000 * period))
+  pointer.timeout.connect(sendPointer)
+
+  def onNewFrame(image, rects):
+    with streamer.framebuffer.reading() as image:
+      viewer.setImage(image, rects)
+    shown.append(time.perf_counter())
+    if not pointer.isActive():
+      pointer.start()
+  streamer.signals.onNewFrame.connect(onNewFrame)
+  streamer.signals.onFatalError.connect(lambda e: (print("error:", e), app.quit()))
+
+  # as in rmview, not the global pool, which Qt uses to convert images
+  pool = QThreadPool()
+  pool.start(streamer)
+  poll = QTimer(interval=50)
+  poll.timeout.connect(lambda: server.thread.is_alive() or pool.activeThreadCount() or app.quit())
+  poll.start()
+  app.exec_()
+  pointer.stop()
+  if qtreactor.installed():
+    qtreactor.stop()
+
+  wire = [t for kind, t in server.factory.received if kind == 5]
+  sent = server.factory.sent
+  # each update is shown by the first paint after its frame
+  paints = iter(painted)
+  toPaint = []
+  t, count = next(paints, (None, 0))
+  for i, s in enumerate(sent[:len(shown)]):
+    while t is not None and count <= i:
+      t, count = next(paints, (None, 0))
+    if t is None:
+      break
+    toPaint.append(t - s)
+  print("%-7s input-to-wire  %s" % (args.reactor, percentiles(b - a for a, b in zip(inputs, wire))))
+  print("%-7s wire-to-paint  %s" % (args.reactor, percentiles(toPaint)))
+
+
+class StartupSSH(FakeSSH):
+  """FakeSSH also serving a pen stream, where nothing happens, to a session."""
+
+  fullDeviceVersion = 'reMarkable 2.0'
+
+  class Installed():
+    """The output of a command that succeeded."""
+
+    class channel():
+
+      @staticmethod
+      def recv_exit_status():
+        return 0
+
+  class Pen():
+
+    def __init__(self):
+      import socket
+      self.channel, self._tablet = socket.socketpair()
+
+    def write(self, data):
+      # the end of the stream
+      self._tablet.close()
+
+  def exec_command(self, cmd):
+    if cmd.startswith('cat'):
+      pen = self.Pen()
+      return pen, pen, None
+    if cmd.startswith('[ -x'):
+      return None, self.Installed(), None
+    return super(StartupSSH, self).exec_command(cmd)
+
+  def close(self):
+    pass
+
+
+# Starts rmview in a fresh interpreter, and connects its session to a
+# fake tablet instead of the one configured, once the window is shown
+STARTUP = """
+import time
+start = time.perf_counter()
+import sys
+from rmview import rmview
+imported = time.perf_counter()
+loaded = [m for m in ('twisted', 'paramiko', 'jwt', 'cryptography') if m in sys.modules]
+
+class Shown(rmview.QObject):
+  def eventFilter(self, obj, e):
+    if e.type() == rmview.QEvent.Paint and 'window' not in times:
+      times['window'] = time.perf_counter()
+    return False
+
+def requestConnect(session, host_key_policy=None):
+  from rmview import bench
+  bench.connectFake(session, lambda: (times.setdefault('frame', time.perf_counter()), app.quit()))
+rmview.rMViewSession.requestConnect = requestConnect
+
+times = dict(start=start, imported=imported)
+rmview.log.setLevel(rmview.logging.ERROR)
+app = rmview.rMViewApp(sys.argv)
+shown = Shown()
+app.sessions[0].viewer.viewport().installEventFilter(shown)
+rmview.QTimer.singleShot(10000, app.quit)
+app.exec_()
+print(repr(dict(((k, t - start) for k, t in times.items()), loaded=loaded)))
+"""
+
+
+def connectFake(session, onFrame):
+  """Connect a session to a fake tablet, onFrame is called at the first frame."""
+  from . import fakeserver
+  from .screenstream.vnc import VncStreamer
+  content = fakeserver.ScriptedContent(ZRLE_ENCODING)
+  port = fakeserver.listen(fakeserver.FakeServerFactory(content, count=1000, period=.1))
+  VncStreamer.port = port.getHost().port
+  session.connected(StartupSSH())
+  session.fbworker.signals.onNewFrame.connect(onFrame)
+
+
+def benchStartup(args):
+  import ast
+  import json
+  import os
+  import subprocess
+  import sys
+  import tempfile
+
+  config = {'ssh': {'address': '127.0.0.1', 'password': ''}, 'backend': 'vncserver'}
+  with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+    json.dump(config, f)
+  try:
+    runs = []
+    for i in range(args.runs):
+      out = subprocess.run([sys.executable, '-c', STARTUP, f.name], check=True,
+                           stdout=subprocess.PIPE, universal_newlines=True).stdout
+      runs.append(ast.literal_eval(out.strip().splitlines()[-1]))
+  finally:
+    os.unlink(f.name)
+
+  print("%d runs, median times from the start of the interpreter" % args.runs)
+  for key, name in (('imported', 'import'), ('window', 'window'), ('frame', 'first frame')):
+    times = sorted(run[key] for run in runs if key in run)
+    if times:
+      print("  %-12s %8.1f ms" % (name, 1000 * times[len(times) // 2]))
+    else:
+      print("  %-12s %8s" % (name, "never"))
+  print("  loaded before the window: %s" % (', '.join(runs[0]['loaded']) or "none of twisted, paramiko, jwt"))
+
+
+BENCHMARKS = {
+  'receive': benchReceive,
+  'paint': benchPaint,
+  'viewer': benchViewer,
+  'replay': benchReplay,
+  'encodings': benchEncodings,
+  'decode': benchDecode,
+  'pen': benchPen,
+  'e2e': benchE2E,
+  'latency': benchLatency,
+  'startup': benchStartup,
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='python -m rmview.bench', description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+  parser.add_argument('--chunk', type=int, default=1448, help="size of the chunks fed to the client")
+  parser.add_argument('--updates', type=int, default=5, help="number of framebuffer updates")
+  parser.add_argument('--frames', type=int, default=200, help="number of frames shown by the viewer")
+  parser.add_argument('--no-numpy', action='store_true', help="use the pure Python/Qt code paths")
+  parser.add_argument('--file', help="capture to replay, instead of a synthetic stream")
+  parser.add_argument('--realtime', action='store_true', help="replay at the recorded pace")
+  parser.add_argument('--backend', choices=('vncserver', 'screenshare'), default='screenshare',
+                      help="streamer connecting to the fake server")
+  parser.add_argument('--encoding', choices=('hextile', 'zrle'), default='zrle',
+                      help="encoding of the scripted content of the fake server")
+  parser.add_argument('--period', type=float, help="seconds between the updates of the fake server")
+  parser.add_argument('--max-fps', type=float, default=0, help="frame rate limit of the streamer")
+  parser.add_argument('--pixel-format', choices=('rgb16', 'gray8'), default='rgb16',
+                      help="pixel format requested by the streamer or used to compare encodings")
+  parser.add_argument('--decode-threads', type=int, default=0, help="size of the decode pool of the streamer")
+  parser.add_argument('--band', type=int, default=256, help="height of the ZRLE rectangles decoded by the pool")
+  parser.add_argument('--opengl', action='store_true', help="also measure the OpenGL viewport")
+  parser.add_argument('--reactor', choices=('thread', 'qt'),
+                      help="where the reactor of the latency benchmark runs, by default both are compared")
+  parser.add_argument('--runs', type=int, default=5, help="number of times rmview is started")
+  parser.add_argument('--bandwidth', type=float, default=20, help="link speed in Mbit/s, to compare encodings")
+  args = parser.parse_args()
+  BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+  main()
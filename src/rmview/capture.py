@@ -0,0 +1,125 @@
+"""
+Recording and replay of the bytes sent by an RFB server.
+
+A capture file starts with MAGIC and is followed by one record per chunk
+received: the seconds elapsed since the start of the connection (double),
+the length of the chunk (uint32) and the chunk itself. When the client
+reconnects, e.g. to fall back to another pixel format, an empty record
+starts the next connection and only the last one is replayed.
+"""
+import logging
+import time
+from struct import Struct
+
+log = logging.getLogger('rmview')
+
+MAGIC = b'RFBCAP1\n'
+RECORD = Struct("!dI")
+
+
+class CaptureWriter():
+  """Writes the chunks received by an RFBClient to a capture file."""
+
+  def __init__(self, path):
+    self.file = open(path, 'wb')
+    self.file.write(MAGIC)
+    self.start = None
+    log.info("Capturing RFB stream to %s", path)
+
+  def connect(self):
+    """Start recording a new connection."""
+    if self.start is not None:
+      self.file.write(RECORD.pack(time.monotonic() - self.start, 0))
+    self.start = time.monotonic()
+
+  def write(self, data):
+    self.file.write(RECORD.pack(time.monotonic() - self.start, len(data)))
+    self.file.write(data)
+
+  def close(self):
+    self.file.close()
+
+
+def readCapture(path):
+  """Yields the (timestamp, data) records of the last connection in a capture file."""
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError("%s is not an RFB capture" % path)
+    start = f.tell()
+    while True:
+      header = f.read(RECORD.size)
+      if len(header) < RECORD.size:
+        break
+      t, length = RECORD.unpack(header)
+      f.seek(length, 1)
+      if not length:
+        start = f.tell()
+    f.seek(start)
+    while True:
+      header = f.read(RECORD.size)
+      if len(header) < RECORD.size:
+        return
+      t, length = RECORD.unpack(header)
+      yield t, f.read(length)
+
+
+class ReplayTransport():
+  """
+  Transport feeding a recorded stream to a protocol, either as fast as
+  possible or, if realtime is set, at the recorded pace using the reactor.
+  Whatever the protocol sends back is discarded.
+  """
+
+  disconnecting = False
+
+  def __init__(self, records, realtime=False):
+    self.records = iter(records)
+    self.realtime = realtime
+    self.protocol = None
+
+  def write(self, data):
+    pass
+
+  def writeSequence(self, seq):
+    pass
+
+  def loseConnection(self):
+    self.disconnecting = True
+
+  def getPeer(self):
+    return None
+
+  def getHost(self):
+    return None
+
+  def play(self, protocol):
+    self.protocol = protocol
+    protocol.makeConnection(self)
+    if self.realtime:
+      self.start = time.monotonic()
+      self._playNext()
+    else:
+      for _, data in self.records:
+        if self.disconnecting:
+          break
+        protocol.dataReceived(data)
+      self._finish()
+
+  def _playNext(self):
+    from twisted.internet import reactor
+    for t, data in self.records:
+      if self.disconnecting:
+        break
+      wait = self.start + t - time.monotonic()
+      if wait > 0:
+        reactor.callLater(wait, self._deliver, data)
+        return
+      self.protocol.dataReceived(data)
+    self._finish()
+
+  def _deliver(self, data):
+    self.protocol.dataReceived(data)
+    self._playNext()
+
+  def _finish(self):
+    self.protocol.connectionLost(None)
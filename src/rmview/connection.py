@@ -9,6 +9,10 @@ import paramiko
 import struct
 import time
 import re
+import json
+import base64
+import hashlib
+import threading
 from binascii import hexlify
 
 import sys
@@ -55,6 +59,92 @@ HOST_KEY_POLICY = {
 
 
 
+# Finds out what rmview needs to know about the tablet in a single round
+# trip, printing one `key=value` per line: the machine, the software
+# version (timestamp and release), whether the VNC server is installed and
+# the command line of the instance running, if any.
+PROBE = r"""
+echo "machine=$(cat /sys/devices/soc0/machine 2>/dev/null)"
+echo "version=$(cat /etc/version 2>/dev/null)"
+echo "release=$(sed -n 's/^REMARKABLE_RELEASE_VERSION=//p' /usr/share/remarkable/update.conf 2>/dev/null)"
+[ -x $HOME/rM-vnc-server-standalone ] && echo "vnc_installed=1" || echo "vnc_installed=0"
+for pid in $(pidof rM-vnc-server-standalone); do
+  echo "vnc_running=$(tr '\0' ' ' < /proc/$pid/cmdline)"
+done
+"""
+
+
+def parseProbe(output):
+  """The values printed by PROBE, the first one for each key."""
+  probe = {}
+  for line in output.splitlines():
+    key, sep, value = line.partition('=')
+    if sep:
+      probe.setdefault(key, value.strip())
+  return probe
+
+
+def fingerprint(key):
+  """The SHA256 fingerprint of a host key, as shown by OpenSSH."""
+  return 'SHA256:' + base64.b64encode(hashlib.sha256(key.asbytes()).digest()).decode().rstrip('=')
+
+
+class DeviceProfiles():
+  """
+  What was found out about each tablet, kept in a JSON file by the
+  fingerprint of its host key, which changes with the software of the
+  tablet, along with the version read from /etc/version.
+  """
+
+  _lock = threading.Lock()
+
+  def __init__(self, path):
+    self.path = path
+
+  def _load(self):
+    try:
+      with open(self.path) as f:
+        return json.load(f)
+    except FileNotFoundError:
+      return {}
+    except Exception as e:
+      log.warning("Could not read the device profiles in %s: %s", self.path, e)
+      return {}
+
+  def get(self, fingerprint):
+    with self._lock:
+      return self._load().get(fingerprint)
+
+  def update(self, fingerprint, replace=False, **values):
+    """Remember values about the tablet, forgetting the others if replace."""
+    with self._lock:
+      profiles = self._load()
+      profile = {} if replace else profiles.get(fingerprint, {})
+      profile.update(values)
+      profiles[fingerprint] = profile
+      try:
+        # it holds the hash of the user id, used to authenticate with ScreenShare
+        fd = os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+          json.dump(profiles, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+      except Exception as e:
+        log.warning("Could not save the device profiles in %s: %s", self.path, e)
+
+
+def cachedProfile(ssh):
+  """The profile of the tablet ssh is connected to, empty if not kept."""
+  return getattr(ssh, 'profile', None) or {}
+
+
+def updateProfile(ssh, **values):
+  """Remember values about the tablet ssh is connected to, if profiles are kept."""
+  profiles = getattr(ssh, 'profiles', None)
+  if profiles is not None:
+    ssh.profile = dict(cachedProfile(ssh), **values)
+    profiles.update(ssh.fingerprint, **values)
+
+
 class rMConnectSignals(QObject):
   onConnect = pyqtSignal(object)
   onError = pyqtSignal(Exception)
@@ -66,7 +156,8 @@ class rMConnect(QRunnable):
   _known_hosts = None
 
   def __init__(self, address='10.11.99.1', username='root', password=None, key=None, timeout=3,
-               onConnect=None, onError=None, host_key_policy=None, known_hosts=None, auth_method=None, **kwargs):
+               onConnect=None, onError=None, host_key_policy=None, known_hosts=None, auth_method=None,
+               profiles=None, **kwargs):
     super(rMConnect, self).__init__()
 
     self.address = address
@@ -76,6 +167,7 @@ class rMConnect(QRunnable):
     self.auth_method = auth_method
     self.host_key_policy = host_key_policy
     self._known_hosts = known_hosts
+    self.profiles = profiles
 
     if key is not None:
       key = os.path.expanduser(key)
@@ -153,34 +245,55 @@ class rMConnect(QRunnable):
     except Exception as e:
       self._exception = e
 
-  def _getVersion(self):
-    _, out, _ = self.client.exec_command("cat /sys/devices/soc0/machine")
-    rmv = out.read().decode("utf-8")
-    version = re.fullmatch(r"reMarkable(?: Prototype)? (\d+)(\.\d+)*\n", rmv)
+  def _probe(self):
+    _, out, _ = self.client.exec_command(PROBE)
+    return parseProbe(out.read().decode("utf-8", "replace"))
+
+  def _usable(self, profile):
+    # ScreenShare needs nothing else from the tablet, while the VNC server
+    # needs to know whether it is installed and running, which the probe tells
+    return profile is not None and profile.get('backend') == 'screenshare' and \
+           all(k in profile for k in ('version', 'deviceVersion', 'fullDeviceVersion', 'softwareVersion'))
+
+  def _verify(self, profile):
+    """Probe the tablet connected with a cached profile, replace it if outdated."""
+    try:
+      probe = self._probe()
+    except Exception as e:
+      log.warning("Could not verify the profile of the tablet: %s", e)
+      return
+    if probe.get('version') != profile['version'] or probe.get('machine') != profile['fullDeviceVersion']:
+      log.warning("The tablet has changed since it was last seen: reconnect if the screen is not shown")
+      self.profiles.update(self.client.fingerprint, replace=True, **self._profile(probe))
+    else:
+      log.debug("Profile of the tablet verified")
+
+  def _profile(self, probe):
+    deviceVersion, fullDeviceVersion = self._getVersion(probe)
+    return dict(version=probe.get('version'), deviceVersion=deviceVersion, fullDeviceVersion=fullDeviceVersion,
+                softwareVersion=list(self._getSwVersion(probe)))
+
+  def _getVersion(self, probe):
+    rmv = probe.get('machine', '')
+    version = re.fullmatch(r"reMarkable(?: Prototype)? (\d+)(\.\d+)*", rmv)
     if version is not None:
       version = int(version[1])
-    return version, rmv.strip()
-
-  def _getSwVersion(self):
-    _, out, _ = self.client.exec_command("cat /etc/version")
-    version_ts = int(out.read().decode("utf-8"))
-    version = timestamp_to_version(version_ts)
+    return version, rmv
 
+  def _getSwVersion(self, probe):
     try:
-      _, out, err = self.client.exec_command(r"grep 'REMARKABLE_RELEASE_VERSION=' /usr/share/remarkable/update.conf "
-                                             r"| sed -r 's/(REMARKABLE_RELEASE_VERSION=)([0-9a-zA-Z.]+)/\2/'")
-      config_version = tuple(int(v) for v in out.read().decode("utf-8").strip().split('.'))
-      if (len(config_version) < 4): config_version += (0,)*(len(config_version) - 4);
-      version = config_version
+      config_version = tuple(int(v) for v in probe.get('release', '').split('.'))
+      config_version += (0,) * (4 - len(config_version))
       log.debug("Using update.conf as SW version authority")
-    except Exception as e:
+      return config_version
+    except ValueError:
       log.debug("Using /etc/version as SW version authority")
-
-    return version
+      return timestamp_to_version(int(probe['version']))
 
 
   @pyqtSlot()
   def run(self):
+    start = time.perf_counter()
     self._initialize()
 
     if self._exception is not None:
@@ -190,12 +303,32 @@ class rMConnect(QRunnable):
     try:
       log.info('Connecting...') # pkey=key,
       self.client.connect(self.address, **self.options)
+      connected = time.perf_counter()
       log.info("Connected to {}".format(self.address))
       self.client.hostname = self.address
-      self.client.deviceVersion, self.client.fullDeviceVersion = self._getVersion()
-      self.client.softwareVersion = self._getSwVersion()
+      self.client.fingerprint = fingerprint(self.client.get_transport().get_remote_server_key())
+      self.client.profiles = self.profiles
+      profile = self.profiles.get(self.client.fingerprint) if self.profiles is not None else None
+      cached = self._usable(profile)
+      if cached:
+        log.info("Connected in %.0f ms, using the profile of the tablet seen before", 1000 * (connected - start))
+      else:
+        probe = self._probe()
+        profile = self._profile(probe)
+        self.client.probe = probe
+        if self.profiles is not None:
+          self.profiles.update(self.client.fingerprint, replace=True, **profile)
+        log.info("Connected in %.0f ms, tablet probed in %.0f ms",
+                 1000 * (connected - start), 1000 * (time.perf_counter() - connected))
+      self.client.profile = profile
+      self.client.deviceVersion = profile['deviceVersion']
+      self.client.fullDeviceVersion = profile['fullDeviceVersion']
+      self.client.softwareVersion = tuple(profile['softwareVersion'])
       log.info("Detected SW version: {}".format('.'.join(str(v) for v in self.client.softwareVersion)))
       self.signals.onConnect.emit(self.client)
+      if cached:
+        # streaming already, on what the tablet was
+        self._verify(profile)
     except Exception as e:
       log.error("Could not connect to %s: %s", self.address, e)
       log.info("Please check your remarkable is connected and retry.")
@@ -0,0 +1,499 @@
+"""
+A stand-in for the VNC servers of the tablet, to exercise the streamers
+without a device.
+
+It speaks the handshake expected by rfb.py, optionally with the reMarkable
+authentication, sends keepalives and a quit message when done, and plays
+either scripted page content, a pen stroke drawn tile by tile, or the
+updates of a stream recorded with the `capture_file` setting.
+"""
+import logging
+import random
+import time
+import zlib
+from struct import pack, unpack, unpack_from
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import Protocol, ServerFactory
+
+from .rmparams import WIDTH, HEIGHT
+from . import rfb
+
+log = logging.getLogger('rmview')
+
+# RGB565 as sent by the rM-vnc-server
+PIXEL_FORMAT = pack("!BBBBHHHBBBxxx", 16, 16, 0, 1, 31, 63, 31, 11, 5, 0)
+
+# sizes of the client messages by type and, for those with a variable
+# part, the format of its length in the header and the size of its items
+CLIENT_MESSAGES = {
+  0: (20, None, 0),       # SetPixelFormat
+  2: (4, "!xxH", 4),      # SetEncodings
+  3: (10, None, 0),       # FramebufferUpdateRequest
+  4: (8, None, 0),        # KeyEvent
+  5: (6, None, 0),        # PointerEvent
+  6: (8, "!xxxxI", 1),    # ClientCutText
+}
+
+
+def serverInit(width=WIDTH, height=HEIGHT, pixformat=PIXEL_FORMAT, name=b'rmview fake server'):
+  return pack("!HH", width, height) + pixformat + pack("!I", len(name)) + name
+
+
+def updateHeader(x, y, width, height, encoding):
+  return pack("!BxH", 0, 1) + pack("!HHHHi", x, y, width, height, encoding)
+
+
+class ScriptedContent():
+  """
+  A blank page followed by a pen stroke, sent as one small update per
+  step, encoded either with Hextile (16x16 tiles) or ZRLE (64x64 tiles),
+  in any pixel format the client asks for.
+  """
+
+  def __init__(self, encoding=rfb.ZRLE_ENCODING, seed=0):
+    self.encoding = encoding
+    self.init = serverInit()
+    self._rng = random.Random(seed)
+    self._zlib = zlib.compressobj()
+    self.setPixelFormat(16)
+
+  def setPixelFormat(self, bpp):
+    """Switch to pixels of bpp bits, returns False if unsupported."""
+    self.white, self.black = b'\xff' * (bpp // 8), b'\x00' * (bpp // 8)
+    return True
+
+  def __iter__(self):
+    yield self.page()
+    x, y = WIDTH // 2, HEIGHT // 2
+    while True:
+      x = min(max(x + self._rng.randrange(-8, 9), 0), WIDTH - 1)
+      y = min(max(y + self._rng.randrange(-8, 9), 0), HEIGHT - 1)
+      yield self.dot(x, y)
+
+  def page(self):
+    if self.encoding == rfb.HEXTILE_ENCODING:
+      tiles = ((WIDTH + 15) // 16) * ((HEIGHT + 15) // 16)
+      data = (pack("!B", 2) + self.white) + pack("!B", 0) * (tiles - 1)
+    else:
+      tiles = ((WIDTH + 63) // 64) * ((HEIGHT + 63) // 64)
+      data = self._zrle((pack("!B", 1) + self.white) * tiles)
+    return updateHeader(0, 0, WIDTH, HEIGHT, self.encoding) + data
+
+  def dot(self, x, y, size=3):
+    """A black square of the given size at (x, y), within a single tile."""
+    tile = 16 if self.encoding == rfb.HEXTILE_ENCODING else 64
+    tx, ty = x - x % tile, y - y % tile
+    w, h = min(tile, WIDTH - tx), min(tile, HEIGHT - ty)
+    dx, dy = x - tx, y - ty
+    dw, dh = min(size, w - dx), min(size, h - dy)
+    if self.encoding == rfb.HEXTILE_ENCODING:
+      data = pack("!B", 2 | 4 | 8) + self.white + self.black + pack("!BBB", 1, dx << 4 | dy, (dw - 1) << 4 | (dh - 1))
+    else:
+      rows = b''
+      for row in range(h):
+        bits = 0
+        if dy <= row < dy + dh:
+          bits = ((1 << dw) - 1) << (w - dx - dw)
+        rows += (bits << (-w % 8)).to_bytes((w + 7) // 8, 'big')
+      data = self._zrle(pack("!B", 2) + self.white + self.black + rows)
+    return updateHeader(tx, ty, w, h, self.encoding) + data
+
+  def _zrle(self, tiles):
+    # one zlib stream is shared by all the updates of a connection
+    data = self._zlib.compress(tiles) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+    return pack("!I", len(data)) + data
+
+
+class RecordedContent():
+  """The updates of a stream recorded with CaptureWriter."""
+
+  def __init__(self, path):
+    from .capture import readCapture
+
+    data = b''.join(chunk for _, chunk in readCapture(path))
+    splitter = _UpdateSplitter()
+    splitter.dataReceived(data)
+    self.init = data[splitter.initStart:splitter.offsets[0]]
+    self.updates = [data[a:b] for a, b in zip(splitter.offsets, splitter.offsets[1:])]
+
+  def __iter__(self):
+    return iter(self.updates)
+
+  def setPixelFormat(self, bpp):
+    # the recording cannot be converted
+    return bpp == unpack_from("!B", self.init, 4)[0]
+
+
+class Encoder():
+  """
+  Encodes whole frames, given as NumPy arrays of pixels, into framebuffer
+  updates. Zlib streams are kept across updates, as a server would do for
+  a connection. Simple heuristics are used, not the most compact encoding.
+  """
+
+  TIGHT_BAND = 32
+
+  def __init__(self, encoding, bypp=2, band=None):
+    self.encoding = encoding
+    self.bypp = bypp
+    # height of the rectangles a frame is split into, None for one rectangle
+    self.band = band or (self.TIGHT_BAND if encoding == rfb.TIGHT_ENCODING else None)
+    self._zrle = zlib.compressobj()
+    self._tight = [zlib.compressobj() for _ in range(4)]
+    self._zlibhex = {rfb.HEXTILE_ZLIB_RAW: zlib.compressobj(), rfb.HEXTILE_ZLIB_HEX: zlib.compressobj()}
+
+  def update(self, pixels):
+    height, width = pixels.shape
+    if self.band:
+      rects = [(0, y, width, min(self.band, height - y)) for y in range(0, height, self.band)]
+    else:
+      rects = [(0, 0, width, height)]
+    data = pack("!BxH", 0, len(rects))
+    for (x, y, w, h) in rects:
+      data += pack("!HHHHi", x, y, w, h, self.encoding) + self.rectangle(pixels[y:y+h, x:x+w])
+    return data
+
+  def rectangle(self, pixels):
+    return {
+      rfb.RAW_ENCODING: self.raw,
+      rfb.RRE_ENCODING: self.rre,
+      rfb.HEXTILE_ENCODING: self.hextile,
+      rfb.ZLIBHEX_ENCODING: self.zlibhex,
+      rfb.ZRLE_ENCODING: self.zrle,
+      rfb.TIGHT_ENCODING: self.tight,
+    }[self.encoding](pixels)
+
+  def _pixels(self, values):
+    return rfb.np.asarray(values).astype('<u%d' % self.bypp).tobytes()
+
+  def _runs(self, pixels, background):
+    """(x, y, width, color) of the horizontal runs not of background color"""
+    np = rfb.np
+    runs = []
+    for y, row in enumerate(pixels):
+      edges = np.flatnonzero(np.diff(row)) + 1
+      starts = np.concatenate(([0], edges))
+      ends = np.concatenate((edges, [len(row)]))
+      for start, end in zip(starts.tolist(), ends.tolist()):
+        if row[start] != background:
+          runs.append((start, y, end - start, row[start]))
+    return runs
+
+  def raw(self, pixels):
+    return self._pixels(pixels)
+
+  def rre(self, pixels):
+    values, counts = rfb.np.unique(pixels, return_counts=True)
+    background = values[counts.argmax()]
+    runs = self._runs(pixels, background)
+    return (pack("!I", len(runs)) + self._pixels([background])
+            + b''.join(self._pixels([c]) + pack("!HHHH", x, y, w, 1) for (x, y, w, c) in runs))
+
+  def _tiles(self, pixels, size):
+    height, width = pixels.shape
+    for y in range(0, height, size):
+      for x in range(0, width, size):
+        yield pixels[y:y+size, x:x+size]
+
+  def _hextileTile(self, tile):
+    """subencoding and the rest of a hextile tile"""
+    values, counts = rfb.np.unique(tile, return_counts=True)
+    background = values[counts.argmax()]
+    if len(values) == 1:
+      return 2, self._pixels([background])
+    runs = self._runs(tile, background)
+    coloured = len(values) > 2
+    size = len(runs) * (2 + self.bypp if coloured else 2)
+    if len(runs) > 255 or size >= tile.size * self.bypp:
+      return 1, self._pixels(tile)
+    data = b''
+    for (x, y, w, c) in runs:
+      data += (self._pixels([c]) if coloured else b'') + pack("!BB", x << 4 | y, (w - 1) << 4)
+    if coloured:
+      return 2 | 8 | 16, self._pixels([background]) + pack("!B", len(runs)) + data
+    foreground = values[values != background][0]
+    return 2 | 4 | 8, self._pixels([background, foreground]) + pack("!B", len(runs)) + data
+
+  def hextile(self, pixels):
+    return b''.join(pack("!B", sub) + data for sub, data in map(self._hextileTile, self._tiles(pixels, 16)))
+
+  def zlibhex(self, pixels):
+    data = b''
+    for tile in self._tiles(pixels, 16):
+      sub, body = self._hextileTile(tile)
+      if len(body) > 16:
+        kind = rfb.HEXTILE_ZLIB_RAW if sub & 1 else rfb.HEXTILE_ZLIB_HEX
+        z = self._zlibhex[kind]
+        body = z.compress(body) + z.flush(zlib.Z_SYNC_FLUSH)
+        sub = sub & ~1 | kind
+        body = pack("!H", len(body)) + body
+      data += pack("!B", sub) + body
+    return data
+
+  def _packed(self, indices, bits):
+    """rows of palette indices packed in bytes, each row padded"""
+    np = rfb.np
+    height, width = indices.shape
+    per_byte = 8 // bits
+    padded = np.zeros((height, -(-width // per_byte) * per_byte), np.uint8)
+    padded[:, :width] = indices
+    packed = padded.reshape(height, -1, per_byte)
+    shifts = np.arange(8 - bits, -1, -bits, dtype=np.uint8)
+    return (packed << shifts).sum(axis=2, dtype=np.uint8).tobytes()
+
+  def zrle(self, pixels):
+    np = rfb.np
+    data = b''
+    for tile in self._tiles(pixels, 64):
+      values, indices = np.unique(tile, return_inverse=True)
+      if len(values) == 1:
+        data += pack("!B", 1) + self._pixels(values)
+      elif len(values) <= 16:
+        bits = 1 if len(values) == 2 else 2 if len(values) <= 4 else 4
+        data += pack("!B", len(values)) + self._pixels(values) + self._packed(indices.reshape(tile.shape), bits)
+      else:
+        data += pack("!B", 0) + self._pixels(tile)
+    data = self._zrle.compress(data) + self._zrle.flush(zlib.Z_SYNC_FLUSH)
+    return pack("!I", len(data)) + data
+
+  def _compactLength(self, length):
+    data = bytes([length & 0x7f | (0x80 if length > 0x7f else 0)])
+    if length > 0x7f:
+      data += bytes([length >> 7 & 0x7f | (0x80 if length > 0x3fff else 0)])
+      if length > 0x3fff:
+        data += bytes([length >> 14])
+    return data
+
+  def tight(self, pixels):
+    np = rfb.np
+    values, indices = np.unique(pixels, return_inverse=True)
+    indices = indices.reshape(pixels.shape)
+    if len(values) == 1:
+      return pack("!B", rfb.TIGHT_FILL << 4) + self._pixels(values)
+    if len(values) == 2:
+      stream, head = 1, pack("!BBB", (4 | 1) << 4, rfb.TIGHT_FILTER_PALETTE, 1) + self._pixels(values)
+      data = self._packed(indices, 1)
+    elif len(values) <= 256:
+      stream, head = 2, pack("!BBB", (4 | 2) << 4, rfb.TIGHT_FILTER_PALETTE, len(values) - 1) + self._pixels(values)
+      data = indices.astype(np.uint8).tobytes()
+    else:
+      stream, head = 0, pack("!B", 0)
+      data = self._pixels(pixels)
+    if len(data) < rfb.TIGHT_MIN_TO_COMPRESS:
+      return head + data
+    z = self._tight[stream]
+    data = z.compress(data) + z.flush(zlib.Z_SYNC_FLUSH)
+    return head + self._compactLength(len(data)) + data
+
+
+class _NullTransport():
+
+  def write(self, data):
+    pass
+
+
+class _UpdateSplitter(rfb.RFBClient):
+  """Finds where the server init and each update end in a recorded stream."""
+
+  def __init__(self):
+    super(_UpdateSplitter, self).__init__()
+    self.factory = rfb.RFBFactory()
+    self.transport = _NullTransport()
+    self.initStart = None
+    self.offsets = []
+    self._received = 0
+
+  def dataReceived(self, data):
+    self._received += len(data)
+    super(_UpdateSplitter, self).dataReceived(data)
+
+  def _offset(self):
+    return self._received - len(self._buffer.peek())
+
+  def _doClientInitialization(self):
+    self.initStart = self._offset()
+    super(_UpdateSplitter, self)._doClientInitialization()
+
+  def vncConnectionMade(self):
+    self.offsets.append(self._offset())
+
+  def commitUpdate(self, rectangles=None):
+    self.offsets.append(self._offset())
+
+  def getRMChallenge(self):
+    return None
+
+
+class FakeServerProtocol(Protocol):
+
+  def connectionMade(self):
+    self.buffer = b''
+    self.handler = self._handleVersion
+    self.updates = iter(self.factory.content)
+    self.requested = False
+    self.sent = 0
+    self.factory.events['connected'] = time.perf_counter()
+    self.keepalive = self.ticker = None
+    self.transport.write(b'RFB 003.008\n')
+
+  def connectionLost(self, reason):
+    for loop in (self.keepalive, self.ticker):
+      if loop is not None and loop.running:
+        loop.stop()
+
+  def dataReceived(self, data):
+    self.buffer += data
+    while self.handler():
+      pass
+
+  def _take(self, size):
+    if len(self.buffer) < size:
+      return None
+    block, self.buffer = self.buffer[:size], self.buffer[size:]
+    return block
+
+  def _handleVersion(self):
+    if self._take(12) is None:
+      return False
+    sec_type = rfb.RM_AUTH if self.factory.rmAuth else rfb.NO_AUTH
+    self.transport.write(pack("!BB", 1, sec_type))
+    self.handler = self._handleSecurityType
+    return True
+
+  def _handleSecurityType(self):
+    block = self._take(1)
+    if block is None:
+      return False
+    # with RM_AUTH the client waits for 4 bytes before sending the
+    # challenge, otherwise these are the security result
+    self.transport.write(pack("!I", 0))
+    if block[0] == rfb.RM_AUTH:
+      self.handler = self._handleChallengeLength
+    else:
+      self.handler = self._handleClientInit
+    return True
+
+  def _handleChallengeLength(self):
+    if len(self.buffer) < 4:
+      return False
+    (length,) = unpack("!I", self.buffer[:4])
+    block = self._take(4 + length)
+    if block is None:
+      return False
+    expected = self.factory.challenge
+    ok = expected is None or block[4:] == expected
+    self.transport.write(pack("!B", 0 if ok else 1))
+    self.handler = self._handleClientInit
+    return True
+
+  def _handleClientInit(self):
+    if self._take(1) is None:
+      return False
+    self.transport.write(self.factory.content.init)
+    self.factory.events['handshake'] = time.perf_counter()
+    self.handler = self._handleMessage
+    if self.factory.keepalive:
+      self.keepalive = task.LoopingCall(self.transport.write, pack("!B", 103))
+      self.keepalive.start(self.factory.keepalive, now=False)
+    if self.factory.period:
+      self.ticker = task.LoopingCall(self._tick)
+      self.ticker.start(self.factory.period, now=False)
+    return True
+
+  def _handleMessage(self):
+    if not self.buffer:
+      return False
+    size, length, item = CLIENT_MESSAGES.get(self.buffer[0], (None, None, 0))
+    if size is None:
+      log.warning("Fake server: unknown message %d", self.buffer[0])
+      self.transport.loseConnection()
+      return False
+    if length is not None:
+      if len(self.buffer) < size:
+        return False
+      size += unpack_from(length, self.buffer)[0] * item
+    block = self._take(size)
+    if block is None:
+      return False
+    self.factory.received.append((block[0], time.perf_counter()))
+    if block[0] == 0 and not self.factory.content.setPixelFormat(block[4]):
+      log.warning("Fake server: refusing pixel format of %d bpp", block[4])
+      self.transport.loseConnection()
+      self.handler = lambda: False
+      return False
+    if block[0] == 3:
+      self.requested = True
+      if not self.factory.period or not self.sent:
+        self._sendUpdate()
+    return True
+
+  def _tick(self):
+    if self.requested:
+      self._sendUpdate()
+
+  def _sendUpdate(self):
+    update = next(self.updates, None)
+    if update is None or self.sent >= self.factory.count:
+      self.transport.write(pack("!B", 101))
+      self.transport.loseConnection()
+      self.handler = lambda: False
+      return
+    self.requested = False
+    self.factory.sent.append(time.perf_counter())
+    self.transport.write(update)
+    self.sent += 1
+
+
+class FakeServerFactory(ServerFactory):
+  """
+  Serves content (ScriptedContent or RecordedContent) to a single client.
+
+  An update is sent as soon as it is requested or, if period is set, at
+  the first tick after the request. After count updates the server sends
+  the reMarkable quit message and closes the connection. With rmAuth the
+  reMarkable authentication is used and, if challenge is set, checked.
+  The times of the connection, of the end of the handshake and of each
+  update sent are recorded in events and sent, the type and time of each
+  client message in received.
+  """
+  protocol = FakeServerProtocol
+
+  def __init__(self, content, count=100, period=None, keepalive=1, rmAuth=True, challenge=None):
+    self.content = content
+    self.count = count
+    self.period = period
+    self.keepalive = keepalive
+    self.rmAuth = rmAuth
+    self.challenge = challenge
+    self.events = {}
+    self.sent = []
+    self.received = []
+
+
+def selfSignedContext():
+  """TLS context for serving ScreenShare clients, which do not verify it."""
+  import datetime
+  from cryptography import x509
+  from cryptography.hazmat.primitives import hashes
+  from cryptography.hazmat.primitives.asymmetric import ec
+  from cryptography.x509.oid import NameOID
+  from OpenSSL import crypto
+  from twisted.internet import ssl
+
+  key = ec.generate_private_key(ec.SECP256R1())
+  name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'rmview')])
+  now = datetime.datetime.now(datetime.timezone.utc)
+  cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+          .public_key(key.public_key()).serial_number(1)
+          .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+          .sign(key, hashes.SHA256()))
+  return ssl.CertificateOptions(privateKey=crypto.PKey.from_cryptography_key(key),
+                                certificate=crypto.X509.from_cryptography(cert))
+
+
+def listen(factory, tls=False, port=0):
+  """Listen on localhost, returns the port listening."""
+  if tls:
+    return reactor.listenSSL(port, factory, selfSignedContext(), interface='127.0.0.1')
+  return reactor.listenTCP(port, factory, interface='127.0.0.1')
@@ -0,0 +1,127 @@
+"""
+Pointer and trail of the pen, drawn over the frame.
+"""
+import time
+from collections import deque
+
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import *
+
+from .rmparams import WIDTH, HEIGHT, stylus_width, stylus_height
+
+
+class PenOverlay(QObject):
+  """
+  The positions reported by the PenTracker only replace the latest one,
+  the scene is updated at display rate by a timer, which runs only while
+  the pen moves or its trail fades.
+
+  The trail is a ring buffer of the positions shown in the last trailDelay
+  ms, drawn as two paths: the newer half opaque, the older one at half
+  opacity, so that it fades in place without an item per sample.
+  """
+
+  # samples kept for the trail, at most
+  MAX_SAMPLES = 256
+
+  def __init__(self, scene, size=15, color='red', trailDelay=200, showDelay=0.4):
+    super(PenOverlay, self).__init__()
+    self.size = size
+    self.showDelay = showDelay
+    self.trailDelay = trailDelay / 1000
+    # None: disabled, False: inactive, True: active
+    self.trail = None if trailDelay == 0 else False
+    self.lastShown = None
+
+    self.pen = scene.addEllipse(-(size // 2), -(size // 2), size, size,
+                                pen=QPen(QColor('white')), brush=QBrush(QColor(color)))
+    self.pen.setZValue(100)
+    self.pen.hide()
+    trailPen = QPen(QColor(color), max(1, size // 3))
+    trailPen.setCapStyle(Qt.RoundCap)
+    trailPen.setJoinStyle(Qt.RoundJoin)
+    self.recentTrail = scene.addPath(QPainterPath(), trailPen)
+    self.olderTrail = scene.addPath(QPainterPath(), trailPen)
+    self.olderTrail.setOpacity(.5)
+    for item in (self.recentTrail, self.olderTrail):
+      item.setZValue(99)
+    # (time, x, y, joined to the previous sample)
+    self.samples = deque(maxlen=self.MAX_SAMPLES)
+    self._position = None
+
+    # from tablet to framebuffer coordinates
+    ratio_width, ratio_height = WIDTH / stylus_width, HEIGHT / stylus_height
+    self._scaling = scaling = max(ratio_width, ratio_height)
+    self._dx = (stylus_width - WIDTH / scaling) / 2
+    self._dy = (stylus_height - HEIGHT / scaling) / 2
+
+    screen = QGuiApplication.primaryScreen()
+    rate = screen.refreshRate() if screen is not None else 0
+    self.timer = QTimer(self, interval=int(1000 / (rate or 60)))
+    self.timer.setTimerType(Qt.PreciseTimer)
+    self.timer.timeout.connect(self.update)
+
+  @pyqtSlot(int, int)
+  def move(self, x, y):
+    self._position = (x, y)
+    if not self.timer.isActive():
+      self.timer.start()
+
+  @pyqtSlot()
+  def hide(self):
+    self._breakTrail()
+    self.lastShown = None
+    self.pen.hide()
+
+  @pyqtSlot()
+  def show(self):
+    """Show the pen once it has moved for showDelay seconds."""
+    self._breakTrail()
+    self.lastShown = time.perf_counter()
+
+  @pyqtSlot()
+  def showNow(self):
+    self._breakTrail()
+    self.lastShown = None
+    self.pen.show()
+
+  def _breakTrail(self):
+    if self.trail is not None:
+      self.trail = False
+
+  @pyqtSlot()
+  def update(self):
+    now = time.perf_counter()
+    if self._position is not None:
+      x, y = self._position
+      self._position = None
+      x = self._scaling * (x - self._dx)
+      y = self._scaling * (stylus_height - y - self._dy)
+      if self.trail is not None:
+        # a trail joins the positions shown while it is active
+        self.samples.append((now, x, y, self.trail and self.pen.isVisible()))
+        self.trail = True
+      self.pen.setPos(x, y)
+      if self.lastShown is not None and now - self.lastShown > self.showDelay:
+        self.pen.show()
+        self.lastShown = None
+    elif not self.samples:
+      self.timer.stop()
+      return
+
+    samples = self.samples
+    while samples and now - samples[0][0] > self.trailDelay:
+      samples.popleft()
+    half = now - self.trailDelay / 2
+    recent = QPainterPath()
+    older = QPainterPath()
+    for i, (t, x, y, joined) in enumerate(samples):
+      path = recent if t > half else older
+      if joined and i > 0:
+        # a segment is drawn by the path of its newer end
+        _, px, py, _ = samples[i - 1]
+        path.moveTo(px, py)
+        path.lineTo(x, y)
+    self.recentTrail.setPath(recent)
+    self.olderTrail.setPath(older)
@@ -4,13 +4,15 @@ from PyQt5.QtCore import *
 
 from .rmparams import *
 
-import paramiko
 import struct
 import time
 
 import sys
 import os
 import logging
+import threading
+import select
+import socket
 
 log = logging.getLogger('rmview')
 
@@ -27,10 +29,26 @@ class PenTrackerSignals(QObject):
 LIFTED = 0
 PRESSED = 1
 
+# struct input_event on the 32 bit tablets: timeval, type, code and value
+EVENT = struct.Struct('2IHHi')
+EVENTS_PER_READ = 256
+
 
 class PenTracker(QRunnable):
+  """
+  Reads the events of the pen of a tablet, from a thread of its own when
+  run, or along with the pens of other tablets when added to a
+  PenMultiplexer.
+  """
 
   _stop = False
+  _penkill = None
+  _channel = None
+  # whether the stream being read was ended by _kill(): its end arrives
+  # later, possibly after resume()
+  _killed = False
+  # called when resumed or stopped, by the PenMultiplexer reading the pen
+  _wake = None
 
   def __init__(self, ssh, path="/dev/input/event0", threshold=1000):
     super(PenTracker, self).__init__()
@@ -38,65 +56,202 @@ class PenTracker(QRunnable):
     self.ssh = ssh
     self.threshold = threshold
     self.signals = PenTrackerSignals()
+    self._resumed = threading.Event()
+    self._resumed.set()
 
   @pyqtSlot()
   def pause(self):
     self.signals.blockSignals(True)
+    self._resumed.clear()
+    self._kill()
 
   @pyqtSlot()
   def resume(self):
     self.signals.blockSignals(False)
+    self._resumed.set()
+    if self._wake is not None:
+      self._wake()
 
   def stop(self):
-    self._penkill.write('\n')
     self._stop = True
+    self._resumed.set()
+    self._kill()
+    if self._wake is not None:
+      self._wake()
+
+  def _kill(self):
+    # ends the cat on the tablet, and with it the stream being read
+    penkill, self._penkill = self._penkill, None
+    if penkill is not None:
+      self._killed = True
+      try:
+        penkill.write('\n')
+      except OSError:
+        pass
 
   @pyqtSlot()
   def run(self):
-    penkill, penstream, _ = self.ssh.exec_command('cat %s & { read ; kill %%1; }' % self.event)
-    self._penkill = penkill
-    new_x = new_y = False
-    state = LIFTED
-
     while not self._stop:
-      try:
-        _, _, e_type, e_code, e_value = struct.unpack('2IHHi', penstream.read(16))
-      except struct.error:
-        return
-      except Exception as e:
-        log.error('Error in pointer worker: %s %s', type(e), e)
+      # while paused nothing is read, nor sent by the tablet
+      self._resumed.wait()
+      if self._stop or not self._track():
         return
 
-      # decoding adapted from remarkable_mouse
-      if e_type == e_type_abs:
+  def _track(self):
+    """Read events until the stream ends, return whether it was ended on purpose."""
+    self._open()
+    try:
+      while not self._stop and self._read():
+        pass
+    except Exception as e:
+      log.error('Error in pointer worker: %s %s', type(e), e)
+      return False
+    finally:
+      self._channel = None
+    return not self._stop and self._killed
 
-        # handle x direction
-        if e_code == e_code_stylus_xpos:
-          x = e_value
-          new_x = True
+  def _open(self):
+    """Start streaming the events from the tablet."""
+    penkill, penstream, _ = self.ssh.exec_command('cat %s & { read ; kill %%1; }' % self.event)
+    self._killed = False
+    self._penkill = penkill
+    if not self._resumed.is_set():
+      # paused while starting
+      self._kill()
+    self._channel = penstream.channel
+    self._pending = b''
+    self._x = self._y = self._new_x = self._new_y = None
+    self._moved = False
+    self._changes = []
+    self._state = LIFTED
 
-        # handle y direction
-        if e_code == e_code_stylus_ypos:
-          y = e_value
-          new_y = True
+  def _read(self):
+    """Read and handle whatever has arrived, return False at the end of the stream."""
+    # as many events as possible at once
+    chunk = self._channel.recv(EVENT.size * EVENTS_PER_READ)
+    if not chunk:
+      return False
+    self._feed(chunk)
+    return True
 
-        # handle draw
-        if e_code == e_code_stylus_pressure:
+  def _feed(self, chunk):
+    data = self._pending + chunk
+    end = len(data) - len(data) % EVENT.size
+    self._pending = data[end:]
+    x, y, new_x, new_y = self._x, self._y, self._new_x, self._new_y
+    moved, changes, state = self._moved, self._changes, self._state
+
+    # decoding adapted from remarkable_mouse; events take effect at the
+    # end of their report, and only the last position read is emitted
+    for _, _, e_type, e_code, e_value in EVENT.iter_unpack(data[:end]):
+      if e_type == e_type_abs:
+        if e_code == e_code_stylus_xpos:
+          new_x = e_value
+        elif e_code == e_code_stylus_ypos:
+          new_y = e_value
+        elif e_code == e_code_stylus_pressure:
           if e_value > self.threshold:
             if state == LIFTED:
               state = PRESSED
-              self.signals.onPenPress.emit()
-          else:
-            if state == PRESSED:
-              state = LIFTED
-              self.signals.onPenLift.emit()
-
-        if new_x and new_y:
-          self.signals.onPenMove.emit(x, y)
-          new_x = new_y = False
-
-      if e_type == e_type_key and e_code == e_code_stylus_proximity:
-        if e_value == 0:
-          self.signals.onPenFar.emit()
-        else:
-          self.signals.onPenNear.emit()
+              changes.append(self.signals.onPenPress)
+          elif state == PRESSED:
+            state = LIFTED
+            changes.append(self.signals.onPenLift)
+
+      elif e_type == e_type_key and e_code == e_code_stylus_proximity:
+        changes.append(self.signals.onPenNear if e_value else self.signals.onPenFar)
+
+      elif e_type == e_type_sync and e_code == e_code_sync_report:
+        if new_x is not None and new_y is not None and (new_x, new_y) != (x, y):
+          x, y = new_x, new_y
+          moved = True
+        if changes:
+          # keep the order of moves, presses and lifts
+          if moved:
+            self.signals.onPenMove.emit(x, y)
+            moved = False
+          for signal in changes:
+            signal.emit()
+          changes = []
+
+    if moved:
+      self.signals.onPenMove.emit(x, y)
+      moved = False
+    self._x, self._y, self._new_x, self._new_y = x, y, new_x, new_y
+    self._moved, self._changes, self._state = moved, changes, state
+
+
+class PenMultiplexer(QRunnable):
+  """
+  Reads the pens of several tablets from a single thread, waiting for
+  their streams with select() rather than a blocking read per tablet.
+
+  Trackers are added with add() and dropped once stopped, or once their
+  stream ends other than by a pause.
+  """
+
+  def __init__(self):
+    super(PenMultiplexer, self).__init__()
+    self.setAutoDelete(False)
+    self._trackers = []
+    self._lock = threading.Lock()
+    self._stop = False
+    self._wakeup, self._waker = socket.socketpair()
+    self._wakeup.setblocking(False)
+
+  def add(self, tracker):
+    tracker._wake = self.wake
+    with self._lock:
+      self._trackers.append(tracker)
+    self.wake()
+
+  def wake(self):
+    try:
+      self._waker.send(b'\0')
+    except OSError:
+      pass
+
+  def stop(self):
+    self._stop = True
+    with self._lock:
+      trackers = list(self._trackers)
+    for tracker in trackers:
+      tracker.stop()
+    self.wake()
+
+  @pyqtSlot()
+  def run(self):
+    while not self._stop:
+      with self._lock:
+        self._trackers = [t for t in self._trackers if not t._stop]
+        trackers = list(self._trackers)
+      for tracker in trackers:
+        if tracker._channel is None and tracker._resumed.is_set():
+          try:
+            tracker._open()
+          except Exception as e:
+            log.error('Error in pointer worker: %s %s', type(e), e)
+            tracker.stop()
+      channels = {t._channel: t for t in trackers if t._channel is not None}
+      readable, _, _ = select.select([self._wakeup] + list(channels), [], [])
+      for channel in readable:
+        if channel is self._wakeup:
+          try:
+            self._wakeup.recv(4096)
+          except BlockingIOError:
+            pass
+          continue
+        tracker = channels[channel]
+        try:
+          if tracker._read():
+            continue
+        except Exception as e:
+          log.error('Error in pointer worker: %s %s', type(e), e)
+          tracker._stop = True
+        # the stream ended: reopened once resumed if killed by pause(), otherwise
+        # the tracker is dropped
+        tracker._channel = None
+        if not tracker._killed:
+          tracker._stop = True
+    self._wakeup.close()
+    self._waker.close()
@@ -16,12 +16,20 @@ MIT License
 import sys
 import math
 import zlib
+from array import array
 from struct import pack, unpack
+from time import perf_counter_ns
+from concurrent.futures import ThreadPoolExecutor, wait
 from twisted.python import usage, log
 from twisted.internet.protocol import Protocol
 from twisted.internet import protocol
 from twisted.application import internet, service
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Python3 compatibility replacement for ord(str) as ord(byte)
 if not isinstance(b' ', str):
     def ord(x): return x
@@ -42,6 +50,26 @@ REMARKABLE_ENCODING =           5000
 PSEUDO_CURSOR_ENCODING =        -239
 PSEUDO_DESKTOP_SIZE_ENCODING =  -223
 
+ENCODING_NAMES = {
+    value: name[:-len('_ENCODING')]
+    for name, value in list(globals().items()) if name.endswith('_ENCODING')
+}
+
+#Tight
+TIGHT_FILL = 8
+TIGHT_JPEG = 9
+TIGHT_FILTER_COPY = 0
+TIGHT_FILTER_PALETTE = 1
+TIGHT_FILTER_GRADIENT = 2
+# smaller data is sent uncompressed
+TIGHT_MIN_TO_COMPRESS = 12
+#0xffffffe0 to 0xffffffe9 JPEG quality levels
+PSEUDO_JPEG_QUALITY_0_ENCODING = -32
+
+#ZlibHex subencodings, in addition to the Hextile ones
+HEXTILE_ZLIB_RAW = 32
+HEXTILE_ZLIB_HEX = 64
+
 #auth types
 NO_AUTH = 1
 VNC_AUTH = 2
@@ -161,6 +189,73 @@ class ZRLEDataStream():
         else:
             return self._zrle_next_nibble(length)
 
+    # --- NumPy decoding, see RFBClient._decodeZRLETileNumpy
+
+    def nextArray(self, length):
+        r = np.frombuffer(self._data, np.uint8, length, self._offset)
+        self._offset += length
+        return r
+
+    def nextPalette(self, palette_size):
+        return self.nextArray(palette_size * self._bypp).reshape(palette_size, self._bypp)
+
+    def nextPackedIndices(self, palette_size, width, height):
+        """palette indices of a packed palette tile, as a height x width array"""
+        if palette_size == 2:
+            bits = 1
+        elif palette_size <= 4:
+            bits = 2
+        else:
+            bits = 4
+        row_bytes = (width * bits + 7) // 8  # rows are padded to whole bytes
+        packed = self.nextArray(row_bytes * height).reshape(height, row_bytes)
+        if bits == 1:
+            indices = np.unpackbits(packed, axis=1)
+        else:
+            shifts = np.arange(8 - bits, -1, -bits, dtype=np.uint8)
+            indices = (packed[:, :, None] >> shifts) & ((1 << bits) - 1)
+            indices = indices.reshape(height, -1)
+        return indices[:, :width]
+
+    def nextRuns(self, tot_pixels, palette_size):
+        """
+        Scan the runs of an RLE tile, returning their values and lengths.
+        Values are palette indices, or offsets of the pixels in the stream
+        for plain RLE (palette_size 0).
+        """
+        data = self._data
+        offset = self._offset
+        bypp = self._bypp
+        values = []
+        lengths = []
+        num_pixels = 0
+        while num_pixels < tot_pixels:
+            if palette_size:
+                value = data[offset]
+                offset += 1
+                long_run = value & 0x80
+                value &= 0x7F
+            else:
+                value = offset
+                offset += bypp
+                long_run = True
+            run_length = 1
+            if long_run:
+                b = data[offset]
+                offset += 1
+                run_length += b
+                while b == 255:
+                    b = data[offset]
+                    offset += 1
+                    run_length += b
+            values.append(value)
+            lengths.append(run_length)
+            num_pixels += run_length
+        self._offset = offset
+        if num_pixels != tot_pixels:
+            raise ValueError("too many pixels")
+        return values, lengths
+
     def _zrle_next_bit(self, tot_pixels):
         num_pixels = 0
         while num_pixels < tot_pixels:
@@ -199,23 +294,213 @@ class ZRLEDataStream():
 
 
 
+class ReceiveBuffer():
+    """
+    Growable receive buffer with a read cursor.
+
+    Incoming chunks are appended to a bytearray and consumed from the front
+    as memoryviews, so message handlers get their block without copying.
+    A view is only valid until the handler returns: the space is reused for
+    later data, so a handler that keeps part of a block must copy it.
+    """
+
+    def __init__(self, size=65536):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def write(self, data):
+        size = len(data)
+        if self._end + size > len(self._buf):
+            self._reserve(size)
+        self._buf[self._end:self._end + size] = data
+        self._end += size
+
+    def _reserve(self, size):
+        pending = self._end - self._start
+        if pending + size <= len(self._buf) // 2:
+            # enough room once the consumed data is dropped
+            self._buf[:pending] = self._buf[self._start:self._end]
+        else:
+            # views handed out earlier keep the old bytearray alive,
+            # so grow into a fresh one instead of resizing in place
+            capacity = len(self._buf)
+            while capacity < 2 * (pending + size):
+                capacity *= 2
+            buf = bytearray(capacity)
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start = 0
+        self._end = pending
+
+    def peek(self):
+        return self._view[self._start:self._end]
+
+    def read(self, size):
+        """Return a view of the next size bytes, or None if not yet received."""
+        start = self._start
+        end = start + size
+        if end > self._end:
+            return None
+        if end == self._end:
+            self._start = self._end = 0
+        else:
+            self._start = end
+        return self._view[start:end]
+
+    def consume(self, size):
+        self._start += size
+        if self._start >= self._end:
+            self._start = self._end = 0
+
+
+
+class FillList():
+    """
+    Solid fills collected while decoding, to be applied in one pass by
+    RFBClient.fillRectangles. Rectangles are packed in an array of
+    (x, y, width, height) quadruples, colours in a parallel bytearray.
+    """
+
+    def __init__(self, bytes_per_pixel):
+        self.bypp = bytes_per_pixel
+        self.rects = array('H')
+        self.colors = bytearray()
+
+    def __len__(self):
+        return len(self.rects) // 4
+
+    def __iter__(self):
+        rects = self.rects
+        colors = self.colors
+        bypp = self.bypp
+        for i in range(len(rects) // 4):
+            yield (rects[4*i], rects[4*i+1], rects[4*i+2], rects[4*i+3],
+                   bytes(colors[i*bypp:(i+1)*bypp]))
+
+    def append(self, x, y, width, height, color):
+        self.rects.extend((x, y, width, height))
+        self.colors += color
+
+    def clear(self):
+        del self.rects[:]
+        del self.colors[:]
+
+
+
+class DecodePool():
+    """
+    Decodes ZRLE rectangles off the reactor thread.
+
+    The reactor only frames the messages: the compressed data of each
+    rectangle is inflated by a single thread, in order since all rectangles
+    share one zlib stream, and its tiles are then decoded by one of the
+    workers, in parallel with the other rectangles of the update, which
+    cover disjoint regions of the framebuffer. Tiles within a rectangle are
+    decoded in sequence, as their boundaries are only known by parsing them.
+
+    The client must draw from the workers without a QPainter, i.e. with
+    NumPy, and commits an update once all its rectangles are done.
+    """
+
+    def __init__(self, client, threads):
+        self.client = client
+        self._inflater = ThreadPoolExecutor(1, 'rfb-inflate')
+        self._workers = ThreadPoolExecutor(threads, 'rfb-decode')
+        self._jobs = []
+        self._pending = None
+
+    def decodeZRLE(self, block, x, y, width, height):
+        # the receive buffer reuses the space of block once we return
+        inflated = self._inflater.submit(self.client._zlib_stream.decompress, bytes(block))
+        self._jobs.append(self._workers.submit(
+            lambda: self.client._decodeZRLETiles(inflated.result(), x, y, width, height)))
+
+    def whenDone(self, callback, *args):
+        """Call callback(*args) on the reactor thread once the rectangles submitted so far are decoded."""
+        from twisted.internet import reactor
+        jobs, self._jobs = self._jobs, []
+        pending = self._pending = (jobs, callback, args)
+        if not jobs:
+            self._finish(pending)
+            return
+        def done(_):
+            if all(job.done() for job in jobs):
+                reactor.callFromThread(self._finishLater, pending)
+        for job in jobs:
+            job.add_done_callback(done)
+
+    def flush(self):
+        """Wait for all the rectangles submitted so far, running a pending callback right away."""
+        jobs = self._jobs + (self._pending[0] if self._pending else [])
+        wait(jobs)
+        for job in self._jobs:
+            job.result()
+        self._finish(self._pending)
+
+    def _finish(self, pending):
+        if pending is None or pending is not self._pending:
+            return  # already run by flush()
+        self._pending = None
+        jobs, callback, args = pending
+        for job in jobs:
+            job.result()  # raise decoding errors
+        callback(*args)
+
+    def _finishLater(self, pending):
+        try:
+            self._finish(pending)
+        except Exception:
+            log.err(None, "Error decoding ZRLE rectangle")
+            self.client.transport.loseConnection()
+
+    def shutdown(self):
+        self._jobs = []
+        self._pending = None
+        self._inflater.shutdown(wait=False)
+        self._workers.shutdown(wait=False)
+
+
 class RFBClient(Protocol):
 
+    # the class of the receive buffer, can be overridden to tune allocation
+    receiveBufferClass = ReceiveBuffer
+    # decode with NumPy when it is installed
+    useNumpy = True
+    # if set, an object whose write() method is given all the data received
+    capture = None
+    # if set, a Stats object collecting counters and timers while enabled
+    stats = None
+    # if set, ZRLE rectangles are decoded by a DecodePool of this many threads
+    decodeThreads = 0
+
     def __init__(self):
-        self._packet = []
-        self._packet_len = 0
+        self._buffer = self.receiveBufferClass()
         self._handler = self._handleInitial
         self._already_expecting = 0
         self._version = None
         self._version_server = None
         self._zlib_stream = zlib.decompressobj(0)
+        self._tight_streams = [zlib.decompressobj() for _ in range(4)]
+        self._zlibhex_raw_stream = zlib.decompressobj()
+        self._zlibhex_hex_stream = zlib.decompressobj()
+        self._hextile_handler = self._handleDecodeHextile
+        # [name, ns] of the rectangle being decoded while stats are enabled
+        self._decoding = None
+        self._handlerStart = 0
+        self._decodePool = None
 
     #------------------------------------------------------
     # states used on connection startup
     #------------------------------------------------------
 
     def _handleInitial(self):
-        buffer = b''.join(self._packet)
+        buffer = bytes(self._buffer.peek()[:12])
         if b'\n' in buffer:
             version = 3.8
             version_server = 3.8
@@ -229,13 +514,11 @@ class RFBClient(Protocol):
                             % version_server)
                     version = max(filter(
                         lambda x: x <= version_server, SUPPORTED_VERSIONS))
-            buffer = buffer[12:]
+            self._buffer.consume(12)
             log.msg("Using protocol version %.3f" % version)
             parts = str(version).split('.')
             self.transport.write(
                 bytes(b"RFB %03d.%03d\n" % (int(parts[0]), int(parts[1]))))
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
             self._handler = self._handleExpected
             self._version = version
             self._version_server = version_server
@@ -244,9 +527,6 @@ class RFBClient(Protocol):
                 self.expect(self._handleAuth, 4)
             else:
                 self.expect(self._handleNumberSecurityTypes, 1)
-        else:
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
 
     def _handleNumberSecurityTypes(self, block):
         (num_types,) = unpack("!B", block)
@@ -287,7 +567,9 @@ class RFBClient(Protocol):
             if self.getRMChallenge() is None:
                 log.msg("auth failed, currently ignored")
             else:
-                raise Exception("authentication failed")
+                self.vncAuthFailed("challenge refused")
+                self.transport.loseConnection()
+                return
 
         self._doClientInitialization()
 
@@ -309,10 +591,10 @@ class RFBClient(Protocol):
         self.expect(self._handleConnMessage, waitfor)
 
     def _handleConnMessage(self, block):
-        log.msg("Connection refused: %r" % block)
+        log.msg("Connection refused: %r" % bytes(block))
 
     def _handleVNCAuth(self, block):
-        self._challenge = block
+        self._challenge = bytes(block)
         self.vncRequestPassword()
         self.expect(self._handleVNCAuthResult, 4)
 
@@ -352,7 +634,7 @@ class RFBClient(Protocol):
         self.expect(self._handleAuthFailedMessage, waitfor)
 
     def _handleAuthFailedMessage(self, block):
-        self.vncAuthFailed(block)
+        self.vncAuthFailed(bytes(block))
         self.transport.loseConnection()
 
     def _doClientInitialization(self):
@@ -369,9 +651,14 @@ class RFBClient(Protocol):
         self.expect(self._handleServerName, namelen)
 
     def _handleServerName(self, block):
-        self.name = block
+        self.name = bytes(block)
         #callback:
-        log.msg('Server:', block.decode())
+        log.msg('Server:', self.name.decode())
+        if self.decodeThreads:
+            if self.useNumpy and np is not None:
+                self._decodePool = DecodePool(self, self.decodeThreads)
+            else:
+                log.msg("Decoding on the reactor thread, the decode pool needs NumPy")
         self.vncConnectionMade()
         self.expect(self._handleConnection, 1)
 
@@ -400,15 +687,37 @@ class RFBClient(Protocol):
 
     def _handleFramebufferUpdate(self, block):
         (self.rectangles,) = unpack("!xH", block)
+        if self._decodePool is not None:
+            # the previous update must be committed before drawing this one
+            self._decodePool.flush()
+        if self.stats is not None and self.stats.enabled:
+            self.stats.mark('update')
+            self.stats.count('updates')
+            self.stats.count('rects', self.rectangles)
         self.rectanglePos = []
+        self._fills = FillList(self.bypp)
         self.beginUpdate()
         self._doConnection()
 
     def _doConnection(self):
+        if self._fills:
+            # apply the fills of the last rectangle before the next one,
+            # which may overlap or copy from it
+            self.fillRectangles(self._fills)
+            self._fills.clear()
+        if self._decoding is not None:
+            name, elapsed = self._decoding
+            self._decoding = None
+            if self.stats.enabled:
+                # the rectangle ends within the handler being timed
+                self.stats.time(name, elapsed + perf_counter_ns() - self._handlerStart)
         if self.rectangles:
             self.expect(self._handleRectangle, 12)
         else:
-            self.commitUpdate(self.rectanglePos)
+            if self._decodePool is not None:
+                self._decodePool.whenDone(self.commitUpdate, self.rectanglePos)
+            else:
+                self.commitUpdate(self.rectanglePos)
             self.expect(self._handleConnection, 1)
 
     def _handleRectangle(self, block):
@@ -416,12 +725,21 @@ class RFBClient(Protocol):
         if self.rectangles:
             self.rectangles -= 1
             self.rectanglePos.append( (x, y, width, height) )
+            if self.stats is not None and self.stats.enabled:
+                name = 'decode_' + ENCODING_NAMES.get(encoding, str(encoding))
+                self._decoding = [name, 0]
             if encoding == COPY_RECTANGLE_ENCODING:
                 self.expect(self._handleDecodeCopyrect, 4, x, y, width, height)
             elif encoding == RAW_ENCODING:
                 self.expect(self._handleDecodeRAW, width*height*self.bypp, x, y, width, height)
             elif encoding == HEXTILE_ENCODING:
+                self._hextile_handler = self._handleDecodeHextile
+                self._doNextHextileSubrect(None, None, x, y, width, height, None, None)
+            elif encoding == ZLIBHEX_ENCODING:
+                self._hextile_handler = self._handleDecodeZlibHex
                 self._doNextHextileSubrect(None, None, x, y, width, height, None, None)
+            elif encoding == TIGHT_ENCODING:
+                self.expect(self._handleDecodeTight, 1, x, y, width, height)
             elif encoding == CORRE_ENCODING:
                 self.expect(self._handleDecodeCORRE, 4 + self.bypp, x, y, width, height)
             elif encoding == RRE_ENCODING:
@@ -451,6 +769,9 @@ class RFBClient(Protocol):
 
     def _handleDecodeCopyrect(self, block, x, y, width, height):
         (srcx, srcy) = unpack("!HH", block)
+        if self._decodePool is not None:
+            # the source may still be being decoded
+            self._decodePool.flush()
         self.copyRectangle(srcx, srcy, x, y, width, height)
         self._doConnection()
 
@@ -459,7 +780,7 @@ class RFBClient(Protocol):
     def _handleDecodeRRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
         color = block[4:]
-        self.fillRectangle(x, y, width, height, color)
+        self._fills.append(x, y, width, height, color)
         if subrects:
             self.expect(self._handleRRESubRectangles, (8 + self.bypp) * subrects, x, y)
         else:
@@ -471,9 +792,10 @@ class RFBClient(Protocol):
         end = len(block)
         sz  = self.bypp + 8
         format = "!%dsHHHH" % self.bypp
+        fills = self._fills
         while pos < end:
             (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
+            fills.append(topx + x, topy + y, width, height, color)
             pos += sz
         self._doConnection()
 
@@ -482,7 +804,7 @@ class RFBClient(Protocol):
     def _handleDecodeCORRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
         color = block[4:]
-        self.fillRectangle(x, y, width, height, color)
+        self._fills.append(x, y, width, height, color)
         if subrects:
             self.expect(self._handleDecodeCORRERectangles, (4 + self.bypp)*subrects, x, y)
         else:
@@ -494,9 +816,10 @@ class RFBClient(Protocol):
         end = len(block)
         sz  = self.bypp + 4
         format = "!%dsBBBB" % self.bypp
-        while pos < sz:
+        fills = self._fills
+        while pos < end:
             (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
+            fills.append(topx + x, topy + y, width, height, color)
             pos += sz
         self._doConnection()
 
@@ -522,7 +845,7 @@ class RFBClient(Protocol):
         if ty >= y + height:
             self._doConnection()
         else:
-            self.expect(self._handleDecodeHextile, 1, bg, color, x, y, width, height, tx, ty)
+            self.expect(self._hextile_handler, 1, bg, color, x, y, width, height, tx, ty)
 
     def _handleDecodeHextile(self, block, bg, color, x, y, width, height, tx, ty):
         (subencoding,) = unpack("!B", block)
@@ -544,18 +867,18 @@ class RFBClient(Protocol):
             if numbytes:
                 self.expect(self._handleDecodeHextileSubrect, numbytes, subencoding, bg, color, x, y, width, height, tx, ty, tw, th)
             else:
-                self.fillRectangle(tx, ty, tw, th, bg)
+                self._fills.append(tx, ty, tw, th, bg)
                 self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
     def _handleDecodeHextileSubrect(self, block, subencoding, bg, color, x, y, width, height, tx, ty, tw, th):
         subrects = 0
         pos = 0
         if subencoding & 2:     #BackgroundSpecified
-            bg = block[:self.bypp]
+            bg = bytes(block[:self.bypp])
             pos += self.bypp
-        self.fillRectangle(tx, ty, tw, th, bg)
+        self._fills.append(tx, ty, tw, th, bg)
         if subencoding & 4:     #ForegroundSpecified
-            color = block[pos:pos+self.bypp]
+            color = bytes(block[pos:pos+self.bypp])
             pos += self.bypp
         if subencoding & 8:     #AnySubrects
             #~ (subrects, ) = unpack("!B", block)
@@ -580,16 +903,17 @@ class RFBClient(Protocol):
         sz = self.bypp + 2
         pos = 0
         end = len(block)
+        fills = self._fills
         while pos < end:
             pos2 = pos + self.bypp
-            color = block[pos:pos2]
+            subcolor = block[pos:pos2]
             xy = ord(block[pos2])
             wh = ord(block[pos2+1])
             sx = xy >> 4
             sy = xy & 0xf
             sw = (wh >> 4) + 1
             sh = (wh & 0xf) + 1
-            self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
+            fills.append(tx + sx, ty + sy, sw, sh, subcolor)
             pos += sz
         self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
@@ -597,6 +921,7 @@ class RFBClient(Protocol):
         """all subrect with same color"""
         pos = 0
         end = len(block)
+        fills = self._fills
         while pos < end:
             xy = ord(block[pos])
             wh = ord(block[pos+1])
@@ -604,11 +929,218 @@ class RFBClient(Protocol):
             sy = xy & 0xf
             sw = (wh >> 4) + 1
             sh = (wh & 0xf) + 1
-            self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
+            fills.append(tx + sx, ty + sy, sw, sh, color)
             pos += 2
         self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
 
+    # ---  ZlibHex Encoding
+    # Hextile where tiles can be zlib compressed, either raw or hextile
+    # encoded, each kind with its own zlib stream.
+
+    def _handleDecodeZlibHex(self, block, bg, color, x, y, width, height, tx, ty):
+        (subencoding,) = unpack("!B", block)
+        if subencoding & (HEXTILE_ZLIB_RAW | HEXTILE_ZLIB_HEX) and not subencoding & 1:
+            self.expect(self._handleDecodeZlibHexLength, 2, subencoding, bg, color, x, y, width, height, tx, ty)
+        else:
+            self._handleDecodeHextile(block, bg, color, x, y, width, height, tx, ty)
+
+    def _handleDecodeZlibHexLength(self, block, subencoding, bg, color, x, y, width, height, tx, ty):
+        (length,) = unpack("!H", block)
+        self.expect(self._handleDecodeZlibHexData, length, subencoding, bg, color, x, y, width, height, tx, ty)
+
+    def _handleDecodeZlibHexData(self, block, subencoding, bg, color, x, y, width, height, tx, ty):
+        tw = min(16, x + width - tx)
+        th = min(16, y + height - ty)
+        if subencoding & HEXTILE_ZLIB_RAW:
+            self.updateRectangle(tx, ty, tw, th, self._zlibhex_raw_stream.decompress(block))
+        else:
+            data = self._zlibhex_hex_stream.decompress(block)
+            bg, color = self._decodeHextileTile(data, subencoding, bg, color, tx, ty, tw, th)
+        self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
+
+    def _decodeHextileTile(self, data, subencoding, bg, color, tx, ty, tw, th):
+        """decode a hextile encoded tile already received as a whole,
+           returns the new background and foreground colors"""
+        bypp = self.bypp
+        pos = 0
+        if subencoding & 2:     #BackgroundSpecified
+            bg = bytes(data[:bypp])
+            pos += bypp
+        fills = self._fills
+        fills.append(tx, ty, tw, th, bg)
+        if subencoding & 4:     #ForegroundSpecified
+            color = bytes(data[pos:pos+bypp])
+            pos += bypp
+        if subencoding & 8:     #AnySubrects
+            subrects = data[pos]
+            pos += 1
+            coloured = subencoding & 16
+            for _ in range(subrects):
+                if coloured:
+                    subcolor = data[pos:pos+bypp]
+                    pos += bypp
+                else:
+                    subcolor = color
+                xy, wh = data[pos], data[pos+1]
+                pos += 2
+                fills.append(tx + (xy >> 4), ty + (xy & 0xf), (wh >> 4) + 1, (wh & 0xf) + 1, subcolor)
+        return bg, color
+
+    # ---  Tight Encoding
+    # See https://github.com/rfbproto/rfbproto/blob/master/rfbproto.rst#tight-encoding
+
+    def _tightPixelSize(self):
+        """size of a TPIXEL, i.e. a pixel as sent in Tight rectangles"""
+        if (self.bpp == 32 and self.depth == 24 and
+                self.redmax == self.greenmax == self.bluemax == 255):
+            return 3
+        return self.bypp
+
+    def _tightPixels(self, data):
+        """convert TPIXELs (r, g, b) to pixels, if they differ"""
+        if self._tightPixelSize() == self.bypp:
+            return data
+        order = '>' if self.bigendian else '<'
+        if np is not None:
+            rgb = np.frombuffer(data, np.uint8).reshape(-1, 3).astype(np.uint32)
+            pixels = (rgb[:, 0] << self.redshift) | (rgb[:, 1] << self.greenshift) | (rgb[:, 2] << self.blueshift)
+            return pixels.astype(order + 'u4').tobytes()
+        return b''.join(pack(order + "I", r << self.redshift | g << self.greenshift | b << self.blueshift)
+                        for r, g, b in zip(data[0::3], data[1::3], data[2::3]))
+
+    def _expectTightLength(self, handler, *args):
+        """read a compact length (1 to 3 bytes), then expect that many bytes"""
+        self.expect(self._handleTightLength, 1, 0, 0, handler, *args)
+
+    def _handleTightLength(self, block, length, shift, handler, *args):
+        byte = block[0]
+        if shift == 14:
+            length |= byte << 14
+        else:
+            length |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                self.expect(self._handleTightLength, 1, length, shift + 7, handler, *args)
+                return
+        self.expect(handler, length, *args)
+
+    def _handleDecodeTight(self, block, x, y, width, height):
+        (control,) = unpack("!B", block)
+        for stream in range(4):
+            if control & (1 << stream):
+                self._tight_streams[stream] = zlib.decompressobj()
+        compression = control >> 4
+        if compression == TIGHT_FILL:
+            self.expect(self._handleDecodeTightFill, self._tightPixelSize(), x, y, width, height)
+        elif compression == TIGHT_JPEG:
+            self._expectTightLength(self._handleDecodeTightJpeg, x, y, width, height)
+        elif compression < 8:
+            stream = compression & 3
+            if compression & 4:
+                self.expect(self._handleDecodeTightFilter, 1, stream, x, y, width, height)
+            else:
+                self._expectTightData(stream, TIGHT_FILTER_COPY, None, x, y, width, height)
+        else:
+            raise ValueError("Unsupported Tight compression 0x%x" % compression)
+
+    def _handleDecodeTightFill(self, block, x, y, width, height):
+        self.fillRectangle(x, y, width, height, bytes(self._tightPixels(block)))
+        self._doConnection()
+
+    def _handleDecodeTightJpeg(self, block, x, y, width, height):
+        self.updateRectangleJpeg(x, y, width, height, block)
+        self._doConnection()
+
+    def _handleDecodeTightFilter(self, block, stream, x, y, width, height):
+        (filter_id,) = unpack("!B", block)
+        if filter_id == TIGHT_FILTER_PALETTE:
+            self.expect(self._handleDecodeTightPaletteSize, 1, stream, x, y, width, height)
+        elif filter_id in (TIGHT_FILTER_COPY, TIGHT_FILTER_GRADIENT):
+            self._expectTightData(stream, filter_id, None, x, y, width, height)
+        else:
+            raise ValueError("Unsupported Tight filter %d" % filter_id)
+
+    def _handleDecodeTightPaletteSize(self, block, stream, x, y, width, height):
+        colors = block[0] + 1
+        self.expect(self._handleDecodeTightPalette, colors * self._tightPixelSize(), stream, x, y, width, height)
+
+    def _handleDecodeTightPalette(self, block, stream, x, y, width, height):
+        palette = self._tightPixels(bytes(block))
+        self._expectTightData(stream, TIGHT_FILTER_PALETTE, palette, x, y, width, height)
+
+    def _expectTightData(self, stream, filter_id, palette, x, y, width, height):
+        if filter_id == TIGHT_FILTER_PALETTE:
+            colors = len(palette) // self.bypp
+            size = ((width + 7) // 8 if colors == 2 else width) * height
+        else:
+            size = width * height * self._tightPixelSize()
+        if size < TIGHT_MIN_TO_COMPRESS:
+            self.expect(self._handleDecodeTightData, size, filter_id, palette, x, y, width, height)
+        else:
+            self._expectTightLength(self._handleDecodeTightZlib, stream, filter_id, palette, x, y, width, height)
+
+    def _handleDecodeTightZlib(self, block, stream, filter_id, palette, x, y, width, height):
+        data = self._tight_streams[stream].decompress(block)
+        self._handleDecodeTightData(data, filter_id, palette, x, y, width, height)
+
+    def _handleDecodeTightData(self, block, filter_id, palette, x, y, width, height):
+        if filter_id == TIGHT_FILTER_PALETTE:
+            pixels = self._tightPaletteRect(block, palette, width, height)
+        elif filter_id == TIGHT_FILTER_GRADIENT:
+            pixels = self._tightGradientRect(block, width, height)
+        else:
+            pixels = self._tightPixels(block)
+        self.updateRectangle(x, y, width, height, pixels)
+        self._doConnection()
+
+    def _tightPaletteRect(self, data, palette, width, height):
+        bypp = self.bypp
+        colors = len(palette) // bypp
+        if self.useNumpy and np is not None:
+            palette = np.frombuffer(palette, np.uint8).reshape(colors, bypp)
+            indices = np.frombuffer(data, np.uint8)
+            if colors == 2:
+                indices = np.unpackbits(indices.reshape(height, -1), axis=1)[:, :width]
+            return palette[indices.reshape(height, width)]
+        palette = [palette[i*bypp:(i+1)*bypp] for i in range(colors)]
+        if colors == 2:
+            row_bytes = (width + 7) // 8
+            return b''.join(palette[(data[row*row_bytes + col // 8] >> (7 - col % 8)) & 1]
+                            for row in range(height) for col in range(width))
+        return b''.join(palette[i] for i in data)
+
+    def _tightGradientRect(self, data, width, height):
+        """undo the gradient filter, which sends each color component as
+           the difference from left + above - above left"""
+        tpixel = self._tightPixelSize()
+        if tpixel == 3:
+            maxes, shifts = (255, 255, 255), None
+            diffs = [tuple(data[i:i+3]) for i in range(0, len(data), 3)]
+        else:
+            maxes = (self.redmax, self.greenmax, self.bluemax)
+            shifts = (self.redshift, self.greenshift, self.blueshift)
+            fmt = {1: 'B', 2: 'H', 4: 'I'}[tpixel]
+            values = unpack(('>' if self.bigendian else '<') + fmt * (width * height), data)
+            diffs = [tuple((v >> s) & m for m, s in zip(maxes, shifts)) for v in values]
+        above = [(0, 0, 0)] * width
+        rows = []
+        for y in range(height):
+            row = []
+            left = upleft = (0, 0, 0)
+            for x in range(width):
+                up = above[x]
+                pixel = tuple(
+                    (min(max(l + u - ul, 0), m) + d) & m
+                    for l, u, ul, d, m in zip(left, up, upleft, diffs[y * width + x], maxes))
+                row.append(pixel)
+                left, upleft = pixel, up
+            rows.append(row)
+            above = row
+        if shifts is None:
+            return self._tightPixels(bytes(c for row in rows for pixel in row for c in pixel))
+        return pack(('>' if self.bigendian else '<') + fmt * (width * height),
+                    *(r << shifts[0] | g << shifts[1] | b << shifts[2] for row in rows for (r, g, b) in row))
+
     # ---  ZRLE Encoding
     def _handleDecodeZRLE(self, block, x, y, width, height):
         """
@@ -620,10 +1152,21 @@ class RFBClient(Protocol):
         self.expect(self._handleDecodeZRLEdata, compressed_bytes, x, y, width, height)
 
     def _handleDecodeZRLEdata(self, block, x, y, width, height):
+        if self._decodePool is not None:
+            self._decodePool.decodeZRLE(block, x, y, width, height)
+        else:
+            self._decodeZRLETiles(self._zlib_stream.decompress(block), x, y, width, height)
+        self._doConnection()
+
+    def _decodeZRLETiles(self, data, x, y, width, height):
         tx = x
         ty = y
 
-        data = ZRLEDataStream(self._zlib_stream.decompress(block), self.bypp)
+        data = ZRLEDataStream(data, self.bypp)
+        if self.useNumpy and np is not None:
+            decodeTile = self._decodeZRLETileNumpy
+        else:
+            decodeTile = self._decodeZRLETile
 
         while len(data) > 0:
             subencoding = data.nextByte()
@@ -635,70 +1178,109 @@ class RFBClient(Protocol):
             if y + height - ty < 64:
                 th = y + height - ty
 
-            pixels_in_tile = tw * th
+            decodeTile(data, subencoding, tx, ty, tw, th)
 
-            # decode next tile
-            palette_size = subencoding & 127
-            if subencoding & 0x80:
-                # RLE
-                pixel_data = bytearray()
+            # Next tile
+            tx = tx + 64
+            if tx >= x + width:
+                tx = x
+                ty = ty + 64
 
-                if palette_size == 0:
-                    # plain RLE
-                    while len(pixel_data) < pixels_in_tile:
-                        color = bytes(data.nextPixel())
-                        run_len = data.nextRunLength()
-                        pixel_data += color * run_len
-                        if len(pixel_data) > pixels_in_tile:
-                            raise ValueError("too many pixels")
-                else:
-                    # Palette RLE
-                    palette = [data.nextPixel() for _ in range(palette_size)]
-
-                    while len(pixel_data) < pixels_in_tile:
-                        palette_index = data.nextByte()
-                        if palette_index & 0x80:
-                            palette_index &= 0x7F
-                            # run of length > 1, more bytes follow to determine run length
-                            run_len = data.nextRunLength()
-                            pixel_data += palette[palette_index] * run_len
-                        else:
-                            # run of length 1
-                            pixel_data += palette[palette_index]
-
-                    if len(pixel_data) != pixels_in_tile:
+    def _decodeZRLETile(self, data, subencoding, tx, ty, tw, th):
+        pixels_in_tile = tw * th
+        tile_bytes = pixels_in_tile * self.bypp
+
+        # decode next tile
+        palette_size = subencoding & 127
+        if subencoding & 0x80:
+            # RLE
+            pixel_data = bytearray()
+
+            if palette_size == 0:
+                # plain RLE
+                while len(pixel_data) < tile_bytes:
+                    color = bytes(data.nextPixel())
+                    run_len = data.nextRunLength()
+                    pixel_data += color * run_len
+                    if len(pixel_data) > tile_bytes:
                         raise ValueError("too many pixels")
+            else:
+                # Palette RLE
+                palette = [bytes(data.nextPixel()) for _ in range(palette_size)]
+
+                while len(pixel_data) < tile_bytes:
+                    palette_index = data.nextByte()
+                    if palette_index & 0x80:
+                        palette_index &= 0x7F
+                        # run of length > 1, more bytes follow to determine run length
+                        run_len = data.nextRunLength()
+                        pixel_data += palette[palette_index] * run_len
+                    else:
+                        # run of length 1
+                        pixel_data += palette[palette_index]
+
+                if len(pixel_data) != tile_bytes:
+                    raise ValueError("too many pixels")
 
+            self.updateRectangle(tx, ty, tw, th, pixel_data)
+        else:
+            # No RLE
+            if palette_size == 0:
+                # Raw pixel data
+                pixel_data = data.nextPixels(pixels_in_tile)
                 self.updateRectangle(tx, ty, tw, th, pixel_data)
+            elif palette_size == 1:
+                # Fill tile with plain color
+                color = data.nextPixel()
+                self.fillRectangle(tx, ty, tw, th, color)
             else:
-                # No RLE
-                if palette_size == 0:
-                    # Raw pixel data
-                    pixel_data = data.nextPixels(pixels_in_tile)
-                    self.updateRectangle(tx, ty, tw, th, pixel_data)
-                elif palette_size == 1:
-                    # Fill tile with plain color
-                    color = data.nextPixel()
-                    self.fillRectangle(tx, ty, tw, th, color)
-                else:
-                    if palette_size > 16:
-                        raise ValueError(
-                            "Palette of size {0} is not allowed".format(palette_size))
+                if palette_size > 16:
+                    raise ValueError(
+                        "Palette of size {0} is not allowed".format(palette_size))
 
-                    palette = [data.nextPixel() for _ in range(palette_size)]
+                palette = [data.nextPixel() for _ in range(palette_size)]
 
-                    pixel_data = bytearray()
-                    for palette_index in data.nextPaletteIndices(palette_size, pixels_in_tile):
+                pixel_data = bytearray()
+                # each row of packed indices starts on a new byte
+                for _ in range(th):
+                    for palette_index in data.nextPaletteIndices(palette_size, tw):
                         pixel_data += palette[palette_index]
-                    self.updateRectangle(tx, ty, tw, th, pixel_data)
-
-            # Next tile
-            tx = tx + 64
-            if tx >= x + width:
-                tx = x
-                ty = ty + 64
+                self.updateRectangle(tx, ty, tw, th, pixel_data)
 
-        self._doConnection()
+    def _decodeZRLETileNumpy(self, data, subencoding, tx, ty, tw, th):
+        """
+        Same as _decodeZRLETile, but expands the tile with array operations
+        instead of one pixel at a time. The tile is handed to updateRectangle
+        as a height x width x bypp array.
+        """
+        palette_size = subencoding & 127
+        if palette_size == 0 and not subencoding & 0x80:
+            # Raw pixel data
+            self.updateRectangle(tx, ty, tw, th, data.nextPixels(tw * th))
+            return
+        if palette_size == 1 and not subencoding & 0x80:
+            # Fill tile with plain color
+            self.fillRectangle(tx, ty, tw, th, data.nextPixel())
+            return
+        if palette_size > 16 and not subencoding & 0x80:
+            raise ValueError(
+                "Palette of size {0} is not allowed".format(palette_size))
+
+        if palette_size:
+            palette = data.nextPalette(palette_size)
+        if subencoding & 0x80:
+            # RLE: runs have to be scanned one by one to find their length,
+            # but the pixels are expanded all at once
+            values, lengths = data.nextRuns(tw * th, palette_size)
+            if palette_size == 0:
+                stream = np.frombuffer(data._data, np.uint8)
+                colors = stream[np.add.outer(values, np.arange(self.bypp))]
+            else:
+                colors = palette[values]
+            pixel_data = np.repeat(colors, lengths, axis=0)
+        else:
+            pixel_data = palette[data.nextPackedIndices(palette_size, tw, th)]
+        self.updateRectangle(tx, ty, tw, th, pixel_data)
 
     # --- Pseudo Cursor Encoding
     def _handleDecodePsuedoCursor(self, block, x, y, width, height):
@@ -720,31 +1302,49 @@ class RFBClient(Protocol):
         self.expect(self._handleServerCutTextValue, length)
 
     def _handleServerCutTextValue(self, block):
-        self.copy_text(block)
+        self.copy_text(bytes(block))
         self.expect(self._handleConnection, 1)
 
+    def connectionLost(self, reason):
+        if self._decodePool is not None:
+            self._decodePool.shutdown()
+
     #------------------------------------------------------
     # incoming data redirector
     #------------------------------------------------------
     def dataReceived(self, data):
         #~ sys.stdout.write(repr(data) + '\n')
-        #~ print len(data), ", ", len(self._packet)
-        self._packet.append(data)
-        self._packet_len += len(data)
+        #~ print len(data), ", ", len(self._buffer)
+        if self.capture is not None:
+            self.capture.write(data)
+        if self.stats is not None and self.stats.enabled:
+            self.stats.count('bytes_in', len(data))
+        self._buffer.write(data)
         self._handler()
 
     def _handleExpected(self):
-        if self._packet_len >= self._expected_len:
-            buffer = b''.join(self._packet)
-            while len(buffer) >= self._expected_len:
-                self._already_expecting = 1
-                block, buffer = buffer[:self._expected_len], buffer[self._expected_len:]
-                #~ log.msg("handle %r with %r\n" % (block, self._expected_handler.__name__))
-                self._expected_handler(block, *self._expected_args, **self._expected_kwargs)
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
+        read = self._buffer.read
+        block = read(self._expected_len)
+        if block is not None:
+            self._already_expecting = 1
+            while block is not None:
+                #~ log.msg("handle %r with %r\n" % (bytes(block), self._expected_handler.__name__))
+                if self.stats is not None and self.stats.enabled:
+                    self._timeHandler(block)
+                else:
+                    self._expected_handler(block, *self._expected_args, **self._expected_kwargs)
+                block = read(self._expected_len)
             self._already_expecting = 0
 
+    def _timeHandler(self, block):
+        """call the expected handler, adding the time spent to the rectangle
+           being decoded: the time waiting for its data is left out"""
+        decoding = self._decoding
+        self._handlerStart = perf_counter_ns()
+        self._expected_handler(block, *self._expected_args, **self._expected_kwargs)
+        if decoding is not None and decoding is self._decoding:
+            decoding[1] += perf_counter_ns() - self._handlerStart
+
     def expect(self, handler, size, *args, **kwargs):
         #~ log.msg("expect(%r, %r, %r, %r)\n" % (handler.__name__, size, args, kwargs))
         self._expected_handler = handler
@@ -820,7 +1420,7 @@ class RFBClient(Protocol):
 
     def beginUpdate(self):
         """called before a series of updateRectangle(),
-           copyRectangle() or fillRectangle()."""
+           copyRectangle(), fillRectangle() or fillRectangles()."""
 
     def commitUpdate(self, rectangles=None):
         """called after a series of updateRectangle(), copyRectangle()
@@ -831,8 +1431,8 @@ class RFBClient(Protocol):
            rectangles."""
 
     def updateRectangle(self, x, y, width, height, data):
-        """new bitmap data. data is a string in the pixel format set
-           up earlier."""
+        """new bitmap data. data is a bytes-like object in the pixel
+           format set up earlier, only valid until the call returns."""
 
     def copyRectangle(self, srcx, srcy, x, y, width, height):
         """used for copyrect encoding. copy the given rectangle
@@ -843,7 +1443,20 @@ class RFBClient(Protocol):
            the pixel format set up earlier"""
         #fallback variant, use update recatngle
         #override with specialized function for better performance
-        self.updateRectangle(x, y, width, height, color*width*height)
+        self.updateRectangle(x, y, width, height, bytes(color)*width*height)
+
+    def fillRectangles(self, fills):
+        """fill a batch of rectangles, as collected from Hextile and
+           (Co)RRE subrects. fills is a FillList, iterating it yields
+           (x, y, width, height, color) tuples.
+           override to apply the whole batch in one pass."""
+        for (x, y, width, height, color) in fills:
+            self.fillRectangle(x, y, width, height, color)
+
+    def updateRectangleJpeg(self, x, y, width, height, data):
+        """new bitmap data as a JPEG image, only sent by Tight servers
+           when a JPEG quality level has been requested."""
+        log.msg("JPEG rectangle ignored")
 
     def updateCursor(self, x, y, width, height, image, mask):
         """ New cursor, focuses at (x, y)
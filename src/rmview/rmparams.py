@@ -24,7 +24,7 @@ def timestamp_to_version(ts):
     return (2, 9, 1, 9999) # Phony version number. Just needs to compare > 2.9.1.236
 
 
-# evtype_sync = 0
+e_type_sync = 0
 e_type_key = 1
 e_type_abs = 3
 
@@ -38,6 +38,7 @@ e_code_stylus_pressure = 24
 # evcode_finger_ypos = 54
 # evcode_finger_pressure = 58
 e_code_stylus_proximity = 320
+e_code_sync_report = 0
 
 stylus_width = 15725
 stylus_height = 20951
@@ -4,14 +4,13 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 
 from . import resources
-from .screenstream.common import KEY_Left, KEY_Right, KEY_Escape
-from .screenstream.vnc import VncStreamer
-from .screenstream.screenshare import ScreenShareStream
-from .pentracker import PenTracker
-from .connection import rMConnect, RejectNewHostKey, AddNewHostKey, UnknownHostKeyException
-from .viewer import QtImageViewer
-
-from paramiko import BadHostKeyException, HostKeys
+# paramiko, twisted and the streamers are only imported once the window
+# is shown, see rMViewSession.requestConnect and rMViewSession.connected
+from .screenstream import qtreactor
+from .pentracker import PenTracker, PenMultiplexer
+from .penoverlay import PenOverlay
+from .viewer import QtImageViewer, TiledFrameItem
+from .stats import Stats
 
 from .rmparams import *
 
@@ -21,6 +20,7 @@ import stat
 import json
 import re
 import signal
+import math
 import time
 
 import logging
@@ -28,10 +28,11 @@ logging.basicConfig(format='[%(levelname)s] %(message)s')
 log = logging.getLogger('rmview')
 
 
-class rMViewApp(QApplication):
-
-  config_file = None
-  config = {}
+class rMViewSession(QObject):
+  """
+  A tablet, shown in a window of its own: the connection, the streams of
+  its screen and pen, and the viewer.
+  """
 
   viewer = None
   fbworker = None
@@ -40,56 +41,28 @@ class rMViewApp(QApplication):
 
   streaming = True
   right_mode = True
+  stopped = False
+  # when the connection was requested, until the first frame
+  connectStart = None
+  shown = False
+  connectWhenShown = False
 
   pen = None
   pen_size = 15
-  trail = None  # None: disabled, False: inactive, True: active
-
-  cloned_frames = set()
-
-  def __init__(self, args):
-    super(rMViewApp, self).__init__(args)
-    path = QStandardPaths.standardLocations(QStandardPaths.ConfigLocation)[0]
-    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
-    self.CONFIG_DIR = path
-    self.DEFAULT_CONFIG = os.path.join(self.CONFIG_DIR, 'rmview.json')
-    self.LOCAL_KNOWN_HOSTS = os.path.join(self.CONFIG_DIR, 'rmview_known_hosts')
-
-    config_files = [] if len(args) < 2 else [args[1]]
-    config_files += ['rmview.json']
-    rmview_conf = os.environ.get("RMVIEW_CONF")
-    if rmview_conf is not None:
-        config_files += [rmview_conf]
-    config_files += [self.DEFAULT_CONFIG]
-    log.info("Searching configuration in " + ', '.join(config_files))
-    for f in config_files:
-      try:
-        f = os.path.expanduser(f)
-        with open(f) as config_file:
-          self.config = json.load(config_file)
-          self.config_file = f
-          log.info("Fetching configuration from " + f)
-          break
-      except json.JSONDecodeError as e:
-        log.error("Malformed configuration in %s: %s" % (f, e))
-      except Exception as e:
-        log.debug("Configuration failure in %s: %s" % (f, e))
-
-    self._checkConfigFilePermissions(self.config_file)
 
-    self.config.setdefault('ssh', {})
+  def __init__(self, app, config, place=(0, 1)):
+    """place is the index of the tablet and the number of tablets shown."""
+    super(rMViewSession, self).__init__()
+    self.app = app
+    self.config = config
+    self.place = place
     self.pen_size = self.config.get('pen_size', self.pen_size)
-    self.trailPen = QPen(QColor(self.config.get('pen_color', 'red')), max(1, self.pen_size // 3))
-    self.trailPen.setCapStyle(Qt.RoundCap)
-    self.trailPen.setJoinStyle(Qt.RoundJoin)
-    self.trailDelay = self.config.get('pen_trail', 200)
-    self.trail = None if self.trailDelay == 0 else False
     self.right_mode = self.config.get('right_mode', True)
 
-    self.bar = QMenuBar()
-    self.setWindowIcon(QIcon(':/assets/rmview.svg'))
-
     self.viewer = QtImageViewer()
+    # stop streaming when the window is closed
+    self.viewer.installEventFilter(self)
+    self.viewer.viewport().installEventFilter(self)
 
     if 'background_color' in self.config:
       self.viewer.setBackgroundBrush(QBrush(QColor(self.config.get('background_color'))))
@@ -97,6 +70,11 @@ class rMViewApp(QApplication):
     if self.config.get('invert_colors'):
         self.viewer.invertColors()
 
+    if self.config.get('opengl', False):
+      self.viewer.useOpenGL()
+    elif self.config.get('tiled_frame', False):
+      self.viewer.frameItemClass = TiledFrameItem
+
     ### ACTIONS
     self.cloneAction = QAction('Clone current frame', self.viewer)
     self.cloneAction.setShortcut(QKeySequence.New)
@@ -108,34 +86,40 @@ class rMViewApp(QApplication):
     self.pauseAction.triggered.connect(self.toggleStreaming)
     self.viewer.addAction(self.pauseAction)
     ###
+    self.statsAction = QAction('Show statistics', self.viewer, checkable=True)
+    self.statsAction.setShortcut('F3')
+    self.statsAction.toggled.connect(self.toggleStats)
+    self.viewer.addAction(self.statsAction)
+    ###
     self.settingsAction = QAction('Settings...', self.viewer)
     self.settingsAction.triggered.connect(self.openSettings)
     self.viewer.addAction(self.settingsAction)
     ###
     self.quitAction = QAction('Quit', self.viewer)
     self.quitAction.setShortcut('Ctrl+Q')
-    self.quitAction.triggered.connect(self.quit)
+    self.quitAction.triggered.connect(self.app.quit)
     self.viewer.addAction(self.quitAction)
     ###
     self.leftAction = QAction('Emulate Left Button', self)
     self.leftAction.setShortcut('Ctrl+Left')
-    self.leftAction.triggered.connect(lambda: self.emulateKeyEvent(KEY_Left))
+    self.leftAction.triggered.connect(lambda: self.emulateKeyEvent('KEY_Left'))
     self.viewer.addAction(self.leftAction)
     ###
     self.rightAction = QAction('Emulate Right Button', self)
     self.rightAction.setShortcut('Ctrl+Right')
-    self.rightAction.triggered.connect(lambda: self.emulateKeyEvent(KEY_Right))
+    self.rightAction.triggered.connect(lambda: self.emulateKeyEvent('KEY_Right'))
     self.viewer.addAction(self.rightAction)
     ###
     self.homeAction = QAction('Emulate Central Button', self)
     # self.homeAction.setShortcut(QKeySequence.Cancel)
-    self.homeAction.triggered.connect(lambda: self.emulateKeyEvent(KEY_Escape))
+    self.homeAction.triggered.connect(lambda: self.emulateKeyEvent('KEY_Escape'))
     self.viewer.addAction(self.homeAction)
 
 
     ### VIEWER MENU ADDITIONS
     self.viewer.menu.addAction(self.cloneAction)
     self.viewer.menu.addAction(self.pauseAction)
+    self.viewer.menu.addAction(self.statsAction)
     # inputMenu = self.viewer.menu.addMenu("Input")
     # inputMenu.addAction(self.leftAction)
     # inputMenu.addAction(self.rightAction)
@@ -148,6 +132,21 @@ class rMViewApp(QApplication):
     self.viewer.setWindowTitle("rMview")
     self.viewer.show()
 
+    # Statistics, collected only while shown or dumped periodically
+    self.stats = Stats()
+    self.statsSnapshot = None
+    self.statsOverlay = QLabel(self.viewer)
+    self.statsOverlay.setStyleSheet("background: rgba(0, 0, 0, 160); color: white; padding: 4px; font-family: monospace")
+    self.statsOverlay.hide()
+    self.statsOverlayTimer = QTimer(self, interval=1000)
+    self.statsOverlayTimer.timeout.connect(self.updateStatsOverlay)
+    statsInterval = self.config.get('stats_interval', 0)
+    if statsInterval:
+      self.stats.enabled = True
+      self.statsDumpTimer = QTimer(self, interval=int(1000 * statsInterval))
+      self.statsDumpTimer.timeout.connect(self.dumpStats)
+      self.statsDumpTimer.start()
+
     # Display connecting image until we successfuly connect
     self.viewer.setImage(QImage(':/assets/connecting.png'))
 
@@ -178,16 +177,19 @@ class rMViewApp(QApplication):
 
 
     if not self.ensureConnConfig(): # I know, it's ugly
-      QTimer.singleShot(0, lambda: self.quit())
+      QTimer.singleShot(0, self.close)
       return
 
-    self.threadpool = QThreadPool()
-    self.aboutToQuit.connect(self.joinWorkers)
-    self.requestConnect()
+    if self.shown:
+      self.requestConnect()
+    else:
+      # see eventFilter
+      self.connectWhenShown = True
 
   def emulateKeyEvent(self, key):
     if self.fbworker:
-      self.fbworker.keyEvent(key)
+      from . import rfb
+      self.fbworker.keyEvent(getattr(rfb, key))
 
   def disableAutoOrientation(self):
     self.orient = 0
@@ -212,8 +214,14 @@ class rMViewApp(QApplication):
   def autoResize(self, ratio):
     if self.viewer.windowState() & (QWindow.FullScreen | QWindow.Maximized):
       return
-    dg = self.desktop().availableGeometry(self.viewer)
-    ds = dg.size() * 0.7
+    dg = self.app.desktop().availableGeometry(self.viewer)
+    # with several tablets, each window is centered in a cell of a grid
+    index, count = self.place
+    cols = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / cols)
+    dg = QRect(dg.x() + dg.width() * (index % cols) // cols, dg.y() + dg.height() * (index // cols) // rows,
+               dg.width() // cols, dg.height() // rows)
+    ds = dg.size() * (0.7 if count == 1 else 0.95)
     if ds.width() * ratio > ds.height():
       ds.setWidth(int(ds.height() / ratio))
     else:
@@ -247,8 +255,8 @@ class rMViewApp(QApplication):
       self.config['ssh']['host_key_policy'] = "ignore_all"
 
     if self.config['ssh'].get('host_key_policy') == "auto_add":
-      if not os.path.isfile(self.LOCAL_KNOWN_HOSTS):
-        open(self.LOCAL_KNOWN_HOSTS, 'a').close()
+      if not os.path.isfile(self.app.LOCAL_KNOWN_HOSTS):
+        open(self.app.LOCAL_KNOWN_HOSTS, 'a').close()
 
     if log.isEnabledFor(logging.DEBUG):
       import copy
@@ -259,50 +267,30 @@ class rMViewApp(QApplication):
 
     return True
 
-  def _checkConfigFilePermissions(self, file_path):
-    """
-    Emit a warning message if config file is readable by others.
-    """
-    if file_path is None:
-      return
-      
-    st_mode = os.stat(file_path).st_mode
-
-    if bool(st_mode & stat.S_IROTH) or bool(st_mode & stat.S_IWOTH):
-      file_permissions = str(oct(st_mode)[4:])
-
-      if file_permissions.startswith("0") and len(file_permissions) == 4:
-        file_permissions = file_permissions[1:]
-
-      log.warn("Config file \"%s\" is readable by others (permissions=%s). If your config "
-                "file contains secrets (e.g. password) you are strongly encouraged to make sure "
-                "it's not readable by other users (chmod 600 %s)" % (file_path, file_permissions,
-                                                                     file_path))
-
   def requestConnect(self, host_key_policy=None):
+    from .connection import rMConnect, DeviceProfiles
+    self.connectStart = time.perf_counter()
     self.viewer.setWindowTitle("rMview - Connecting...")
     args = self.config.get('ssh')
     if host_key_policy:
       args = args.copy()
       args['host_key_policy'] = host_key_policy
-    self.threadpool.start(
+    profiles = None
+    if self.config.get('device_profiles', True):
+      profiles = DeviceProfiles(self.app.DEVICE_PROFILES)
+    self.app.threadpool.start(
       rMConnect(**args,
-                known_hosts=self.LOCAL_KNOWN_HOSTS,
+                known_hosts=self.app.LOCAL_KNOWN_HOSTS,
+                profiles=profiles,
                 onError=self.connectionError,
                 onConnect=self.connected ) )
 
-  @pyqtSlot()
-  def joinWorkers(self):
-    if self.penworker is not None:
-      self.penworker.stop()
-    if self.fbworker is not None:
-      self.fbworker.stop()
-    if self.ssh is not None:
-      self.ssh.close()
-    self.threadpool.waitForDone()
-
   @pyqtSlot(object)
   def connected(self, ssh):
+    # imported here, once rMViewApp has installed the reactor chosen by the configuration
+    from .screenstream.common import FrameGovernor, UpdateScheduler, preferEncodings
+    from .connection import updateProfile
+
     self.ssh = ssh
     self.viewer.setWindowTitle("rMview - " + ssh.hostname)
 
@@ -311,7 +299,7 @@ class rMViewApp(QApplication):
     if version not in [1, 2]:
       log.error("Device is unsupported: '%s' [%s]", ssh.fullDeviceVersion, version or "unknown device")
       QMessageBox.critical(None, "Unsupported device", "The detected device is '%s'.\nrmView currently only supports reMarkable 1 and 2." % ssh.fullDeviceVersion)
-      self.quit()
+      self.close()
       return
 
     backend = self.config.get('backend', 'auto')
@@ -324,50 +312,68 @@ class rMViewApp(QApplication):
           log.warning("Detected version 2.7 or 2.8. The server might not work with these versions.")
 
     log.info("Using backend '%s'", backend)
+    updateProfile(ssh, backend=backend)
+    options = dict(
+      governor=FrameGovernor(max_fps=self.config.get('max_fps', 60),
+                             adaptive=self.config.get('adaptive_fps', False),
+                             delay=self.config.get('fetch_frame_delay')),
+      capture=self.config.get('capture_file'),
+      scheduler=UpdateScheduler(refresh=self.config.get('refresh_interval')),
+      stats=self.stats,
+      jpeg_quality=self.config.get('jpeg_quality'),
+      decode_threads=self.config.get('decode_threads', 0),
+      # gray8 is opt-in: a server accepting SetPixelFormat could still send
+      # other pixels, which the fallback to rgb16 would not notice
+      pixel_format=self.config.get('pixel_format', 'rgb16'),
+    )
+    if self.config.get('encodings'):
+      options['encodings'] = preferEncodings(self.config['encodings'])
     if backend == 'screenshare':
-      self.fbworker = ScreenShareStream(ssh)
+      from .screenstream.screenshare import ScreenShareStream
+      self.fbworker = ScreenShareStream(ssh, **options)
       # does not support key/pointer events
       self.leftAction.setEnabled(False)
       self.rightAction.setEnabled(False)
       self.homeAction.setEnabled(False)
 
     elif backend == 'vncserver':
-      self.fbworker = VncStreamer(ssh, ssh_config=self.config.get('ssh', {}),
-                                       delay=self.config.get('fetch_frame_delay'))
+      from .screenstream.vnc import VncStreamer
+      self.fbworker = VncStreamer(ssh, ssh_config=self.config.get('ssh', {}), **options)
 
     self.fbworker.signals.onNewFrame.connect(self.onNewFrame)
     self.fbworker.signals.onFatalError.connect(self.frameError)
+    if self.config.get('request_visible_only', True):
+      self.viewer.visibleRectChanged.connect(self.fbworker.setVisibleRect)
+      self.fbworker.setVisibleRect(self.viewer.visibleRect())
 
     # check needed files are in place
     if self.fbworker.needsDependencies():
       if not self.promptDependenciesInstall():
         return
 
-    self.threadpool.start(self.fbworker)
+    self.app.threadpool.start(self.fbworker)
     if self.config.get("forward_mouse_events", False):
       self.viewer.pointerEvent.connect(self.fbworker.pointerEvent)
 
     self.penworker = PenTracker(ssh, path="/dev/input/event%d" % (version-1))
-    self.threadpool.start(self.penworker)
-    self.pen = self.viewer.scene.addEllipse(0,0,self.pen_size,self.pen_size,
-                                            pen=QPen(QColor('white')),
-                                            brush=QBrush(QColor(self.config.get('pen_color', 'red'))))
-    self.pen.lastShown = None
-    self.pen.showDelay = self.config.get("pen_show_delay", 0.4)
-    self.pen.hide()
-    self.pen.setZValue(100)
-    self.penworker.signals.onPenMove.connect(self.movePen)
+    self.app.penMultiplexer.add(self.penworker)
+    if self.pen is None:
+      self.pen = PenOverlay(self.viewer.scene, size=self.pen_size,
+                            color=self.config.get('pen_color', 'red'),
+                            trailDelay=self.config.get('pen_trail', 200),
+                            showDelay=self.config.get("pen_show_delay", 0.4))
+    self.penworker.signals.onPenMove.connect(self.pen.move)
     if self.config.get("show_pen_on_lift", True):
-      self.penworker.signals.onPenLift.connect(self.showPen)
+      self.penworker.signals.onPenLift.connect(self.pen.show)
     if self.config.get("hide_pen_on_press", True):
-        self.penworker.signals.onPenPress.connect(self.hidePen)
-    self.penworker.signals.onPenNear.connect(self.showPenNow)
-    self.penworker.signals.onPenFar.connect(self.hidePen)
+        self.penworker.signals.onPenPress.connect(self.pen.hide)
+    self.penworker.signals.onPenNear.connect(self.pen.showNow)
+    self.penworker.signals.onPenFar.connect(self.pen.hide)
 
   def promptDependenciesInstall(self):
     mbox = QMessageBox(QMessageBox.NoIcon, 'Missing components', 'Your reMarkable is missing some needed components.')
     icon = QPixmap(":/assets/problem.svg")
-    icon.setDevicePixelRatio(self.devicePixelRatio())
+    icon.setDevicePixelRatio(self.app.devicePixelRatio())
     mbox.setIconPixmap(icon)
     mbox.setInformativeText(
       "To work properly, rmView needs some dependencies "\
@@ -390,66 +396,73 @@ class rMViewApp(QApplication):
       except Exception as e:
         log.error('%s %s', type(e), e)
         QMessageBox.critical(None, "Error", 'There has been an error while trying to install the required components on the tablet.\n%s\n.' % e)
-        self.quit()
+        self.close()
     elif answer == QMessageBox.Cancel:
-      self.quit()
+      self.close()
     elif answer == QMessageBox.Help:
       QDesktopServices.openUrl(QUrl("https://github.com/bordaigorl/rmview"))
-      self.quit()
+      self.close()
     else:
       self.openSettings(prompt=False)
 
     return False
 
-  @pyqtSlot(QImage)
-  def onNewFrame(self, image):
-    if self.orient > 0:
-      self.detectOrientation(image)
-      if self.orient == 1:
-        self.orient = 0
-    self.viewer.setImage(image)
-
-  @pyqtSlot()
-  def hidePen(self):
-    if self.trail is not None:
-      self.trail = False
-    self.pen.lastShown = None
-    self.pen.hide()
+  @pyqtSlot(QImage, list)
+  def onNewFrame(self, image, rects):
+    stats = self.stats if self.stats.enabled else None
+    if stats is not None:
+      stats.timeSince('queue', 'emit')
+      start = time.perf_counter_ns()
+    # the frame may have moved on since the signal was queued:
+    # show the latest one, which also covers the regions in rects
+    with self.fbworker.framebuffer.reading() as image:
+      if self.orient > 0:
+        self.detectOrientation(image)
+        if self.orient == 1:
+          self.orient = 0
+      self.viewer.setImage(image, rects)
+    if stats is not None:
+      stats.time('display', time.perf_counter_ns() - start)
+      stats.timeSince('latency', 'update')
+      stats.count('frames')
+    if self.connectStart is not None:
+      log.info("First frame shown %.0f ms after connecting", 1000 * (time.perf_counter() - self.connectStart))
+      self.connectStart = None
+
+  @pyqtSlot(bool)
+  def toggleStats(self, show):
+    self.stats.enabled = show or bool(self.config.get('stats_interval'))
+    if show:
+      self.statsSnapshot = self.stats.snapshot()
+      self.statsOverlay.setText("Collecting statistics...")
+      self.statsOverlay.adjustSize()
+      self.statsOverlay.show()
+      self.statsOverlayTimer.start()
+    else:
+      self.statsOverlay.hide()
+      self.statsOverlayTimer.stop()
 
   @pyqtSlot()
-  def showPen(self):
-    if self.trail is not None:
-      self.trail = False
-    self.pen.lastShown = time.perf_counter()
-    # self.pen.show()
+  def updateStatsOverlay(self):
+    text, self.statsSnapshot = self.stats.summary(self.statsSnapshot)
+    self.statsOverlay.setText(text)
+    self.statsOverlay.adjustSize()
 
   @pyqtSlot()
-  def showPenNow(self):
-    if self.trail is not None:
-      self.trail = False
-    self.pen.lastShown = None
-    self.pen.show()
-
-  @pyqtSlot(int, int)
-  def movePen(self, x, y):
-    y = 20951 - y
-    ratio_width, ratio_height = WIDTH / 15725, HEIGHT / 20951
-    scaling = ratio_width if ratio_width > ratio_height else ratio_height
-    x = scaling * (x - (15725 - WIDTH / scaling) / 2)
-    y = scaling * (y - (20951 - HEIGHT / scaling) / 2)
-    if self.trail is not None:
-      if self.trail is False:
-        self.trail = True
-      elif self.pen.isVisible():
-        old = self.pen.rect().center()
-        t = self.viewer.scene.addLine(x,y,old.x(),old.y(),self.trailPen)
-        QTimer.singleShot(self.trailDelay // 2, lambda: t.setOpacity(.5))
-        QTimer.singleShot(self.trailDelay, lambda: self.viewer.scene.removeItem(t))
-    self.pen.setRect(x - (self.pen_size // 2), y - (self.pen_size // 2), self.pen_size, self.pen_size)
-    if self.pen.lastShown is not None:
-      if time.perf_counter() - self.pen.lastShown > self.pen.showDelay:
-        self.pen.show()
-        self.pen.lastShown = None
+  def dumpStats(self):
+    prometheus = self.config.get('stats_format', 'json') == 'prometheus'
+    text = self.stats.prometheus() if prometheus else self.stats.json()
+    path = self.config.get('stats_file')
+    if path is None:
+      log.info("Stats: %s", text)
+    elif prometheus:
+      # replace the file at once, as expected by textfile collectors
+      with open(path + '.tmp', 'w') as f:
+        f.write(text)
+      os.replace(path + '.tmp', path)
+    else:
+      with open(path, 'a') as f:
+        f.write(text + '\n')
 
   @pyqtSlot()
   def cloneViewer(self):
@@ -461,9 +474,9 @@ class rMViewApp(QApplication):
     v.setImage(img)
     v.show()
     v.rotate(self.viewer._rotation)
-    self.cloned_frames.add(v)
-    v.setWindowTitle("Cloned frame %d" % len(self.cloned_frames))
-    v.destroyed.connect(lambda: self.cloned_frames.discard(v))
+    self.app.cloned_frames.add(v)
+    v.setWindowTitle("Cloned frame %d" % len(self.app.cloned_frames))
+    v.destroyed.connect(lambda: self.app.cloned_frames.discard(v))
 
   @pyqtSlot()
   def toggleStreaming(self):
@@ -493,7 +506,7 @@ class rMViewApp(QApplication):
       if ans == QMessageBox.Cancel:
         return
 
-    confpath = os.path.abspath(self.config_file or self.DEFAULT_CONFIG)
+    confpath = os.path.abspath(self.app.config_file or self.app.DEFAULT_CONFIG)
     if not os.path.isfile(confpath):
       os.makedirs(os.path.dirname(confpath), exist_ok=True)
       with open(confpath, "w") as f:
@@ -505,15 +518,17 @@ class rMViewApp(QApplication):
             "pen_trail": 200
           }, f, indent=4)
     QDesktopServices.openUrl(QUrl("file:///" + confpath))
-    self.quit()
+    self.app.quit()
 
   @pyqtSlot(Exception)
   def connectionError(self, e):
+    from paramiko import BadHostKeyException, HostKeys
+    from .connection import UnknownHostKeyException
     self.viewer.setWindowTitle("rMview - Could not connect!")
     log.error(e)
     mbox = QMessageBox(QMessageBox.NoIcon, 'Connection error', "Connection attempt failed", parent=self.viewer)
     icon = QPixmap(":/assets/dead.svg")
-    icon.setDevicePixelRatio(self.devicePixelRatio())
+    icon.setDevicePixelRatio(self.app.devicePixelRatio())
     mbox.setIconPixmap(icon)
     mbox.addButton("Settings...", QMessageBox.ResetRole)
     mbox.addButton(QMessageBox.Cancel)
@@ -561,25 +576,153 @@ class rMViewApp(QApplication):
     if answer == QMessageBox.Retry:
       self.requestConnect()
     elif answer == QMessageBox.Cancel:
-      self.quit()
+      self.close()
     elif answer == 1: # Ignore
       self.requestConnect(host_key_policy="ignore_all")
     elif answer == 2: # Add/Update
-      if not os.path.isfile(self.LOCAL_KNOWN_HOSTS):
-        open(self.LOCAL_KNOWN_HOSTS, 'a').close()
-      hk = HostKeys(self.LOCAL_KNOWN_HOSTS)
+      if not os.path.isfile(self.app.LOCAL_KNOWN_HOSTS):
+        open(self.app.LOCAL_KNOWN_HOSTS, 'a').close()
+      hk = HostKeys(self.app.LOCAL_KNOWN_HOSTS)
       hk.add(e.hostname, e.key.get_name(), e.key)
-      hk.save(self.LOCAL_KNOWN_HOSTS)
-      log.info("Saved host key in %s", self.LOCAL_KNOWN_HOSTS)
+      hk.save(self.app.LOCAL_KNOWN_HOSTS)
+      log.info("Saved host key in %s", self.app.LOCAL_KNOWN_HOSTS)
       self.requestConnect()
     else:
       self.openSettings(prompt=False)
-      self.quit()
+      self.close()
 
   @pyqtSlot(Exception)
   def frameError(self, e):
     QMessageBox.critical(self.viewer, "Error", 'Please check your reMarkable is properly configured, see the documentation for instructions.\n\n%s' % e)
-    self.quit()
+    self.close()
+
+
+
+  def stop(self):
+    if self.stopped:
+      return
+    self.stopped = True
+    if self.penworker is not None:
+      self.penworker.stop()
+    if self.fbworker is not None:
+      self.fbworker.stop()
+    if self.ssh is not None:
+      self.ssh.close()
+
+  @pyqtSlot()
+  def close(self):
+    """Stop streaming and close the window, the application quits with the last one."""
+    self.viewer.close()
+
+  def eventFilter(self, obj, e):
+    if obj is self.viewer and e.type() == QEvent.Close:
+      self.stop()
+    elif not self.shown and e.type() == QEvent.Paint and obj is self.viewer.viewport():
+      # connecting imports paramiko and, with the streamer, twisted:
+      # not before the window has been painted
+      self.shown = True
+      if self.connectWhenShown:
+        QTimer.singleShot(0, self.requestConnect)
+    return False
+
+
+class rMViewApp(QApplication):
+  """
+  Loads the configuration and shows each tablet configured in a
+  rMViewSession, all sharing the threads of the application.
+  """
+
+  config_file = None
+  config = {}
+
+  cloned_frames = set()
+
+  def __init__(self, args):
+    super(rMViewApp, self).__init__(args)
+    path = QStandardPaths.standardLocations(QStandardPaths.ConfigLocation)[0]
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+    self.CONFIG_DIR = path
+    self.DEFAULT_CONFIG = os.path.join(self.CONFIG_DIR, 'rmview.json')
+    self.LOCAL_KNOWN_HOSTS = os.path.join(self.CONFIG_DIR, 'rmview_known_hosts')
+    self.DEVICE_PROFILES = os.path.join(self.CONFIG_DIR, 'rmview_devices.json')
+
+    config_files = [] if len(args) < 2 else [args[1]]
+    config_files += ['rmview.json']
+    rmview_conf = os.environ.get("RMVIEW_CONF")
+    if rmview_conf is not None:
+        config_files += [rmview_conf]
+    config_files += [self.DEFAULT_CONFIG]
+    log.info("Searching configuration in " + ', '.join(config_files))
+    for f in config_files:
+      try:
+        f = os.path.expanduser(f)
+        with open(f) as config_file:
+          self.config = json.load(config_file)
+          self.config_file = f
+          log.info("Fetching configuration from " + f)
+          break
+      except json.JSONDecodeError as e:
+        log.error("Malformed configuration in %s: %s" % (f, e))
+      except Exception as e:
+        log.debug("Configuration failure in %s: %s" % (f, e))
+
+    self._checkConfigFilePermissions(self.config_file)
+
+    self.config.setdefault('ssh', {})
+    # each entry overrides the settings for one tablet
+    tablets = self.config.get('tablets') or [{}]
+    if self.config.get('reactor', 'thread') == 'qt' or len(tablets) > 1:
+      # a reactor can only be run once, so several tablets share the one
+      # in the Qt event loop
+      qtreactor.install()
+
+    self.bar = QMenuBar()
+    self.setWindowIcon(QIcon(':/assets/rmview.svg'))
+
+    self.threadpool = QThreadPool()
+    # the pens of all the tablets are read by a single thread
+    self.penMultiplexer = PenMultiplexer()
+    self.threadpool.start(self.penMultiplexer)
+    # which leaves threads to connect and, unless the reactor runs in the
+    # Qt event loop, to stream the screen
+    self.threadpool.setMaxThreadCount(max(self.threadpool.maxThreadCount(), 3))
+    self.aboutToQuit.connect(self.joinWorkers)
+
+    self.sessions = []
+    for i, tablet in enumerate(tablets):
+      config = dict(self.config, **tablet)
+      config['ssh'] = dict(self.config['ssh'], **tablet.get('ssh', {}))
+      config.pop('tablets', None)
+      self.sessions.append(rMViewSession(self, config, place=(i, len(tablets))))
+
+  def _checkConfigFilePermissions(self, file_path):
+    """
+    Emit a warning message if config file is readable by others.
+    """
+    if file_path is None:
+      return
+      
+    st_mode = os.stat(file_path).st_mode
+
+    if bool(st_mode & stat.S_IROTH) or bool(st_mode & stat.S_IWOTH):
+      file_permissions = str(oct(st_mode)[4:])
+
+      if file_permissions.startswith("0") and len(file_permissions) == 4:
+        file_permissions = file_permissions[1:]
+
+      log.warn("Config file \"%s\" is readable by others (permissions=%s). If your config "
+                "file contains secrets (e.g. password) you are strongly encouraged to make sure "
+                "it's not readable by other users (chmod 600 %s)" % (file_path, file_permissions,
+                                                                     file_path))
+
+  @pyqtSlot()
+  def joinWorkers(self):
+    for session in self.sessions:
+      session.stop()
+    self.penMultiplexer.stop()
+    if qtreactor.installed():
+      qtreactor.stop()
+    self.threadpool.waitForDone()
 
   def event(self, e):
     return QApplication.event(self, e)
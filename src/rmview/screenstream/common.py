@@ -1,62 +1,421 @@
 import logging
 import atexit
+import threading
+import time
+from contextlib import contextmanager
 
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 
 from twisted.internet import reactor
 from twisted.internet.error import ConnectionRefusedError
+from twisted.python.threadable import isInIOThread
 
 from ..rmparams import *
 from ..rfb import *
+from ..capture import CaptureWriter
+from . import qtreactor
 
 IMG_FORMAT = QImage.Format_RGB16
 BYTES_PER_PIXEL = 2
 
+# formats of the framebuffer, by name as in the `pixel_format` setting;
+# rgb16 is the default of the servers, gray8 is requested with setPixelFormat
+PIXEL_FORMATS = {
+  'rgb16': QImage.Format_RGB16,
+  'gray8': QImage.Format_Grayscale8,
+}
+# encodings offered to the server, in order of preference
+DEFAULT_ENCODINGS = [
+  COPY_RECTANGLE_ENCODING,
+  HEXTILE_ENCODING,
+  CORRE_ENCODING,
+  PSEUDO_CURSOR_ENCODING,
+  RRE_ENCODING,
+  ZRLE_ENCODING,
+  TIGHT_ENCODING,
+  ZLIBHEX_ENCODING,
+  RAW_ENCODING,
+  # REMARKABLE_ENCODING
+]
+
+
+def preferEncodings(names):
+  """The default encodings, with the given ones (e.g. "tight") first."""
+  codes = {name.lower(): code for code, name in ENCODING_NAMES.items()}
+  preferred = [codes[name.lower()] for name in names]
+  return preferred + [e for e in DEFAULT_ENCODINGS if e not in preferred]
+
+
+GRAY8_PIXEL_FORMAT = dict(bpp=8, depth=8, bigendian=0, truecolor=1,
+                          redmax=255, greenmax=0, bluemax=0,
+                          redshift=0, greenshift=0, blueshift=0)
+
 log = logging.getLogger('rmview')
 
 
+def callInReactor(f, *args):
+  """Call f in the reactor thread, at once if it is the current thread."""
+  if isInIOThread():
+    f(*args)
+  else:
+    reactor.callFromThread(f, *args)
+
+
+def runReactor():
+  """
+  Run the reactor in the current thread until it is stopped, unless it
+  already runs in the Qt event loop.
+  """
+  if not qtreactor.installed():
+    reactor.run(installSignalHandlers=0)
+
+
+def stopReactor():
+  """Stop the reactor run by a streamer, the one of the Qt event loop is left running."""
+  if not qtreactor.installed():
+    reactor.callFromThread(reactor.stop)
+
+
+def framebufferArray(img):
+  """
+  NumPy view on the pixels of img, one element per pixel,
+  or None if NumPy is not installed.
+  """
+  if np is None:
+    return None
+  bits = img.bits()
+  bits.setsize(img.sizeInBytes())
+  bypp = img.depth() // 8
+  dtype = {1: np.uint8, 2: np.uint16, 4: np.uint32}[bypp]
+  return np.frombuffer(bits, dtype).reshape(img.height(), img.bytesPerLine() // bypp)
+
+
+class FrameBuffer():
+  """
+  Framebuffer shared by the decoder, running on the reactor thread,
+  and the GUI thread.
+
+  The decoder draws into a back buffer (img, painter and pixels) while the
+  GUI reads the last committed frame, and swap() publishes the back buffer.
+  With three buffers there is always one that is neither the latest frame
+  nor being read. A buffer becoming the back buffer again is brought up to
+  date by copying only the regions changed since it was last current.
+  """
+
+  # past this many stale regions, a buffer is refreshed as a whole
+  MAX_STALE = 64
+
+  def __init__(self, width=WIDTH, height=HEIGHT, fmt=IMG_FORMAT, count=3):
+    self.width, self.height = width, height
+    self.count = count
+    self._allocate(fmt)
+
+  def _allocate(self, fmt):
+    self.format = fmt
+    self.bypp = QImage(1, 1, fmt).depth() // 8
+    self.images = [QImage(self.width, self.height, fmt) for _ in range(self.count)]
+    for img in self.images:
+      img.fill(Qt.white)
+    self.painters = [QPainter(img) for img in self.images]
+    self.arrays = [framebufferArray(img) for img in self.images]
+    self._stale = [[] for _ in range(self.count)]
+    self._lock = threading.Lock()
+    self._front = None
+    self._reading = None
+    self._setBack(0)
+    self._published = self._shown = 0
+
+  def setFormat(self, fmt):
+    """Change the pixel format, only allowed before the first swap."""
+    assert self._front is None, "the framebuffer is already in use"
+    if fmt != self.format:
+      self._endPainters()
+      self._allocate(fmt)
+
+  def _endPainters(self):
+    # images must not be destroyed while being painted
+    for painter in self.painters:
+      painter.end()
+
+  def __del__(self):
+    self._endPainters()
+
+  def _setBack(self, i):
+    self._back = i
+    self.img = self.images[i]
+    self.painter = self.painters[i]
+    self.pixels = self.arrays[i]
+
+  def swap(self, rects):
+    """Publish the back buffer as the latest frame, and return it."""
+    full = [(0, 0, self.width, self.height)]
+    with self._lock:
+      front = self._front = self._back
+      self._published += 1
+      for i, stale in enumerate(self._stale):
+        if i != front:
+          stale.extend(rects)
+          if len(stale) > self.MAX_STALE:
+            stale[:] = full
+      back = next(i for i in range(len(self.images)) if i != front and i != self._reading)
+    # front is only read from now on, and back is ours alone
+    self._copyRegions(back, front, self._stale[back])
+    self._stale[back] = []
+    self._setBack(back)
+    return self.images[front]
+
+  def _copyRegions(self, dst, src, rects):
+    if self.arrays[src] is not None:
+      dst, src = self.arrays[dst], self.arrays[src]
+      for (x, y, w, h) in rects:
+        dst[y:y+h, x:x+w] = src[y:y+h, x:x+w]
+    else:
+      painter, src = self.painters[dst], self.images[src]
+      for (x, y, w, h) in rects:
+        painter.drawImage(x, y, src, x, y, w, h)
+
+  def front(self):
+    """The latest frame, or None before the first swap."""
+    with self._lock:
+      return None if self._front is None else self.images[self._front]
+
+  def lag(self):
+    """Number of frames published since the GUI last read one."""
+    return self._published - self._shown
+
+  @contextmanager
+  def reading(self):
+    """
+    Context in which the latest frame can be safely read from another
+    thread: the decoder will not draw into it until the context is left.
+    """
+    with self._lock:
+      self._reading = self._front
+      self._shown = self._published
+    try:
+      yield None if self._reading is None else self.images[self._reading]
+    finally:
+      with self._lock:
+        self._reading = None
+
+
+class FrameGovernor():
+  """
+  Paces the frames handed to the GUI and the update requests.
+
+  At most max_fps frames per second are emitted, updates committed in
+  between are merged into the next frame. The next update is requested
+  delay seconds after the previous one is received and, in adaptive mode,
+  only once the GUI has caught up with the frames already emitted.
+  """
+
+  def __init__(self, max_fps=60, adaptive=False, delay=None):
+    self.interval = 1 / max_fps if max_fps else 0
+    self.adaptive = adaptive
+    self.delay = delay or 0
+
+
+class UpdateScheduler():
+  """
+  Decides what the update requests ask for.
+
+  Only the region shown is requested, e.g. when zooming in, and nothing
+  while paused. Parts of the screen that were not requested may be out of
+  date, so a region not contained in the last one requested is asked for
+  as a whole; every refresh seconds the region shown is also asked for as
+  a whole, to heal any corruption. The region and pause state are set from
+  the GUI thread and read on the reactor thread.
+  """
+
+  def __init__(self, refresh=None):
+    self.refresh = refresh or 0
+    # (x, y, width, height) of the region shown, None for the whole screen
+    self.region = None
+    self.paused = False
+    self._requested = None
+
+  def request(self, width, height, full=False):
+    """Arguments of the next framebufferUpdateRequest, or None while paused."""
+    if self.paused:
+      return None
+    region = self.region or (0, 0, width, height)
+    last = self._requested or (0, 0, width, height)
+    x, y, w, h = region
+    contained = last[0] <= x and last[1] <= y and x + w <= last[0] + last[2] and y + h <= last[1] + last[3]
+    self._requested = region
+    return x, y, w, h, 0 if full or not contained else 1
+
+
 class ScreenStreamSignals(QObject):
   onFatalError = pyqtSignal(Exception)
-  onNewFrame = pyqtSignal(QImage)
+  onNewFrame = pyqtSignal(QImage, list)
   onChallengeReceived = pyqtSignal(bytes)
 
 
 class VncClient(RFBClient):
-  img = QImage(WIDTH, HEIGHT, IMG_FORMAT)
-  painter = QPainter(img)
 
-  def __init__(self, signals):
+  encodings = DEFAULT_ENCODINGS
+  # JPEG quality level (0-9) requested from Tight servers, None for lossless
+  jpegQuality = None
+
+  def __init__(self, signals, framebuffer=None, governor=None, scheduler=None):
     super(VncClient, self).__init__()
     self.signals = signals
+    self.framebuffer = framebuffer or FrameBuffer()
+    self.governor = governor or FrameGovernor(max_fps=None)
+    self.scheduler = scheduler or UpdateScheduler()
+    self._pending = []
+    self._lastEmit = 0
+    self._emitCall = None
+    self._requestCall = None
+    self._refreshCall = None
+    self._withheld = False
 
   def emitImage(self):
-    self.signals.onNewFrame.emit(self.img)
+    img = self.framebuffer.front()
+    if img is not None:
+      self.signals.onNewFrame.emit(img, [(0, 0, img.width(), img.height())])
 
   def vncConnectionMade(self):
     log.info("Connection to VNC server has been established")
+    if self.framebuffer.format == QImage.Format_Grayscale8:
+      self.setPixelFormat(**GRAY8_PIXEL_FORMAT)
 
     # self.signals = self.factory.signals
-    self.setEncodings([
-      HEXTILE_ENCODING,
-      CORRE_ENCODING,
-      PSEUDO_CURSOR_ENCODING,
-      RRE_ENCODING,
-      ZRLE_ENCODING,
-      RAW_ENCODING,
-      # REMARKABLE_ENCODING
-      ])
+    encodings = list(self.encodings)
+    if self.jpegQuality is not None:
+      # only Tight uses JPEG, which the server avoids unless asked
+      encodings.append(PSEUDO_JPEG_QUALITY_0_ENCODING + self.jpegQuality)
+    self.setEncodings(encodings)
     self.framebufferUpdateRequest()
+    if self.scheduler.refresh:
+      self._refreshCall = reactor.callLater(self.scheduler.refresh, self.refreshRegion)
 
   def sendPassword(self, password):
     self.signals.onFatalError.emit(Exception("Unsupported password request."))
 
+  def vncAuthFailed(self, reason):
+    log.error("Authentication failed: %s", reason)
+    self.factory.authFailed = True
+
   def commitUpdate(self, rectangles=None):
-    self.signals.onNewFrame.emit(self.img)
-    self.framebufferUpdateRequest(incremental=1)
+    if rectangles is None:
+      # the whole screen may have changed
+      rectangles = [(0, 0, self.width, self.height)]
+    self._pending.extend(rectangles)
+    if self._emitCall is None:
+      wait = self._lastEmit + self.governor.interval - time.monotonic()
+      if wait > 0:
+        self._emitCall = reactor.callLater(wait, self.emitFrame)
+      else:
+        self.emitFrame()
+    if self._requestCall is None:
+      self.requestUpdate(self.governor.delay)
+
+  def emitFrame(self):
+    if self._decodePool is not None:
+      # the workers draw into the back buffer that swap() publishes:
+      # let them finish, committing their update right away
+      self._decodePool.flush()
+    self._emitCall = None
+    if not self._pending:
+      return
+    rects, self._pending = self._pending, []
+    img = self.framebuffer.swap(rects)
+    self._lastEmit = time.monotonic()
+    if self.stats is not None and self.stats.enabled:
+      self.stats.timeSince('emit', 'update')
+      self.stats.mark('emit')
+    self.signals.onNewFrame.emit(img, rects)
+
+  def requestUpdate(self, delay=0):
+    self._requestCall = None
+    if not delay and self.governor.adaptive and self.framebuffer.lag() > 1:
+      # the GUI is behind, check again in a frame
+      delay = self.governor.interval or 1 / 60
+    if delay:
+      self._requestCall = reactor.callLater(delay, self.requestUpdate)
+      return
+    request = self.scheduler.request(self.width, self.height)
+    if request is None:
+      # paused: with no update on the way the server only sends keepalives,
+      # stop reading until resumeUpdates() asks again
+      self._withheld = True
+      self.transport.pauseProducing()
+    else:
+      self.framebufferUpdateRequest(*request)
+
+  def resumeUpdates(self):
+    if self._withheld:
+      self._withheld = False
+      self.transport.resumeProducing()
+      # a single full refresh, whatever changed while paused
+      request = self.scheduler.request(self.width, self.height, full=True)
+      if request is not None:
+        self.framebufferUpdateRequest(*request)
+
+  def refreshRegion(self):
+    self._refreshCall = reactor.callLater(self.scheduler.refresh, self.refreshRegion)
+    request = self.scheduler.request(self.width, self.height, full=True)
+    if request is not None:
+      self.framebufferUpdateRequest(*request)
+
+  def connectionLost(self, reason):
+    super(VncClient, self).connectionLost(reason)
+    for call in (self._emitCall, self._requestCall, self._refreshCall):
+      if call is not None and call.active():
+        call.cancel()
 
   def updateRectangle(self, x, y, width, height, data):
-    self.painter.drawImage(x,y,QImage(data, width, height, width * BYTES_PER_PIXEL, IMG_FORMAT))
+    fb = self.framebuffer
+    if self.useNumpy and fb.pixels is not None:
+      # unlike the painter, safe to use from the workers of a decode pool
+      fb.pixels[y:y+height, x:x+width] = np.frombuffer(data, fb.pixels.dtype).reshape(height, width)
+    else:
+      fb.painter.drawImage(x,y,QImage(data, width, height, width * fb.bypp, fb.format))
+
+  def fillRectangle(self, x, y, width, height, color):
+    fb = self.framebuffer
+    if self.useNumpy and fb.pixels is not None:
+      fb.pixels[y:y+height, x:x+width] = np.frombuffer(color, fb.pixels.dtype)[0]
+    else:
+      fb.painter.fillRect(x, y, width, height, self._qcolor(color))
+
+  def copyRectangle(self, srcx, srcy, x, y, width, height):
+    fb = self.framebuffer
+    if self.useNumpy and fb.pixels is not None:
+      # NumPy takes care of overlapping source and destination
+      pixels = fb.pixels
+      pixels[y:y+height, x:x+width] = pixels[srcy:srcy+height, srcx:srcx+width]
+    else:
+      fb.painter.drawImage(x, y, fb.img.copy(srcx, srcy, width, height))
+
+  def fillRectangles(self, fills):
+    fb = self.framebuffer
+    if self.useNumpy and fb.pixels is not None:
+      pixels = fb.pixels
+      colors = np.frombuffer(fills.colors, pixels.dtype).tolist()
+      rects = fills.rects.tolist()
+      for x, y, w, h, color in zip(rects[0::4], rects[1::4], rects[2::4], rects[3::4], colors):
+        pixels[y:y+h, x:x+w] = color
+    else:
+      painter = fb.painter
+      qcolors = {}
+      for (x, y, w, h, color) in fills:
+        qcolor = qcolors.get(color)
+        if qcolor is None:
+          qcolor = qcolors[color] = self._qcolor(color)
+        painter.fillRect(x, y, w, h, qcolor)
+
+  def updateRectangleJpeg(self, x, y, width, height, data):
+    fb = self.framebuffer
+    img = QImage.fromData(bytes(data), 'JPEG')
+    fb.painter.drawImage(x, y, img.convertToFormat(fb.format))
+
+  def _qcolor(self, color):
+    fb = self.framebuffer
+    return QImage(color, 1, 1, fb.bypp, fb.format).pixelColor(0, 0)
 
   def getRMChallenge(self):
     return self.factory.challenge
@@ -66,26 +425,68 @@ class VncFactory(RFBFactory):
   protocol = VncClient
   instance = None
   challenge = None #bytes(32)
+  authFailed = False
 
-  def __init__(self, signals):
+  def __init__(self, signals, framebuffer=None, governor=None, scheduler=None, capture=None, stats=None,
+               encodings=None, jpeg_quality=None, decode_threads=0):
     super(VncFactory, self).__init__()
     self.signals = signals
+    self.framebuffer = framebuffer or FrameBuffer()
+    self.governor = governor
+    self.scheduler = scheduler
+    self.capture = capture
+    self.captureWriter = None
+    self.stats = stats
+    self.encodings = encodings
+    self.jpegQuality = jpeg_quality
+    self.decodeThreads = decode_threads
 
   def buildProtocol(self, addr):
-    self.instance = VncClient(self.signals)
+    self.instance = self.protocol(self.signals, self.framebuffer, self.governor, self.scheduler)
+    if self.capture:
+      # the same file records the connections made on retries
+      if self.captureWriter is None:
+        self.captureWriter = CaptureWriter(self.capture)
+      self.captureWriter.connect()
+      self.instance.capture = self.captureWriter
+    self.instance.stats = self.stats
+    if self.encodings is not None:
+      self.instance.encodings = self.encodings
+    self.instance.jpegQuality = self.jpegQuality
+    self.instance.decodeThreads = self.decodeThreads
     self.instance.factory = self
     return self.instance
 
   def clientConnectionLost(self, connector, reason):
     log.warning("Disconnected: %s", reason.getErrorMessage())
-    reactor.callFromThread(reactor.stop)
+    if self.authFailed:
+      self.authenticationFailed()
+      return
+    fb = self.framebuffer
+    if fb.format != IMG_FORMAT and fb.front() is None:
+      # the server may not support the pixel format we asked for
+      log.warning("Retrying with the default pixel format of the server")
+      fb.setFormat(IMG_FORMAT)
+      connector.connect()
+      return
+    stopReactor()
+
+  def stopFactory(self):
+    if self.captureWriter is not None:
+      self.captureWriter.close()
+      self.captureWriter = None
 
   def clientConnectionFailed(self, connector, reason):
     if reason.check(ConnectionRefusedError):
       self.signals.onFatalError.emit(Exception("It seems the tablet is refusing to connect.\nIf you are using the ScreenShare backend please make sure you enabled it on the tablet, before running rmview."))
     else:
       self.signals.onFatalError.emit(Exception("Connection failed: " + str(reason)))
-    reactor.callFromThread(reactor.stop)
+    stopReactor()
+
+  def authenticationFailed(self):
+    """called once disconnected, after the server refused to authenticate us"""
+    self.signals.onFatalError.emit(Exception("The tablet refused the authentication."))
+    stopReactor()
 
   def setChallenge(self, challenge):
     self.challenge = challenge
@@ -0,0 +1,75 @@
+"""
+Drive the Twisted reactor from the Qt event loop.
+
+By default each streamer runs the reactor in a thread of the pool: frames
+reach the GUI through queued signals and pointer and key events go the
+other way through reactor.callFromThread. Once install() is called the
+reactor runs in the GUI thread instead, so that the protocol, the frame
+signals and the input events share one loop. Decoding stays on the GUI
+thread too, unless a decode pool is used (`decode_threads`).
+
+qt5reactor is used if available, otherwise the threaded select reactor of
+Twisted, which only waits for the sockets in a thread of its own.
+"""
+import logging
+
+from PyQt5.QtCore import *
+
+log = logging.getLogger('rmview')
+
+_installed = False
+
+
+class _Waker(QObject):
+  """Calls in the GUI thread the functions emitted from other threads."""
+
+  wake = pyqtSignal(object)
+
+  def __init__(self):
+    super(_Waker, self).__init__()
+    self.wake.connect(self.call)
+
+  @pyqtSlot(object)
+  def call(self, f):
+    f()
+
+
+def install():
+  """
+  Install and start the reactor in the Qt event loop. To be called from
+  the GUI thread, once the application exists and before anything imports
+  twisted.internet.reactor.
+  """
+  global _installed, _waker
+  try:
+    import qt5reactor
+  except ImportError:
+    from twisted.internet import _threadedselect
+    _threadedselect.install()
+    from twisted.internet import reactor
+    _waker = _Waker()
+    reactor.interleave(_waker.wake.emit, installSignalHandlers=False)
+    log.info("Running the reactor in the Qt event loop (threaded select)")
+  else:
+    qt5reactor.install()
+    from twisted.internet import reactor
+    reactor.runReturn(installSignalHandlers=False)
+    log.info("Running the reactor in the Qt event loop (qt5reactor)")
+  _installed = True
+
+
+def installed():
+  """Whether the reactor runs in the Qt event loop."""
+  return _installed
+
+
+def stop(timeout=2000):
+  """Stop the reactor, running the Qt event loop until it has shut down."""
+  from twisted.internet import reactor
+  if not reactor.running:
+    return
+  loop = QEventLoop()
+  reactor.addSystemEventTrigger('after', 'shutdown', loop.quit)
+  QTimer.singleShot(timeout, loop.quit)
+  reactor.stop()
+  loop.exec_()
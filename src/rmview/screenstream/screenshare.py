@@ -4,7 +4,6 @@ from PyQt5.QtCore import *
 
 from rmview.rmparams import *
 
-import paramiko
 import struct
 import time
 
@@ -12,42 +11,78 @@ import sys
 import os
 import logging
 import configparser
-import jwt
 import io
 import socket
 import hashlib
 from twisted.internet.protocol import Protocol,DatagramProtocol
-from twisted.internet import protocol, reactor, ssl
+from twisted.internet import protocol, reactor, ssl, threads
 from twisted.application import internet, service
 
 
 from .common import *
+from ..connection import cachedProfile, updateProfile
 
 log = logging.getLogger('rmview')
 
 # the screenshare vnc auth uses udp broadcasts
 class ChallengeReaderProtocol(DatagramProtocol):
-  clients = {}
+  """
+  Reads the timestamps broadcast by the tablets sharing their screen and
+  hands each to the stream of the tablet it comes from. The port can only
+  be bound once, so the streams of all the tablets share one reader,
+  used from the reactor thread with listen() and forget().
+  """
 
-  def __init__(self, callback):
-    self.callback = callback
+  port = 5901
+  instance = None
+
+  def __init__(self):
+    # callback(timestamp) of each stream, by address of its tablet
+    self.callbacks = {}
+    # timestamps already received, by address
+    self.clients = {}
+    self.listener = None
+
+  @classmethod
+  def listen(cls, address, callback):
+    """Hand the timestamps from address to callback until it returns False."""
+    if cls.instance is None:
+      cls.instance = cls()
+      cls.instance.listener = reactor.listenUDP(cls.port, cls.instance)
+    cls.instance.callbacks[address] = callback
+
+  @classmethod
+  def forget(cls, address):
+    reader = cls.instance
+    if reader is not None and reader.callbacks.pop(address, None) and not reader.callbacks:
+      log.debug("Stopping listening for timestamps")
+      reader.listener.stopListening()
+      cls.instance = None
 
   def datagramReceived(self, datagram, host):
+    address = host[0]
+    if address not in self.callbacks:
+      if len(self.callbacks) != 1:
+        log.debug(f"ignoring challenge from {address}")
+        return
+      # a single tablet may broadcast from any of its addresses
+      address, = self.callbacks
+    clients = self.clients.setdefault(address, {})
+
     reader = io.BytesIO(datagram)
 
     # the timestamp is needed for the challenge
     timestamp = reader.read(8)
     tounx, = unpack("!Q", timestamp)
-    if timestamp in self.clients:
+    if timestamp in clients:
       log.debug(f"skipping challenge {tounx}")
       return
-    log.info(f"received timestamp challenge {tounx}")
+    log.info(f"received timestamp challenge {tounx} from {host[0]}")
 
-    if not self.callback(timestamp):
-      log.debug("Stopping listening for timestamps")
-      self.transport.stopListening()
+    if not self.callbacks[address](timestamp):
+      self.forget(address)
 
-    self.clients[timestamp] = addresses = []
+    clients[timestamp] = addresses = []
 
     ### The rest of the message is ignored for now
     # (hashlength,) = unpack("!I", reader.read(4))
@@ -66,14 +101,35 @@ class ChallengeReaderProtocol(DatagramProtocol):
 
 
 
+class ScreenShareFactory(VncFactory):
+  """Has the stream try again when the tablet refuses a challenge."""
+
+  def __init__(self, stream, *args, **kwargs):
+    super(ScreenShareFactory, self).__init__(*args, **kwargs)
+    self.stream = stream
+
+  def authenticationFailed(self):
+    if not self.stream.retryAuthentication():
+      super(ScreenShareFactory, self).authenticationFailed()
+
+
 class ScreenShareStream(QRunnable):
 
   factory = None
-
-  def __init__(self, ssh):
+  port = 5900
+  # of the tablet, as the source of its challenges
+  address = None
+  # whether the user id hash was taken from the profile of the tablet
+  cachedUserIdHash = False
+
+  def __init__(self, ssh, pixel_format='rgb16', **options):
+    """options are passed on to VncFactory"""
     super(ScreenShareStream, self).__init__()
     self.ssh = ssh
+    self.options = options
+    self.scheduler = options.setdefault('scheduler', UpdateScheduler())
     self.signals = ScreenStreamSignals()
+    self.framebuffer = FrameBuffer(fmt=PIXEL_FORMATS[pixel_format])
 
   def needsDependencies(self):
     return False
@@ -83,12 +139,14 @@ class ScreenShareStream(QRunnable):
 
   def stop(self):
     log.debug("Stopping ScreenShare streamer thread...")
+    if self.address is not None:
+      callInReactor(ChallengeReaderProtocol.forget, self.address)
     try:
       log.info("Disconnecting from VNC server...")
-      reactor.callFromThread(self.vncClient.stopService)
+      callInReactor(self.vncClient.stopService)
     except Exception as e:
       log.debug("Disconnect failed (%s), stopping reactor" % str(e))
-      reactor.callFromThread(reactor.stop)
+      stopReactor()
 
     log.debug("ScreenShare streamer thread stopped.")
 
@@ -96,6 +154,7 @@ class ScreenShareStream(QRunnable):
   reads the usedId from deviceToken from the config file on the rm
   """
   def get_userid(self):
+    import jwt
     with self.ssh.open_sftp() as sftp:
       with sftp.file('/etc/remarkable.conf') as f:
         file_content = f.read().decode()
@@ -108,27 +167,53 @@ class ScreenShareStream(QRunnable):
 
     return(d["auth0-userid"])
 
-  def computeChallenge(self, userId, timestamp):
-    userBytes = userId.encode()
-    userIdHash = hashlib.sha256(userBytes).digest()
+  def getUserIdHash(self, refresh=False):
+    """
+    The hash of the user id, from the profile of the tablet if seen before,
+    unless refresh is set. Blocks on SFTP and on writing the profiles.
+    """
+    cached = cachedProfile(self.ssh).get('userIdHash')
+    if cached and not refresh:
+      self.cachedUserIdHash = True
+      return bytes.fromhex(cached)
+    self.cachedUserIdHash = False
+    if cached:
+      updateProfile(self.ssh, userIdHash=None)
+    userIdHash = hashlib.sha256(self.get_userid().encode()).digest()
+    updateProfile(self.ssh, userIdHash=userIdHash.hex())
+    return userIdHash
+
+  def computeChallenge(self, userIdHash, timestamp):
     return hashlib.sha256(timestamp + userIdHash).digest()
 
   #Hack to run the vnc with the challenge
-  def runVnc(self, timestamp):
+  def runVnc(self, timestamp, refresh=False):
     if not self.factory:
-      userId = self.get_userid()
-      challenge = self.computeChallenge(userId, timestamp)
-      log.info(f"Challenge: {challenge.hex()}, connecting to vnc")
-      self.startVncClient(challenge)
+      # not in the reactor thread, which may be the GUI thread
+      d = threads.deferToThread(self.getUserIdHash, refresh)
+      d.addCallback(lambda userIdHash: self.startVncClient(self.computeChallenge(userIdHash, timestamp)))
+      d.addErrback(lambda failure: self.signals.onFatalError.emit(failure.value))
     return False
 
+  def retryAuthentication(self):
+    """After the tablet refused a challenge, start again if the user id hash was cached, as it may be outdated."""
+    if not self.cachedUserIdHash:
+      return False
+    log.warning("The tablet refused the challenge, reading the user id again")
+    self.vncClient.stopService()
+    self.factory = None
+    ChallengeReaderProtocol.listen(self.address, lambda timestamp: self.runVnc(timestamp, refresh=True))
+    return True
+
   def startVncClient(self, challenge=None):
-    self.factory = VncFactory(self.signals)
+    if challenge is not None:
+      log.info(f"Challenge: {challenge.hex()}, connecting to vnc")
+    self.factory = ScreenShareFactory(self, self.signals, self.framebuffer, **self.options)
     self.factory.setChallenge(challenge)
 
     # left for testing with stunnel
     #self.vncClient = internet.TCPClient("localhost", 31337, self.factory)
-    self.vncClient = internet.SSLClient(self.ssh.hostname, 5900, self.factory, ssl.ClientContextFactory())
+    self.vncClient = internet.SSLClient(self.ssh.hostname, self.port, self.factory, ssl.ClientContextFactory())
     self.vncClient.startService()
 
   def run(self):
@@ -136,28 +221,38 @@ class ScreenShareStream(QRunnable):
       try:
         if self.ssh.softwareVersion > (2, 9, 1, 236):
           log.warning("Authenticating, please wait...")
-          challengeReader = ChallengeReaderProtocol(self.runVnc)
-          reactor.listenUDP(5901, challengeReader)
+          try:
+            self.address = socket.gethostbyname(self.ssh.hostname)
+          except OSError:
+            self.address = self.ssh.hostname
+          callInReactor(ChallengeReaderProtocol.listen, self.address, self.runVnc)
         else:
           log.warning("Skipping authentication")
-          self.startVncClient()
-        reactor.run(installSignalHandlers=0)
+          callInReactor(self.startVncClient)
+        runReactor()
 
       except Exception as e:
         log.error(e)
 
   @pyqtSlot()
   def pause(self):
+    self.scheduler.paused = True
     self.signals.blockSignals(True)
 
   @pyqtSlot()
   def resume(self):
+    self.scheduler.paused = False
     self.signals.blockSignals(False)
     try:
       self.factory.instance.emitImage()
+      callInReactor(self.factory.instance.resumeUpdates)
     except Exception:
       log.warning("Not ready to resume")
 
+  def setVisibleRect(self, rect):
+    # the full screen is not a region, so that a change of size is followed
+    self.scheduler.region = None if rect.isNull() else (rect.x(), rect.y(), rect.width(), rect.height())
+
   def pointerEvent(self, x, y, button):
     pass
 
@@ -1,5 +1,7 @@
 import logging
 import atexit
+import os
+import time
 
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
@@ -13,6 +15,13 @@ from .common import *
 
 log = logging.getLogger('rmview')
 
+# the VNC servers for the tablets, installed with the package
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+
+
+def serverBinary(deviceVersion):
+  return os.path.join(BIN_DIR, 'rM%d-vnc-server-standalone' % deviceVersion)
+
 
 class VncStreamer(QRunnable):
 
@@ -22,30 +31,38 @@ class VncStreamer(QRunnable):
   factory = None
   vncClient = None
   sshTunnel = None
+  port = 5900
 
-  def __init__(self, ssh, ssh_config, delay=None):
+  def __init__(self, ssh, ssh_config, pixel_format='rgb16', **options):
+    """options are passed on to VncFactory"""
     super(VncStreamer, self).__init__()
     self.ssh = ssh
     self.ssh_config = ssh_config
+    self.options = options
+    self.scheduler = options.setdefault('scheduler', UpdateScheduler())
     self.use_ssh_tunnel = self.ssh_config.get("tunnel", False)
 
     self._vnc_server_already_running = False
 
     self.signals = ScreenStreamSignals()
+    self.framebuffer = FrameBuffer(fmt=PIXEL_FORMATS[pixel_format])
 
   def needsDependencies(self):
+    probe = getattr(self.ssh, 'probe', None)
+    if probe is not None:
+      # as found when connecting
+      return probe.get('vnc_installed') != '1'
     _, out, _ = self.ssh.exec_command("[ -x $HOME/rM-vnc-server-standalone ]")
-    log.info("%s %s", QFile, QIODevice)
     return out.channel.recv_exit_status() != 0
 
   def installDependencies(self):
     sftp = self.ssh.open_sftp()
     from stat import S_IXUSR
-    fo = QFile(':bin/rM%d-vnc-server-standalone' % self.ssh.deviceVersion)
-    fo.open(QIODevice.ReadOnly)
-    sftp.putfo(fo, 'rM-vnc-server-standalone')
-    fo.close()
+    with open(serverBinary(self.ssh.deviceVersion), 'rb') as fo:
+      sftp.putfo(fo, 'rM-vnc-server-standalone')
     sftp.chmod('rM-vnc-server-standalone', S_IXUSR)
+    if getattr(self.ssh, 'probe', None) is not None:
+      self.ssh.probe['vnc_installed'] = '1'
 
   def stop(self):
     if self._stop:
@@ -59,10 +76,10 @@ class VncStreamer(QRunnable):
     if self.vncClient:
       try:
         log.info("Disconnecting from VNC server...")
-        reactor.callFromThread(self.vncClient.stopService)
+        callInReactor(self.vncClient.stopService)
       except Exception as e:
         log.debug("Disconnect failed (%s), stopping reactor" % str(e))
-        reactor.callFromThread(reactor.stop)
+        stopReactor()
 
     # If we used an existing running instance and didn't start one ourselves we will not kill it.
     if not self._vnc_server_already_running:
@@ -86,20 +103,22 @@ class VncStreamer(QRunnable):
 
   @pyqtSlot()
   def run(self):
+    start = time.perf_counter()
     try:
       self._start_vnc_server()
       vnc_server_host, vnc_server_port = self._setup_ssh_tunnel_if_configured()
     except Exception as e:
       self.signals.onFatalError.emit(e)
       return
+    log.info("VNC server ready in %.0f ms", 1000 * (time.perf_counter() - start))
 
     log.info("Establishing connection to remote VNC server on %s:%s" % (vnc_server_host,
                                                                         vnc_server_port))
     try:
-      self.factory = VncFactory(self.signals)
+      self.factory = VncFactory(self.signals, self.framebuffer, **self.options)
       self.vncClient = internet.TCPClient(vnc_server_host, vnc_server_port, self.factory)
-      self.vncClient.startService()
-      reactor.run(installSignalHandlers=0)
+      callInReactor(self.vncClient.startService)
+      runReactor()
     except Exception as e:
       log.error("Failed to connect to the VNC server: %s" % (str(e)))
 
@@ -109,9 +128,13 @@ class VncStreamer(QRunnable):
 
     If it is, True is returned by this method and a log message if emitted.
     """
-    _, stdout, stderr = self.ssh.exec_command("ps -ww | grep rM-vnc-server-standalone | grep -v grep")
-
-    stdout_bytes = stdout.read()
+    probe = getattr(self.ssh, 'probe', None)
+    if probe is not None:
+      # the command line of the instance found when connecting
+      stdout_bytes = probe.get('vnc_running', '').encode()
+    else:
+      _, stdout, stderr = self.ssh.exec_command("ps -ww | grep rM-vnc-server-standalone | grep -v grep")
+      stdout_bytes = stdout.read()
 
     if b"rM-vnc-server-standalone" in stdout_bytes:
       # TODO: Add config option to force kill and start a fresh server in this case
@@ -175,7 +198,7 @@ class VncStreamer(QRunnable):
       tunnel.start()
       self.sshTunnel = tunnel
 
-      log.info("Setting up SSH tunnel %s:%s (rm) <-> %s:%s (localhost)" % ("127.0.0.1", 5900,
+      log.info("Setting up SSH tunnel %s:%s (rm) <-> %s:%s (localhost)" % ("127.0.0.1", self.port,
                                                                            tunnel.local_bind_host,
                                                                            tunnel.local_bind_port))
 
@@ -183,7 +206,7 @@ class VncStreamer(QRunnable):
       vnc_server_port = tunnel.local_bind_port
     else:
       vnc_server_host = self.ssh.hostname
-      vnc_server_port = 5900
+      vnc_server_port = self.port
 
 
     return (vnc_server_host, vnc_server_port)
@@ -207,7 +230,7 @@ class VncStreamer(QRunnable):
         raise Exception("You need to install `sshtunnel` to use the tunnel feature")
       tunnel = sshtunnel.open_tunnel(
         (self.ssh.hostname, 22),
-        remote_bind_address=("127.0.0.1", 5900),
+        remote_bind_address=("127.0.0.1", self.port),
         # We don't specify port so library auto assigns random unused one in the high range
         local_bind_address=('127.0.0.1',),
         compression=self.ssh_config.get("tunnel_compression", False),
@@ -218,28 +241,35 @@ class VncStreamer(QRunnable):
   @pyqtSlot()
   def pause(self):
     self.ignoreEvents = True
+    self.scheduler.paused = True
     self.signals.blockSignals(True)
 
   @pyqtSlot()
   def resume(self):
     self.ignoreEvents = False
+    self.scheduler.paused = False
     self.signals.blockSignals(False)
     try:
       self.factory.instance.emitImage()
+      callInReactor(self.factory.instance.resumeUpdates)
     except Exception:
       log.warning("Not ready to resume")
 
+  def setVisibleRect(self, rect):
+    # the full screen is not a region, so that a change of size is followed
+    self.scheduler.region = None if rect.isNull() else (rect.x(), rect.y(), rect.width(), rect.height())
+
   # @pyqtSlot(int,int,int)
   def pointerEvent(self, x, y, button):
     if self.ignoreEvents: return
     try:
-      reactor.callFromThread(self.factory.instance.pointerEvent, x, y, button)
+      callInReactor(self.factory.instance.pointerEvent, x, y, button)
     except Exception as e:
       log.warning("Not ready to send pointer events! [%s]", e)
 
   def keyEvent(self, key):
     if self.ignoreEvents: return
-    reactor.callFromThread(self.emulatePressRelease, key)
+    callInReactor(self.emulatePressRelease, key)
 
   def emulatePressRelease(self, key):
     self.factory.instance.keyEvent(key)
@@ -0,0 +1,82 @@
+"""
+Counters and timers of the streaming pipeline.
+
+The components of the pipeline are handed a Stats object and only record
+anything while it is enabled, so that it costs next to nothing otherwise.
+"""
+import json
+from collections import defaultdict
+from time import perf_counter_ns
+
+
+class Stats():
+  """
+  Counters accumulate a quantity (e.g. bytes received), timers the number
+  and total duration in nanoseconds of an activity (e.g. decoding a ZRLE
+  rectangle), marks remember when something last happened (e.g. a frame
+  was emitted) so that the latency to a later event can be timed.
+  """
+
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.counters = defaultdict(int)
+    self.timers = defaultdict(lambda: [0, 0])
+    self.marks = {}
+
+  def count(self, name, n=1):
+    self.counters[name] += n
+
+  def time(self, name, ns):
+    timer = self.timers[name]
+    timer[0] += ns
+    timer[1] += 1
+
+  def mark(self, name):
+    self.marks[name] = perf_counter_ns()
+
+  def timeSince(self, name, mark):
+    """Time the interval from the given mark to now."""
+    start = self.marks.get(mark)
+    if start is not None:
+      self.time(name, perf_counter_ns() - start)
+
+  def snapshot(self):
+    return {
+      'time': perf_counter_ns(),
+      'counters': dict(self.counters),
+      'timers': {name: tuple(t) for name, t in list(self.timers.items())},
+    }
+
+  def json(self):
+    return json.dumps(self.snapshot(), sort_keys=True)
+
+  def prometheus(self):
+    lines = []
+    for name, value in sorted(self.counters.items()):
+      lines.append("# TYPE rmview_%s_total counter" % name)
+      lines.append("rmview_%s_total %d" % (name, value))
+    for name, (total, count) in sorted(self.timers.items()):
+      lines.append("# TYPE rmview_%s_seconds summary" % name)
+      lines.append("rmview_%s_seconds_sum %.9f" % (name, total / 1e9))
+      lines.append("rmview_%s_seconds_count %d" % (name, count))
+    return "\n".join(lines) + "\n"
+
+  def summary(self, previous=None):
+    """
+    Human readable rates and mean times since the previous snapshot,
+    returned together with the current snapshot.
+    """
+    now = self.snapshot()
+    previous = previous or {'time': 0, 'counters': {}, 'timers': {}}
+    elapsed = (now['time'] - previous['time']) / 1e9
+    counted = {name: n - previous['counters'].get(name, 0) for name, n in now['counters'].items()}
+    updates = counted.get('updates', 0)
+    lines = ["in %.2f MB/s  %.1f updates/s  %.1f rects/update  %.1f fps" % (
+      counted.get('bytes_in', 0) / elapsed / 1e6, updates / elapsed,
+      counted.get('rects', 0) / updates if updates else 0,
+      counted.get('frames', 0) / elapsed)]
+    for name, (total, count) in sorted(now['timers'].items()):
+      old_total, old_count = previous['timers'].get(name, (0, 0))
+      if count > old_count:
+        lines.append("%-14s %7.2f ms" % (name, (total - old_total) / (count - old_count) / 1e6))
+    return "\n".join(lines), now
@@ -1,16 +1,315 @@
+import logging
+
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
+log = logging.getLogger('rmview')
+
+# OpenGL constants used by GLFrameItem
+GL_TEXTURE_2D = 0x0DE1
+GL_TEXTURE0 = 0x84C0
+GL_TEXTURE_MAG_FILTER = 0x2800
+GL_TEXTURE_MIN_FILTER = 0x2801
+GL_TEXTURE_WRAP_S = 0x2802
+GL_TEXTURE_WRAP_T = 0x2803
+GL_LINEAR = 0x2601
+GL_CLAMP_TO_EDGE = 0x812F
+GL_UNPACK_ALIGNMENT = 0x0CF5
+GL_RGB = 0x1907
+GL_RGBA = 0x1908
+GL_LUMINANCE = 0x1909
+GL_UNSIGNED_BYTE = 0x1401
+GL_UNSIGNED_SHORT_5_6_5 = 0x8363
+GL_TRIANGLE_STRIP = 0x0005
+
 def _invertColor(c):
   (r, g, b, a) = c.getRgb()
   return QColor(255-r, 255-g, 255-b, a)
 
+def _invertArea(painter, rect):
+  """Invert the colors of what is painted in rect."""
+  mode = painter.compositionMode()
+  painter.setCompositionMode(QPainter.CompositionMode_Difference)
+  painter.fillRect(rect, Qt.white)
+  painter.setCompositionMode(mode)
+
+
+class FrameItem(QGraphicsItem):
+  """
+  Scene item showing a frame.
+  The frame is kept in a persistent pixmap, so that an update only needs to
+  upload and repaint the regions that changed.
+  Colors are inverted while painting, the pixmap always holds the frame as is.
+  """
+
+  def __init__(self, image):
+    super(FrameItem, self).__init__()
+    self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+    self._pixmap = QPixmap.fromImage(image)
+    self._inverted = False
+
+  def boundingRect(self):
+    return QRectF(self._pixmap.rect())
+
+  def setInverted(self, inverted):
+    self._inverted = inverted
+    self.update()
+
+  def pixmap(self):
+    """The frame as shown."""
+    if not self._inverted:
+      return self._pixmap
+    pixmap = QPixmap(self._pixmap)
+    painter = QPainter(pixmap)
+    _invertArea(painter, pixmap.rect())
+    painter.end()
+    return pixmap
+
+  def setImage(self, image, rects=None):
+    if rects is None or image.size() != self._pixmap.size():
+      self.prepareGeometryChange()
+      self._pixmap = QPixmap.fromImage(image)
+      self.update()
+      return
+    painter = QPainter(self._pixmap)
+    for (x, y, w, h) in rects:
+      painter.drawImage(x, y, image, x, y, w, h)
+      self.update(x, y, w, h)
+    painter.end()
+
+  def paint(self, painter, option, widget=None):
+    painter.setRenderHint(QPainter.SmoothPixmapTransform)
+    # pad the exposed area so smooth scaling has its neighbouring pixels
+    r = option.exposedRect.toAlignedRect().adjusted(-1, -1, 1, 1) & self._pixmap.rect()
+    painter.drawPixmap(r, self._pixmap, r)
+    if self._inverted:
+      _invertArea(painter, r)
+
+
+class TiledFrameItem(QGraphicsItem):
+  """
+  Scene item showing a frame as tiles of TILE x TILE pixels.
+
+  An update only repaints the tiles it damages, and painting only draws
+  the tiles exposed, e.g. those in view when zoomed in. Each tile has a
+  border of one pixel from its neighbours, so that smooth scaling
+  interpolates across tiles without seams.
+  """
+
+  TILE = 128
+
+  def __init__(self, image):
+    super(TiledFrameItem, self).__init__()
+    self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+    self._inverted = False
+    self._load(image)
+
+  def _load(self, image):
+    self._rect = image.rect()
+    t = self.TILE
+    self._tiles = {}
+    for row in range((image.height() + t - 1) // t):
+      for col in range((image.width() + t - 1) // t):
+        area = QRect(col * t, row * t, t, t) & self._rect
+        padded = area.adjusted(-1, -1, 1, 1) & self._rect
+        source = QRectF(area.translated(-padded.topLeft()))
+        self._tiles[col, row] = (QRectF(area), padded, QPixmap.fromImage(image.copy(padded)), source)
+
+  def _tilesIn(self, rect, border=0):
+    """The tiles intersecting rect, including their border if given."""
+    t = self.TILE
+    left, top = max(rect.left() - border, 0) // t, max(rect.top() - border, 0) // t
+    right, bottom = (rect.right() + border) // t, (rect.bottom() + border) // t
+    for row in range(top, bottom + 1):
+      for col in range(left, right + 1):
+        tile = self._tiles.get((col, row))
+        if tile is not None:
+          yield tile
+
+  def boundingRect(self):
+    return QRectF(self._rect)
+
+  def setInverted(self, inverted):
+    self._inverted = inverted
+    self.update()
+
+  def pixmap(self):
+    pixmap = QPixmap(self._rect.size())
+    painter = QPainter(pixmap)
+    for area, _, tile, source in self._tiles.values():
+      painter.drawPixmap(area, tile, source)
+    if self._inverted:
+      _invertArea(painter, pixmap.rect())
+    painter.end()
+    return pixmap
+
+  def setImage(self, image, rects=None):
+    if image.rect() != self._rect:
+      self.prepareGeometryChange()
+      self._load(image)
+      self.update()
+      return
+    for (x, y, w, h) in rects or [self._rect.getRect()]:
+      damage = QRect(x, y, w, h)
+      for _, padded, tile, _ in self._tilesIn(damage, border=1):
+        r = damage & padded
+        painter = QPainter(tile)
+        painter.drawImage(r.topLeft() - padded.topLeft(), image, r)
+        painter.end()
+      self.update(x, y, w, h)
+
+  def paint(self, painter, option, widget=None):
+    painter.setRenderHint(QPainter.SmoothPixmapTransform)
+    for area, _, tile, source in self._tilesIn(option.exposedRect.toAlignedRect()):
+      painter.drawPixmap(area, tile, source)
+      if self._inverted:
+        _invertArea(painter, area)
+
+
+class GLFrameItem(FrameItem):
+  """
+  FrameItem drawn with OpenGL, in a view with a QOpenGLWidget viewport.
+
+  The frame is kept in a texture, into which only the regions changed are
+  uploaded, and drawn by a shader which applies the view transform, so
+  that scaling and rotating happen on the GPU, and inverts the colors.
+  The pixmap is still kept up to date, for screenshots and for painting
+  on other devices.
+  """
+
+  VERTEX_SHADER = """
+    attribute highp vec2 position;
+    uniform highp mat3 transform;
+    uniform highp vec2 viewport;
+    uniform highp vec2 size;
+    varying highp vec2 texCoord;
+    void main() {
+      highp vec3 p = transform * vec3(position, 1.0);
+      gl_Position = vec4(2.0 * p.x / p.z / viewport.x - 1.0, 1.0 - 2.0 * p.y / p.z / viewport.y, 0.0, 1.0);
+      texCoord = position / size;
+    }
+  """
+  FRAGMENT_SHADER = """
+    uniform sampler2D frame;
+    uniform lowp float invert;
+    varying highp vec2 texCoord;
+    void main() {
+      lowp vec3 color = texture2D(frame, texCoord).rgb;
+      gl_FragColor = vec4(mix(color, 1.0 - color, invert), 1.0);
+    }
+  """
+  # past this many regions waiting to be uploaded, the frame is uploaded whole
+  MAX_PENDING = 64
+
+  def __init__(self, image):
+    super(GLFrameItem, self).__init__(image)
+    # (context, functions, program, texture), False if OpenGL is not usable
+    self._gl = None
+    # (size, format) of the texture
+    self._texture = None
+    self._pending = [(0, 0, image.copy())]
+
+  def setImage(self, image, rects=None):
+    if image.size() != self._pixmap.size():
+      rects = None
+    super(GLFrameItem, self).setImage(image, rects)
+    if rects is None or len(self._pending) + len(rects) > self.MAX_PENDING:
+      self._pending = [(0, 0, image.copy())]
+    else:
+      # the frame may be reused by the decoder before the next paint
+      self._pending.extend((x, y, image.copy(x, y, w, h)) for (x, y, w, h) in rects)
+
+  def paint(self, painter, option, widget=None):
+    context = QOpenGLContext.currentContext()
+    if self._gl is not False and context is not None and painter.paintEngine().type() == QPaintEngine.OpenGL2:
+      painter.beginNativePainting()
+      try:
+        if self._gl is None or self._gl[0] is not context:
+          self._setup(context)
+        self._draw(painter)
+        return
+      except Exception as e:
+        log.warning("Drawing with OpenGL failed, falling back to the CPU: %s", e)
+        self._gl = False
+      finally:
+        painter.endNativePainting()
+    super(GLFrameItem, self).paint(painter, option, widget)
+
+  def _setup(self, context):
+    profile = QOpenGLVersionProfile()
+    profile.setVersion(2, 0)
+    gl = context.versionFunctions(profile)
+    if gl is None:
+      raise RuntimeError("OpenGL 2.0 is not available")
+    gl.initializeOpenGLFunctions()
+    program = QOpenGLShaderProgram()
+    if not (program.addShaderFromSourceCode(QOpenGLShader.Vertex, self.VERTEX_SHADER)
+            and program.addShaderFromSourceCode(QOpenGLShader.Fragment, self.FRAGMENT_SHADER)
+            and program.link()):
+      raise RuntimeError(program.log())
+    texture = gl.glGenTextures(1)
+    gl.glBindTexture(GL_TEXTURE_2D, texture)
+    for parameter, value in ((GL_TEXTURE_MIN_FILTER, GL_LINEAR), (GL_TEXTURE_MAG_FILTER, GL_LINEAR),
+                             (GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE), (GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)):
+      gl.glTexParameteri(GL_TEXTURE_2D, parameter, value)
+    self._gl = (context, gl, program, texture)
+    # a new context starts from an empty texture
+    self._texture = None
+    self._pending = [(0, 0, self._pixmap.toImage())]
+
+  @staticmethod
+  def _glFormat(img):
+    """The image in a format OpenGL reads, with the matching format and type."""
+    if img.format() == QImage.Format_RGB16:
+      return img, GL_RGB, GL_UNSIGNED_SHORT_5_6_5
+    if img.format() == QImage.Format_Grayscale8:
+      return img, GL_LUMINANCE, GL_UNSIGNED_BYTE
+    return img.convertToFormat(QImage.Format_RGBA8888), GL_RGBA, GL_UNSIGNED_BYTE
+
+  def _draw(self, painter):
+    _, gl, program, texture = self._gl
+    gl.glActiveTexture(GL_TEXTURE0)
+    gl.glBindTexture(GL_TEXTURE_2D, texture)
+    # rows of QImages are aligned to 4 bytes
+    gl.glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+    size = self._pixmap.size()
+    for x, y, img in self._pending:
+      img, fmt, type_ = self._glFormat(img)
+      if img.size() == size and self._texture != (size, fmt):
+        # after a change of size the whole frame is pending
+        gl.glTexImage2D(GL_TEXTURE_2D, 0, fmt, size.width(), size.height(), 0, fmt, type_, None)
+        self._texture = (size, fmt)
+      bits = img.constBits()
+      bits.setsize(img.sizeInBytes())
+      gl.glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, img.width(), img.height(), fmt, type_, bits.asstring())
+    self._pending = []
+
+    w, h = size.width(), size.height()
+    device = painter.device()
+    program.bind()
+    program.setUniformValue('transform', painter.combinedTransform())
+    program.setUniformValue('viewport', QVector2D(device.width(), device.height()))
+    program.setUniformValue('size', QVector2D(w, h))
+    # an int sets the sampler, a float the inversion
+    program.setUniformValue('frame', 0)
+    program.setUniformValue('invert', 1.0 if self._inverted else 0.0)
+    program.enableAttributeArray('position')
+    program.setAttributeArray('position', [QVector2D(0, 0), QVector2D(w, 0), QVector2D(0, h), QVector2D(w, h)])
+    gl.glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
+    program.disableAttributeArray('position')
+    program.release()
+
 
 class QtImageViewer(QGraphicsView):
 
   pointerEvent = pyqtSignal(int, int, int)
+  # the item showing the frame, FrameItem, TiledFrameItem or GLFrameItem
+  frameItemClass = FrameItem
+  # part of the image shown, null when it is shown as a whole
+  visibleRectChanged = pyqtSignal(QRect)
   _button = 0
+  _visibleRect = QRect()
 
   zoomInFactor = 1.25
   zoomOutFactor = 1 / zoomInFactor
@@ -37,6 +336,13 @@ class QtImageViewer(QGraphicsView):
     self.setHorizontalScrollBarPolicy(Qt.ScrollBarAsNeeded)
     self.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
     self.setAlignment(Qt.AlignCenter)
+    # zooming, scrolling, resizing and rotating all move the scroll bars,
+    # often more than once, the visible rect is checked once they settle
+    self._visibleRectTimer = QTimer(self, singleShot=True, interval=0)
+    self._visibleRectTimer.timeout.connect(self._checkVisibleRect)
+    for bar in (self.horizontalScrollBar(), self.verticalScrollBar()):
+      bar.valueChanged.connect(lambda *_: self._visibleRectTimer.start())
+      bar.rangeChanged.connect(lambda *_: self._visibleRectTimer.start())
 
     ### ACTIONS
     self.fitAction = QAction('Fit to view', self, checkable=True)
@@ -122,22 +428,61 @@ class QtImageViewer(QGraphicsView):
       return self._pixmap.pixmap().toImage()
     return None
 
-  def setImage(self, image):
-    if type(image) is QImage:
-      if self._invert_colors:
-        image.invertPixels()
-      pixmap = QPixmap.fromImage(image)
-    else:
+  def setImage(self, image, rects=None):
+    """
+    Show image. If rects, a list of (x, y, w, h) tuples, is given,
+    only those regions are assumed to have changed since the last call.
+    """
+    if type(image) is not QImage:
       raise RuntimeError("ImageViewer.setImage: Argument must be a QImage.")
     if self.hasImage():
-      self._pixmap.setPixmap(pixmap)
+      resized = image.size() != self._pixmap.boundingRect().size().toSize()
+      self._pixmap.setImage(image, rects)
     else:
-      self._pixmap = self.scene.addPixmap(pixmap)
+      resized = True
+      self._pixmap = self.frameItemClass(image)
+      self._pixmap.setInverted(self._invert_colors)
       self._pixmap.setZValue(-1)
-    self._pixmap.setTransformationMode(Qt.SmoothTransformation)
-    self.setSceneRect(QRectF(pixmap.rect()))  # Set scene size to image size.
-    # self.fitInView(self.sceneRect(), self.aspectRatioMode)  # Show entire image (use current aspect ratio mode).
-    self.updateViewer()
+      self.scene.addItem(self._pixmap)
+    if resized:
+      self.setSceneRect(self._pixmap.boundingRect())  # Set scene size to image size.
+      # self.fitInView(self.sceneRect(), self.aspectRatioMode)  # Show entire image (use current aspect ratio mode).
+      self.updateViewer()
+
+  def useOpenGL(self):
+    """
+    Draw with OpenGL, the frame being kept in a texture and scaled,
+    rotated and inverted on the GPU. Returns whether OpenGL is available.
+    """
+    if not QOpenGLContext().create():
+      log.warning("OpenGL is not available, drawing on the CPU")
+      return False
+    image = self.image() if self.hasImage() else None
+    self.clearImage()
+    self.frameItemClass = GLFrameItem
+    self.setViewport(QOpenGLWidget())
+    # the page is a single quad, redrawing it all is cheaper than clipping
+    self.setViewportUpdateMode(QGraphicsView.FullViewportUpdate)
+    self.viewport().grabGesture(Qt.PinchGesture)
+    if image is not None:
+      if self._invert_colors:
+        image.invertPixels()
+      self.setImage(image)
+    return True
+
+  def visibleRect(self):
+    """The part of the image shown, in image coordinates, or a null rect if it is all shown."""
+    if not self.hasImage():
+      return QRect()
+    image = self.sceneRect().toAlignedRect()
+    shown = self.mapToScene(self.viewport().rect()).boundingRect().toAlignedRect() & image
+    return QRect() if shown == image else shown
+
+  def _checkVisibleRect(self):
+    rect = self.visibleRect()
+    if rect != self._visibleRect:
+      self._visibleRect = rect
+      self.visibleRectChanged.emit(rect)
 
   def updateViewer(self):
     if self.hasImage() is None:
@@ -229,10 +574,7 @@ class QtImageViewer(QGraphicsView):
   def invertColors(self):
     self._invert_colors = not self._invert_colors
     if self._pixmap:
-      img = self._pixmap.pixmap().toImage()
-      if not self._invert_colors:
-        img.invertPixels()
-      self.setImage(img)
+      self._pixmap.setInverted(self._invert_colors)
     self.setBackgroundBrush(_invertColor(self.backgroundBrush().color()))
 
   def isInverted(self):
@@ -0,0 +1,120 @@
+"""
+Clients keeping the pixels they decode, for the tests of the decoders:
+an RFBClient drawing into a bytearray, and a VncClient. Updates are fed
+as received from a server, one framebuffer update message at a time.
+"""
+import zlib
+from struct import pack
+
+from rmview import rfb
+from rmview.rfb import RFBClient
+from rmview.screenstream import common
+from rmview.screenstream.common import VncClient, FrameBuffer, ScreenStreamSignals
+
+PIXEL_FORMATS = {'gray8': 1, 'rgb16': 2}
+
+
+class NullTransport():
+
+  def write(self, data):
+    pass
+
+  def loseConnection(self):
+    pass
+
+
+class Receiver():
+  """
+  Mixin for RFBClient subclasses, to feed them updates as received
+  after the handshake.
+  """
+
+  def afterHandshake(self, width, height, bypp):
+    self.transport = NullTransport()
+    self.width, self.height = width, height
+    self.bypp = bypp
+    self.updates = 0
+    self._handler = self._handleExpected
+    self.expect(self._handleConnection, 1)
+
+  def update(self, encoding, payload, x=0, y=0, width=None, height=None):
+    """Receive an update of a single rectangle, the whole screen by default."""
+    width = self.width if width is None else width
+    height = self.height if height is None else height
+    self.dataReceived(pack("!BxH", 0, 1) + pack("!HHHHi", x, y, width, height, encoding) + payload)
+
+  def commitUpdate(self, rectangles=None):
+    self.updates += 1
+    super(Receiver, self).commitUpdate(rectangles)
+
+
+class Canvas(Receiver, RFBClient):
+  """An RFBClient keeping the pixels it decodes in a bytearray."""
+
+  def __init__(self, width, height, bypp, useNumpy):
+    super(Canvas, self).__init__()
+    self.useNumpy = useNumpy
+    self.pixels = bytearray(width * height * bypp)
+    self.afterHandshake(width, height, bypp)
+
+  def image(self):
+    return bytes(self.pixels)
+
+  def updateRectangle(self, x, y, width, height, data):
+    if rfb.np is not None and isinstance(data, rfb.np.ndarray):
+      data = rfb.np.ascontiguousarray(data, rfb.np.uint8).tobytes()
+    data = bytes(data)
+    if len(data) != width * height * self.bypp:
+      raise AssertionError("%d bytes for a %dx%d rectangle" % (len(data), width, height))
+    row = width * self.bypp
+    for r in range(height):
+      start = ((y + r) * self.width + x) * self.bypp
+      self.pixels[start:start + row] = data[r * row:(r + 1) * row]
+
+  def fillRectangle(self, x, y, width, height, color):
+    color = bytes(color)
+    if len(color) != self.bypp:
+      raise AssertionError("%d bytes for a pixel" % len(color))
+    self.updateRectangle(x, y, width, height, color * (width * height))
+
+
+class Screen(Receiver, VncClient):
+  """A VncClient with its own framebuffer, the image is the last frame emitted."""
+
+  def __init__(self, width, height, fmt, useNumpy, governor=None):
+    super(Screen, self).__init__(ScreenStreamSignals(), FrameBuffer(width, height, common.PIXEL_FORMATS[fmt]),
+                                 governor or common.FrameGovernor(max_fps=None))
+    self.useNumpy = useNumpy
+    self.afterHandshake(width, height, self.framebuffer.bypp)
+
+  def image(self):
+    with self.framebuffer.reading() as img:
+      bits = img.constBits().asstring(img.sizeInBytes())
+      row = img.width() * self.bypp
+      return b''.join(bits[r * img.bytesPerLine():][:row] for r in range(img.height()))
+
+
+def compressor():
+  """Compresses as a server does, with one zlib stream for all the updates."""
+  stream = zlib.compressobj()
+  return lambda data: stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)
+
+
+def imageOf(width, height, bypp, tiles):
+  """The pixels of a rectangle, from (x, y, w, h, pixels) tiles."""
+  image = bytearray(width * height * bypp)
+  for tile in tiles:
+    paint(image, width, bypp, *tile)
+  return bytes(image)
+
+
+def paint(image, width, bypp, x, y, w, h, pixels):
+  """Draw the w*h pixels, a list, at (x, y) of an image width pixels wide."""
+  for r in range(h):
+    start = ((y + r) * width + x) * bypp
+    image[start:start + w * bypp] = b''.join(pixels[r * w:(r + 1) * w])
+
+
+def randomColors(rng, bypp, count=16):
+  """Distinct pixels."""
+  return [c.to_bytes(bypp, 'little') for c in rng.sample(range(256 ** bypp), count)]
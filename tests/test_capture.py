@@ -0,0 +1,38 @@
+"""
+Recording the streams received by VncFactory, across reconnections.
+"""
+import os
+import tempfile
+import unittest
+
+from rmview.capture import readCapture
+from rmview.screenstream.common import VncFactory, ScreenStreamSignals
+
+
+class CaptureTest(unittest.TestCase):
+
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp(suffix='.rfbcap')
+    os.close(fd)
+    self.addCleanup(os.remove, self.path)
+
+  def testReconnect(self):
+    factory = VncFactory(ScreenStreamSignals(), capture=self.path)
+    first = factory.buildProtocol(None)
+    first.capture.write(b'RFB 003.008\n')
+    first.capture.write(b'refused')
+    # retrying, e.g. with another pixel format
+    second = factory.buildProtocol(None)
+    self.assertIs(second.capture, first.capture)
+    second.capture.write(b'RFB 003.008\n')
+    second.capture.write(b'frames')
+    factory.stopFactory()
+    self.assertIsNone(factory.captureWriter)
+    records = list(readCapture(self.path))
+    self.assertEqual([data for _, data in records], [b'RFB 003.008\n', b'frames'])
+    # timed from the start of the connection replayed
+    self.assertLess(records[0][0], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+"""
+ZRLE rectangles decoded by a DecodePool, while VncClient paces the
+frames it publishes.
+"""
+import threading
+import time
+import unittest
+from struct import pack
+
+from twisted.internet.task import Clock
+
+from rmview import rfb
+from rmview.rfb import ZRLE_ENCODING, DecodePool
+from rmview.screenstream import common
+from rmview.screenstream.common import FrameGovernor
+
+from canvas import Screen, compressor
+
+# two tiles
+WIDTH, HEIGHT = 128, 64
+
+
+class PausingScreen(Screen):
+  """A Screen whose decoding workers can be held after drawing a tile."""
+
+  hold = False
+
+  def __init__(self, *args, **kwargs):
+    super(PausingScreen, self).__init__(*args, **kwargs)
+    self.held = threading.Event()
+    self.release = threading.Event()
+
+  def updateRectangle(self, x, y, width, height, data):
+    super(PausingScreen, self).updateRectangle(x, y, width, height, data)
+    self.drawn()
+
+  def fillRectangle(self, x, y, width, height, color):
+    super(PausingScreen, self).fillRectangle(x, y, width, height, color)
+    self.drawn()
+
+  def drawn(self):
+    if self.hold and threading.current_thread() is not threading.main_thread():
+      self.hold = False
+      self.held.set()
+      self.release.wait(10)
+
+
+@unittest.skipIf(rfb.np is None, "needs NumPy")
+class DecodePoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = Clock()
+    reactor, common.reactor = common.reactor, self.clock
+    self.addCleanup(setattr, common, 'reactor', reactor)
+    self.screen = PausingScreen(WIDTH, HEIGHT, 'gray8', useNumpy=True, governor=FrameGovernor(max_fps=1))
+    self.screen._decodePool = DecodePool(self.screen, 2)
+    self.addCleanup(self.screen._decodePool.shutdown)
+    self.compress = compressor()
+
+  def update(self, gray):
+    """Receive a full screen update of solid tiles."""
+    tiles = bytes([1, gray]) * 2
+    data = self.compress(tiles)
+    self.screen.update(ZRLE_ENCODING, pack("!L", len(data)) + data)
+
+  def testDeferredFrame(self):
+    """A frame published while the next update is being decoded is not torn."""
+    screen = self.screen
+    self.update(10)
+    screen._decodePool.flush()
+    self.assertEqual(screen.image(), bytes([10]) * (WIDTH * HEIGHT))
+    # too early for another frame, the next one is deferred
+    self.update(20)
+    screen._decodePool.flush()
+    self.assertIsNotNone(screen._emitCall)
+    # a worker stops after the first tile of the next update
+    screen.hold = True
+    self.update(30)
+    self.assertTrue(screen.held.wait(10))
+    threading.Timer(0.1, screen.release.set).start()
+    self.clock.advance(1)
+    self.assertEqual(screen.image(), bytes([30]) * (WIDTH * HEIGHT))
+    self.assertEqual(screen.updates, 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,167 @@
+"""
+The Hextile, ZlibHex, RRE and CoRRE decoders against rectangles encoded
+from known pixels, and the fills of VncClient, with NumPy or QPainter,
+against the plain RFBClient ones.
+"""
+import random
+import unittest
+from struct import pack
+
+from rmview import rfb
+from rmview.rfb import HEXTILE_ENCODING, ZLIBHEX_ENCODING, RRE_ENCODING, CORRE_ENCODING, HEXTILE_ZLIB_RAW, HEXTILE_ZLIB_HEX
+
+from canvas import Canvas, Screen, PIXEL_FORMATS, compressor, paint, randomColors
+
+# full tiles and partial edge tiles, 5 and 7 pixels wide or high
+WIDTH, HEIGHT = 16 * 3 + 5, 16 * 2 + 7
+
+RAW, BACKGROUND, FOREGROUND, ANY_SUBRECTS, COLOURED = 1, 2, 4, 8, 16
+
+
+def tiles():
+  """Position and size of the tiles of the rectangle, in Hextile order."""
+  for ty in range(0, HEIGHT, 16):
+    for tx in range(0, WIDTH, 16):
+      yield tx, ty, min(16, WIDTH - tx), min(16, HEIGHT - ty)
+
+
+def subrect(rng, width, height):
+  x, y = rng.randrange(width), rng.randrange(height)
+  return x, y, rng.randint(1, width - x), rng.randint(1, height - y)
+
+
+def hextileTiles(rng, bypp):
+  """
+  Hextile tiles of all kinds, as (subencoding, data following it),
+  and the pixels they hold.
+  """
+  colors = randomColors(rng, bypp)
+  image = bytearray(WIDTH * HEIGHT * bypp)
+  encoded = []
+  bg = fg = None
+  for tx, ty, tw, th in tiles():
+    kind = rng.choice(('raw', 'solid', 'subrects', 'coloured'))
+    if kind == 'raw':
+      pixels = [rng.choice(colors) for _ in range(tw * th)]
+      encoded.append((RAW, b''.join(pixels)))
+      paint(image, WIDTH, bypp, tx, ty, tw, th, pixels)
+      # the colors are left undefined
+      bg = fg = None
+      continue
+    subencoding = 0
+    tile = bytearray()
+    if bg is None or rng.random() < 0.5:
+      subencoding |= BACKGROUND
+      bg = rng.choice(colors)
+      tile += bg
+    pixels = [bg] * (tw * th)
+    subrects = []
+    if kind == 'subrects':
+      if fg is None or rng.random() < 0.5:
+        subencoding |= FOREGROUND
+        fg = rng.choice(colors)
+        tile += fg
+      subrects = [(fg,) + subrect(rng, tw, th) for _ in range(rng.randint(1, 20))]
+    elif kind == 'coloured':
+      subencoding |= COLOURED
+      subrects = [(rng.choice(colors),) + subrect(rng, tw, th) for _ in range(rng.randint(1, 20))]
+    if subrects:
+      subencoding |= ANY_SUBRECTS
+      tile.append(len(subrects))
+      for color, sx, sy, sw, sh in subrects:
+        if subencoding & COLOURED:
+          tile += color
+        tile += bytes([sx << 4 | sy, (sw - 1) << 4 | (sh - 1)])
+        for r in range(sy, sy + sh):
+          pixels[r * tw + sx:r * tw + sx + sw] = [color] * sw
+    encoded.append((subencoding, bytes(tile)))
+    paint(image, WIDTH, bypp, tx, ty, tw, th, pixels)
+  return encoded, bytes(image)
+
+
+def encodeHextile(rng, bypp):
+  """Hextile data mixing all the kinds of tile, and the pixels it holds."""
+  encoded, image = hextileTiles(rng, bypp)
+  return b''.join(bytes([subencoding]) + tile for subencoding, tile in encoded), image
+
+
+def encodeZlibHex(rng, bypp):
+  """
+  ZlibHex data, with tiles compressed or not, raw tiles and hextile
+  encoded tiles each compressed in their own zlib stream.
+  """
+  encoded, image = hextileTiles(rng, bypp)
+  compressRaw, compressHex = compressor(), compressor()
+  data = bytearray()
+  for subencoding, tile in encoded:
+    if rng.random() < 0.3:
+      data += bytes([subencoding]) + tile
+      continue
+    if subencoding & RAW:
+      subencoding, tile = HEXTILE_ZLIB_RAW, compressRaw(tile)
+    else:
+      subencoding, tile = subencoding | HEXTILE_ZLIB_HEX, compressHex(tile)
+    data += bytes([subencoding]) + pack("!H", len(tile)) + tile
+  return bytes(data), image
+
+
+def encodeRRE(rng, bypp, coordinates="!HHHH"):
+  """RRE data, or CoRRE with coordinates "!BBBB", and the pixels it holds."""
+  colors = randomColors(rng, bypp)
+  bg = rng.choice(colors)
+  pixels = [bg] * (WIDTH * HEIGHT)
+  subrects = [subrect(rng, WIDTH, HEIGHT) for _ in range(rng.randint(1, 50))]
+  data = bytearray(pack("!I", len(subrects)) + bg)
+  for sx, sy, sw, sh in subrects:
+    color = rng.choice(colors)
+    data += color + pack(coordinates, sx, sy, sw, sh)
+    for r in range(sy, sy + sh):
+      pixels[r * WIDTH + sx:r * WIDTH + sx + sw] = [color] * sw
+  image = bytearray(WIDTH * HEIGHT * bypp)
+  paint(image, WIDTH, bypp, 0, 0, WIDTH, HEIGHT, pixels)
+  return bytes(data), bytes(image)
+
+
+ENCODINGS = {
+  'hextile': (HEXTILE_ENCODING, encodeHextile),
+  'ZlibHex': (ZLIBHEX_ENCODING, encodeZlibHex),
+  'RRE': (RRE_ENCODING, encodeRRE),
+  'CoRRE': (CORRE_ENCODING, lambda rng, bypp: encodeRRE(rng, bypp, "!BBBB")),
+}
+
+
+class HextileTest(unittest.TestCase):
+
+  def clients(self, fmt, bypp):
+    yield 'RFBClient', Canvas(WIDTH, HEIGHT, bypp, useNumpy=False)
+    yield 'VncClient, QPainter', Screen(WIDTH, HEIGHT, fmt, useNumpy=False)
+    if rfb.np is not None:
+      yield 'VncClient, NumPy', Screen(WIDTH, HEIGHT, fmt, useNumpy=True)
+
+  def testDecode(self):
+    for name, (encoding, encode) in ENCODINGS.items():
+      for fmt, bypp in PIXEL_FORMATS.items():
+        for seed in range(3):
+          data, image = encode(random.Random(seed), bypp)
+          for client, canvas in self.clients(fmt, bypp):
+            with self.subTest(encoding=name, pixel_format=fmt, seed=seed, client=client):
+              canvas.update(encoding, data)
+              self.assertEqual(canvas.updates, 1)
+              self.assertEqual(canvas.image(), image)
+
+  def testOverlap(self):
+    """The fills of a rectangle are applied before the next one is decoded."""
+    for fmt, bypp in PIXEL_FORMATS.items():
+      hextile, _ = encodeHextile(random.Random(0), bypp)
+      rre, image = encodeRRE(random.Random(1), bypp)
+      for client, canvas in self.clients(fmt, bypp):
+        with self.subTest(pixel_format=fmt, client=client):
+          canvas.dataReceived(pack("!BxH", 0, 2)
+                              + pack("!HHHHi", 0, 0, WIDTH, HEIGHT, HEXTILE_ENCODING) + hextile
+                              + pack("!HHHHi", 0, 0, WIDTH, HEIGHT, RRE_ENCODING) + rre)
+          self.assertEqual(canvas.updates, 1)
+          self.assertEqual(canvas.image(), image)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,126 @@
+"""
+The authentication of ScreenShare streams, with the challenges
+broadcast by the tablets.
+"""
+import hashlib
+import unittest
+import unittest.mock
+from struct import pack
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+
+from rmview.screenstream import common, screenshare
+from rmview.screenstream.screenshare import ChallengeReaderProtocol, ScreenShareStream
+
+
+class ChallengeReaderTest(unittest.TestCase):
+
+  def setUp(self):
+    patch = unittest.mock.patch.object(screenshare, 'reactor')
+    self.reactor = patch.start()
+    self.addCleanup(patch.stop)
+    self.addCleanup(setattr, ChallengeReaderProtocol, 'instance', None)
+    self.received = []
+
+  def stream(self, name, keep=False):
+    def callback(timestamp):
+      self.received.append((name, timestamp))
+      return keep
+    return callback
+
+  def testTablets(self):
+    ChallengeReaderProtocol.listen('10.0.0.1', self.stream('first', keep=True))
+    reader = ChallengeReaderProtocol.instance
+    ChallengeReaderProtocol.listen('10.0.0.2', self.stream('second'))
+    self.assertIs(ChallengeReaderProtocol.instance, reader)
+    self.reactor.listenUDP.assert_called_once_with(5901, reader)
+    one, two = pack("!Q", 1), pack("!Q", 2)
+    # from an address of neither tablet
+    reader.datagramReceived(one, ('10.0.0.3', 5901))
+    reader.datagramReceived(one, ('10.0.0.2', 5901))
+    reader.datagramReceived(one, ('10.0.0.1', 5901))
+    reader.datagramReceived(one, ('10.0.0.1', 5901))
+    self.assertEqual(self.received, [('second', one), ('first', one)])
+    # the second stream has its challenge, the first is alone
+    reader.datagramReceived(two, ('10.0.0.3', 5901))
+    self.assertEqual(self.received[-1], ('first', two))
+    ChallengeReaderProtocol.forget('10.0.0.1')
+    self.assertIsNone(ChallengeReaderProtocol.instance)
+    reader.listener.stopListening.assert_called_once_with()
+
+
+class Profiles():
+
+  def __init__(self):
+    self.updates = []
+
+  def update(self, fingerprint, **values):
+    self.updates.append(values)
+
+
+class SSH():
+  hostname = '10.0.0.1'
+  fingerprint = 'SHA256:tablet'
+  softwareVersion = (3, 0)
+
+  def __init__(self, userIdHash):
+    self.profile = {'userIdHash': userIdHash.hex()}
+    self.profiles = Profiles()
+
+
+def sha256(data):
+  return hashlib.sha256(data).digest()
+
+
+class AuthenticationTest(unittest.TestCase):
+
+  def patch(self, target, name, *new):
+    patch = unittest.mock.patch.object(target, name, *new)
+    patch.start()
+    self.addCleanup(patch.stop)
+
+  def setUp(self):
+    self.patch(screenshare, 'reactor')
+    self.patch(screenshare.internet, 'SSLClient')
+    self.patch(common, 'stopReactor')
+    # run at once
+    self.patch(screenshare.threads, 'deferToThread', lambda f, *args: defer.succeed(f(*args)))
+    self.addCleanup(setattr, ChallengeReaderProtocol, 'instance', None)
+    self.errors = []
+    self.ssh = SSH(sha256(b'old user'))
+    self.stream = ScreenShareStream(self.ssh)
+    self.stream.signals.onFatalError.connect(self.errors.append)
+    self.stream.get_userid = unittest.mock.Mock(return_value='new user')
+    self.stream.address = self.ssh.hostname
+    ChallengeReaderProtocol.listen(self.stream.address, self.stream.runVnc)
+
+  def challenge(self, timestamp):
+    ChallengeReaderProtocol.instance.datagramReceived(pack("!Q", timestamp), (self.ssh.hostname, 5901))
+    return self.stream.factory
+
+  def refuse(self, factory):
+    factory.authFailed = True
+    factory.clientConnectionLost(unittest.mock.Mock(), Failure(ConnectionDone()))
+
+  def testCachedUserIdRefused(self):
+    factory = self.challenge(1)
+    self.stream.get_userid.assert_not_called()
+    self.assertEqual(factory.challenge, sha256(pack("!Q", 1) + sha256(b'old user')))
+    # the cached hash is dropped, and the user id read again on the next challenge
+    self.refuse(factory)
+    self.assertIsNone(self.stream.factory)
+    factory = self.challenge(2)
+    self.stream.get_userid.assert_called_once_with()
+    self.assertEqual(factory.challenge, sha256(pack("!Q", 2) + sha256(b'new user')))
+    self.assertEqual(self.ssh.profiles.updates, [{'userIdHash': None}, {'userIdHash': sha256(b'new user').hex()}])
+    self.assertEqual(self.errors, [])
+    # refused again, with a hash just read
+    self.refuse(factory)
+    self.assertEqual(len(self.errors), 1)
+    common.stopReactor.assert_called_once_with()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,45 @@
+"""
+The timers kept by RFBClient while its stats are enabled.
+"""
+import time
+import unittest
+from struct import pack
+
+from rmview.rfb import RAW_ENCODING, HEXTILE_ENCODING
+from rmview.stats import Stats
+
+from canvas import Canvas
+
+WIDTH, HEIGHT = 64, 64
+
+# time waited between two parts of a rectangle
+PAUSE = 0.2
+
+
+class DecodeTimerTest(unittest.TestCase):
+
+  def testDataWaitNotCounted(self):
+    canvas = Canvas(WIDTH, HEIGHT, 1, useNumpy=False)
+    canvas.stats = Stats(enabled=True)
+    raw = bytes(range(256)) * (WIDTH * HEIGHT // 256)
+    hextile = bytes([2, 7]) * (WIDTH * HEIGHT // 256)
+    data = (pack("!BxH", 0, 2)
+            + pack("!HHHHi", 0, 0, WIDTH, HEIGHT, RAW_ENCODING) + raw
+            + pack("!HHHHi", 0, 0, WIDTH, HEIGHT, HEXTILE_ENCODING) + hextile)
+    # each rectangle arrives in two parts
+    for part in (data[:100], data[100:-10], data[-10:]):
+      canvas.dataReceived(part)
+      time.sleep(PAUSE)
+    self.assertEqual(canvas.updates, 1)
+    self.assertEqual(canvas.image(), bytes([7]) * (WIDTH * HEIGHT))
+    timers = canvas.stats.timers
+    for name in ('decode_RAW', 'decode_HEXTILE'):
+      with self.subTest(timer=name):
+        total, count = timers[name]
+        self.assertEqual(count, 1)
+        self.assertGreater(total, 0)
+        self.assertLess(total, PAUSE * 1e9 / 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,169 @@
+"""
+The Tight decoders, pure Python and NumPy, against rectangles encoded
+from known pixels, for each filter and with pixels sent as they are or
+as 24-bit TPIXELs.
+"""
+import random
+import unittest
+
+from rmview import rfb
+from rmview.rfb import TIGHT_ENCODING, TIGHT_FILL, TIGHT_FILTER_COPY, TIGHT_FILTER_PALETTE, TIGHT_FILTER_GRADIENT, \
+  TIGHT_MIN_TO_COMPRESS
+
+from canvas import Canvas, compressor
+
+WIDTH, HEIGHT = 21, 13
+
+# pixel formats as (bypp, bpp, depth, maxes, shifts), TPIXELs are
+# 3 bytes for 32 bits pixels with a depth of 24
+PIXEL_FORMATS = {
+  'gray8': (1, 8, 8, (255, 0, 0), (0, 0, 0)),
+  'rgb16': (2, 16, 16, (31, 63, 31), (11, 5, 0)),
+  'rgb32': (4, 32, 24, (255, 255, 255), (16, 8, 0)),
+}
+
+
+class TightCanvas(Canvas):
+
+  def __init__(self, fmt, useNumpy):
+    bypp, self.bpp, self.depth, maxes, shifts = PIXEL_FORMATS[fmt]
+    super(TightCanvas, self).__init__(WIDTH, HEIGHT, bypp, useNumpy)
+    self.bigendian = 0
+    self.redmax, self.greenmax, self.bluemax = maxes
+    self.redshift, self.greenshift, self.blueshift = shifts
+
+
+class Encoder():
+  """Encodes pixels, given as (r, g, b), as a Tight server would."""
+
+  def __init__(self, fmt):
+    self.bypp, bpp, depth, self.maxes, self.shifts = PIXEL_FORMATS[fmt]
+    self.tpixelSize = 3 if bpp == 32 and depth == 24 else self.bypp
+    self.streams = [compressor() for _ in range(4)]
+
+  def pixel(self, rgb):
+    """The pixel in the client format."""
+    value = sum(c << s for c, s in zip(rgb, self.shifts))
+    return value.to_bytes(self.bypp, 'little')
+
+  def tpixel(self, rgb):
+    return bytes(rgb) if self.tpixelSize == 3 else self.pixel(rgb)
+
+  def randomPixels(self, rng, count, colors=16):
+    palette = list({tuple(rng.randint(0, m) for m in self.maxes) for _ in range(colors)})
+    return [rng.choice(palette) for _ in range(count)]
+
+  def image(self, pixels):
+    return b''.join(self.pixel(rgb) for rgb in pixels)
+
+  def fill(self, rgb):
+    return bytes([TIGHT_FILL << 4]) + self.tpixel(rgb)
+
+  def basic(self, stream, filter_id, header, data):
+    control = bytes([(4 | stream) << 4, filter_id]) if filter_id is not None else bytes([stream << 4])
+    if len(data) >= TIGHT_MIN_TO_COMPRESS:
+      data = self.streams[stream](data)
+      data = compactLength(len(data)) + data
+    return control + header + data
+
+  def copy(self, pixels, stream=0, explicit=False):
+    data = b''.join(self.tpixel(rgb) for rgb in pixels)
+    return self.basic(stream, TIGHT_FILTER_COPY if explicit else None, b'', data)
+
+  def palette(self, pixels, width, stream=1):
+    palette = sorted(set(pixels))
+    header = bytes([len(palette) - 1]) + b''.join(self.tpixel(rgb) for rgb in palette)
+    indices = [palette.index(rgb) for rgb in pixels]
+    if len(palette) == 2:
+      data = bytearray()
+      for row in range(len(pixels) // width):
+        bits = indices[row * width:(row + 1) * width]
+        padding = -width % 8
+        value = int(''.join(map(str, bits)), 2) << padding
+        data += value.to_bytes((width + padding) // 8, 'big')
+    else:
+      data = bytes(indices)
+    return self.basic(stream, TIGHT_FILTER_PALETTE, header, bytes(data))
+
+  def gradient(self, pixels, width, stream=2):
+    diffs = []
+    for i, rgb in enumerate(pixels):
+      x, y = i % width, i // width
+      left = pixels[i - 1] if x else (0, 0, 0)
+      up = pixels[i - width] if y else (0, 0, 0)
+      upleft = pixels[i - width - 1] if x and y else (0, 0, 0)
+      predicted = [min(max(l + u - ul, 0), m) for l, u, ul, m in zip(left, up, upleft, self.maxes)]
+      diffs.append(tuple((c - p) & m for c, p, m in zip(rgb, predicted, self.maxes)))
+    data = b''.join(self.tpixel(d) for d in diffs)
+    return self.basic(stream, TIGHT_FILTER_GRADIENT, b'', data)
+
+
+def compactLength(length):
+  encoded = bytearray([length & 0x7f])
+  if length > 0x7f:
+    encoded[-1] |= 0x80
+    encoded.append(length >> 7 & 0x7f)
+    if length > 0x3fff:
+      encoded[-1] |= 0x80
+      encoded.append(length >> 14)
+  return bytes(encoded)
+
+
+class TightTest(unittest.TestCase):
+
+  def decoders(self):
+    return (False, True) if rfb.np is not None else (False,)
+
+  def check(self, fmt, rectangles):
+    """Decode the (x, y, width, height, data, pixels) rectangles, one update each."""
+    for useNumpy in self.decoders():
+      canvas = TightCanvas(fmt, useNumpy)
+      image = bytearray(canvas.pixels)
+      for x, y, width, height, data, pixels in rectangles:
+        with self.subTest(pixel_format=fmt, useNumpy=useNumpy, rectangle=(x, y, width, height)):
+          canvas.update(TIGHT_ENCODING, data, x, y, width, height)
+          for row in range(height):
+            start = ((y + row) * WIDTH + x) * canvas.bypp
+            image[start:start + width * canvas.bypp] = pixels[row * width * canvas.bypp:][:width * canvas.bypp]
+          self.assertEqual(canvas.image(), bytes(image))
+      self.assertEqual(canvas.updates, len(rectangles))
+
+  def testFilters(self):
+    for fmt in PIXEL_FORMATS:
+      rng = random.Random(0)
+      encoder = Encoder(fmt)
+      rectangles = []
+      # each filter compressed and, for the small ones, not compressed
+      for width, height in ((WIDTH, HEIGHT), (2, 1)):
+        pixels = encoder.randomPixels(rng, width * height)
+        rectangles.append((0, 0, width, height, encoder.copy(pixels), encoder.image(pixels)))
+        pixels = encoder.randomPixels(rng, width * height)
+        rectangles.append((0, 0, width, height, encoder.copy(pixels, 3, explicit=True), encoder.image(pixels)))
+        pixels = encoder.randomPixels(rng, width * height)
+        rectangles.append((0, 0, width, height, encoder.gradient(pixels, width), encoder.image(pixels)))
+        for colors in (2, 7):
+          pixels = encoder.randomPixels(rng, width * height, colors)
+          if len(set(pixels)) < 2:
+            pixels[0] = tuple(m - c for c, m in zip(pixels[1], encoder.maxes))
+          rectangles.append((0, 0, width, height, encoder.palette(pixels, width), encoder.image(pixels)))
+      rgb = encoder.randomPixels(rng, 1)[0]
+      rectangles.append((3, 2, 11, 5, encoder.fill(rgb), encoder.image([rgb] * 55)))
+      self.check(fmt, rectangles)
+
+  def testGradient(self):
+    """Smooth pixels, whose differences from the predicted ones are small."""
+    for fmt in PIXEL_FORMATS:
+      encoder = Encoder(fmt)
+      pixels = [tuple(min((x * 7 + y * 3) * (c + 1), m) for c, m in enumerate(encoder.maxes))
+                for y in range(HEIGHT) for x in range(WIDTH)]
+      self.check(fmt, [(0, 0, WIDTH, HEIGHT, encoder.gradient(pixels, WIDTH), encoder.image(pixels))])
+
+  def testGradientKnown(self):
+    # 2x2 gray8 pixels 10, 20 / 30, 25: the last is predicted as
+    # 20 + 30 - 10 = 40, and sent as 25 - 40 modulo 256
+    data = bytes([(4 | 2) << 4, TIGHT_FILTER_GRADIENT, 10, 10, 20, 241])
+    self.check('gray8', [(0, 0, 2, 2, data, bytes([10, 20, 30, 25]))])
+
+
+if __name__ == '__main__':
+  unittest.main()
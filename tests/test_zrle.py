@@ -0,0 +1,170 @@
+"""
+The ZRLE decoders, pure Python and NumPy, against tiles encoded from
+known pixels, and against each other.
+"""
+import random
+import unittest
+from struct import pack
+
+from rmview import rfb
+from rmview.rfb import ZRLE_ENCODING
+
+from canvas import Canvas, PIXEL_FORMATS, compressor, imageOf, randomColors
+
+# one full tile and partial edge tiles, 13 and 5 pixels wide or high,
+# so that the rows of packed palette indices are not byte-aligned
+WIDTH, HEIGHT = 64 + 13, 64 + 5
+
+
+def tiles():
+  """Position and size of the tiles of the rectangle, in ZRLE order."""
+  for ty in range(0, HEIGHT, 64):
+    for tx in range(0, WIDTH, 64):
+      yield tx, ty, min(64, WIDTH - tx), min(64, HEIGHT - ty)
+
+
+def runLength(length):
+  encoded = bytearray()
+  length -= 1
+  while length >= 255:
+    encoded.append(255)
+    length -= 255
+  encoded.append(length)
+  return encoded
+
+
+def runs(pixels):
+  """Runs of equal pixels, as (pixel, length)."""
+  result = []
+  for pixel in pixels:
+    if result and result[-1][0] == pixel:
+      result[-1][1] += 1
+    else:
+      result.append([pixel, 1])
+  return result
+
+
+def encodeRaw(rng, colors, tw, th):
+  pixels = [rng.choice(colors) for _ in range(tw * th)]
+  return bytes([0]) + b''.join(pixels), pixels
+
+
+def encodeSolid(rng, colors, tw, th):
+  color = rng.choice(colors)
+  return bytes([1]) + color, [color] * (tw * th)
+
+
+def encodePacked(rng, colors, tw, th, size):
+  palette = colors[:size]
+  bits = 1 if size == 2 else 2 if size <= 4 else 4
+  indices = [rng.randrange(size) for _ in range(tw * th)]
+  encoded = bytearray([size]) + b''.join(palette)
+  for r in range(th):
+    row = 0
+    for i in indices[r * tw:(r + 1) * tw]:
+      row = row << bits | i
+    padding = -(tw * bits) % 8
+    encoded += (row << padding).to_bytes((tw * bits + padding) // 8, 'big')
+  return bytes(encoded), [palette[i] for i in indices]
+
+
+def runPixels(rng, choices, tw, th):
+  """Pixels in runs of 1 to 300, so that run lengths take several bytes."""
+  pixels = []
+  while len(pixels) < tw * th:
+    length = rng.choice((1, 1, 2, rng.randrange(3, 300)))
+    pixels += [rng.choice(choices)] * length
+  return pixels[:tw * th]
+
+
+def encodePlainRLE(rng, colors, tw, th):
+  pixels = runPixels(rng, colors, tw, th)
+  encoded = bytearray([128])
+  for pixel, length in runs(pixels):
+    encoded += pixel + runLength(length)
+  return bytes(encoded), pixels
+
+
+def encodePaletteRLE(rng, colors, tw, th, size):
+  palette = colors[:size]
+  pixels = runPixels(rng, palette, tw, th)
+  encoded = bytearray([128 + size]) + b''.join(palette)
+  for pixel, length in runs(pixels):
+    index = palette.index(pixel)
+    if length == 1:
+      encoded.append(index)
+    else:
+      encoded += bytes([index | 0x80]) + runLength(length)
+  return bytes(encoded), pixels
+
+
+ENCODINGS = {
+  'raw': encodeRaw,
+  'solid': encodeSolid,
+  'packed palette, 1 bit': lambda *args: encodePacked(*args, size=2),
+  'packed palette, 2 bits': lambda *args: encodePacked(*args, size=3),
+  'packed palette, 4 bits': lambda *args: encodePacked(*args, size=16),
+  'plain RLE': encodePlainRLE,
+  'palette RLE': lambda *args: encodePaletteRLE(*args, size=5),
+}
+
+class ZRLETest(unittest.TestCase):
+
+  def encode(self, encoding, bypp, seed=0):
+    """The ZRLE data of the rectangle, and the pixels it holds."""
+    rng = random.Random(seed)
+    colors = randomColors(rng, bypp)
+    data = bytearray()
+    decoded = []
+    for tx, ty, tw, th in tiles():
+      tile, pixels = ENCODINGS[encoding](rng, colors, tw, th)
+      data += tile
+      decoded.append((tx, ty, tw, th, pixels))
+    return bytes(data), imageOf(WIDTH, HEIGHT, bypp, decoded)
+
+  def decode(self, data, bypp, useNumpy):
+    canvas = Canvas(WIDTH, HEIGHT, bypp, useNumpy)
+    compressed = compressor()(data)
+    canvas.update(ZRLE_ENCODING, pack("!L", len(compressed)) + compressed)
+    self.assertEqual(canvas.updates, 1)
+    return canvas.image()
+
+  def testPython(self):
+    for encoding in ENCODINGS:
+      for fmt, bypp in PIXEL_FORMATS.items():
+        with self.subTest(encoding=encoding, pixel_format=fmt):
+          data, image = self.encode(encoding, bypp)
+          self.assertEqual(self.decode(data, bypp, useNumpy=False), image)
+
+  @unittest.skipIf(rfb.np is None, "needs NumPy")
+  def testNumpy(self):
+    for encoding in ENCODINGS:
+      for fmt, bypp in PIXEL_FORMATS.items():
+        with self.subTest(encoding=encoding, pixel_format=fmt):
+          data, image = self.encode(encoding, bypp)
+          self.assertEqual(self.decode(data, bypp, useNumpy=True), image)
+
+  @unittest.skipIf(rfb.np is None, "needs NumPy")
+  def testParity(self):
+    """Both decoders agree on rectangles mixing all the encodings."""
+    for fmt, bypp in PIXEL_FORMATS.items():
+      for seed in range(5):
+        with self.subTest(pixel_format=fmt, seed=seed):
+          rng = random.Random(seed)
+          colors = randomColors(rng, bypp)
+          data = b''.join(ENCODINGS[rng.choice(sorted(ENCODINGS))](rng, colors, tw, th)[0]
+                          for tx, ty, tw, th in tiles())
+          self.assertEqual(self.decode(data, bypp, useNumpy=False),
+                           self.decode(data, bypp, useNumpy=True))
+
+  def testTooManyPixels(self):
+    # a run longer than the tile
+    data = bytes([128]) + bytes(2) + runLength(WIDTH * HEIGHT)
+    for useNumpy in (False, True) if rfb.np is not None else (False,):
+      with self.subTest(useNumpy=useNumpy):
+        with self.assertRaises(ValueError):
+          self.decode(data, 2, useNumpy)
+
+
+if __name__ == '__main__':
+  unittest.main()